@@ -0,0 +1,245 @@
+"""igvm - Remote Agent Client
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import inspect
+import json
+import logging
+import socket
+from base64 import b64decode, b64encode
+from pipes import quote
+from threading import Event, Lock, Thread
+
+from paramiko import SSHException
+
+from igvm import remote_agent
+from igvm.exceptions import RemoteCommandError
+from igvm.ssh import CommandResult, get_command
+
+log = logging.getLogger(__name__)
+
+_agents = {}
+_agents_lock = Lock()
+_start_locks = {}
+
+
+def get_agent(ssh_connection):
+    """Return the agent started on the host of the connection or None
+
+    The agent is started on first use, and again, if it has exited, for
+    example because the connection was lost.  None is returned, if
+    the agent cannot be started on the host, and it is not tried again.
+    The agents are started under a lock per host, so the other hosts
+    don't wait for them.
+    """
+    host_string = ssh_connection.host_string
+    with _agents_lock:
+        start_lock = _start_locks.setdefault(host_string, Lock())
+
+    with start_lock:
+        with _agents_lock:
+            agent = _agents.get(host_string, False)
+        if agent is None or (agent and not agent.closed):
+            return agent
+        try:
+            agent = Agent.start(ssh_connection)
+        except (RemoteCommandError, socket.error, SSHException) as error:
+            log.warning(
+                'Cannot start the agent on "{}", running the commands '
+                'over SSH: {}'.format(host_string, error)
+            )
+            agent = None
+        with _agents_lock:
+            _agents[host_string] = agent
+        return agent
+
+
+def close_agents():
+    with _agents_lock:
+        agents = list(_agents.values())
+        _agents.clear()
+    for agent in agents:
+        if agent is not None:
+            agent.close()
+
+
+def get_agent_command():
+    """Return the command to start the agent by the Python of the host"""
+    return 'exec "$(command -v python3 || command -v python)" -c {}'.format(
+        quote(inspect.getsource(remote_agent))
+    )
+
+
+class Agent(object):
+    """Client of the agent running on a host
+
+    The agent is started over SSH once, and the following requests are
+    sent to it over the same channel instead of opening a new session
+    and running sudo for each of them.  The requests can be sent by
+    multiple threads at the same time.  The responses are read by
+    another thread and handed to the waiting threads by the IDs of
+    the requests.  The results are decoded from JSON, so they don't
+    need to be parsed from the output of commands.
+    """
+    def __init__(self, name, reader, writer, close=None):
+        self.name = name
+        self.closed = False
+        self._reader = reader
+        self._writer = writer
+        self._close = close
+        self._lock = Lock()
+        self._next_id = 0
+        self._pending = {}
+
+        try:
+            hello = json.loads(reader.readline().decode('utf-8'))
+        except ValueError:
+            hello = {}
+        if not hello.get('ready'):
+            self.close()
+            reader.close()
+            raise RemoteCommandError(
+                'Agent on "{}" did not start.'.format(self.name)
+            )
+        if hello.get('version') != remote_agent.PROTOCOL_VERSION:
+            self.close()
+            reader.close()
+            raise RemoteCommandError(
+                'Agent on "{}" speaks protocol version {}.'
+                .format(self.name, hello.get('version'))
+            )
+
+        thread = Thread(target=self._read_responses)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def start(cls, ssh_connection):
+        channel = ssh_connection.open_session()
+        channel.exec_command(get_command(get_agent_command()))
+        log.debug('Started the agent on "{}".'.format(
+            ssh_connection.host_string
+        ))
+        return cls(
+            ssh_connection.host_string,
+            channel.makefile('rb'),
+            channel.makefile('wb'),
+            channel.close,
+        )
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        # The agent exits, when its standard input is closed.  The reader
+        # is closed by its thread, when it reaches the end.
+        try:
+            self._writer.close()
+        except (IOError, OSError, socket.error):
+            pass
+        if self._close is not None:
+            self._close()
+
+    def call(self, op, **args):
+        """Send the request and return the result of the operation
+
+        RemoteCommandError is raised, if the operation fails or the agent
+        exits before responding.
+        """
+        waiter = [Event(), None]
+        with self._lock:
+            if self.closed:
+                raise RemoteCommandError(
+                    'Agent on "{}" is closed.'.format(self.name)
+                )
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = waiter
+            try:
+                self._writer.write(json.dumps({
+                    'id': request_id,
+                    'op': op,
+                    'args': args,
+                }).encode('utf-8') + b'\n')
+                self._writer.flush()
+            except (IOError, OSError, socket.error) as error:
+                # The reading thread may not have noticed the exit yet.
+                self.closed = True
+                del self._pending[request_id]
+                raise RemoteCommandError(
+                    'Cannot send request to agent on "{}": {}'
+                    .format(self.name, error)
+                )
+
+        waiter[0].wait()
+        response = waiter[1]
+        if 'error' in response:
+            raise RemoteCommandError(
+                'Operation {} on "{}" failed: {}'
+                .format(op, self.name, response['error'])
+            )
+        return response['result']
+
+    def run(self, command, silent=False, warn_only=False, stdin=None):
+        """Run the command like SSHConnection.run() as root"""
+        if not silent:
+            log.info('[{}] agent run: {}'.format(self.name, command))
+
+        if stdin is not None:
+            if not isinstance(stdin, bytes):
+                stdin = stdin.encode('utf-8')
+            stdin = b64encode(stdin).decode('ascii')
+        response = self.call('run', command=command, stdin=stdin)
+        if not silent:
+            for line in response['stdout'].splitlines():
+                log.info('[{}] out: {}'.format(self.name, line))
+
+        # SSHConnection.run() is also stripping the output.
+        result = CommandResult(
+            response['stdout'].strip(),
+            response['return_code'],
+            response['stderr'].strip(),
+        )
+        if result.failed and not warn_only:
+            raise RemoteCommandError(
+                'Command on "{}" failed with exit code {}: {}\n{}'.format(
+                    self.name, result.return_code, command, result.stderr
+                )
+            )
+        return result
+
+    def stat(self, path):
+        """Return the size, the mode and the type of the file or None"""
+        return self.call('stat', path=path)
+
+    def read_files(self, paths):
+        contents = self.call('read_files', paths=list(paths))
+        return {
+            p: b64decode(contents[p]).decode('utf-8', 'replace')
+            for p in paths
+        }
+
+    def _read_responses(self):
+        try:
+            for line in iter(self._reader.readline, b''):
+                response = json.loads(line.decode('utf-8'))
+                with self._lock:
+                    waiter = self._pending.pop(response['id'], None)
+                if waiter is not None:
+                    waiter[1] = response
+                    waiter[0].set()
+        except (IOError, OSError, ValueError, socket.error) as error:
+            log.debug('Reading from agent on "{}" failed: {}'.format(
+                self.name, error
+            ))
+
+        # The waiting threads would never get their responses otherwise.
+        with self._lock:
+            self.closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for waiter in pending:
+            waiter[1] = {'error': 'The agent has exited.'}
+            waiter[0].set()
+        self.close()
+        self._reader.close()
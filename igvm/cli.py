@@ -4,13 +4,14 @@ Copyright (c) 2017, InnoGames GmbH
 """
 
 from __future__ import print_function
-from argparse import ArgumentParser, _SubParsersAction
+from argparse import SUPPRESS, Action, ArgumentParser, _SubParsersAction
 import logging
 import sys
 import time
 
 from fabric.network import disconnect_all
 
+from igvm.agent import close_agents
 from igvm.buildvm import buildvm
 from igvm.migratevm import migratevm
 from igvm.commands import (
@@ -25,10 +26,32 @@ from igvm.commands import (
     vm_delete,
     vm_sync,
     vm_rename,
+    vm_place,
+    vm_build_many,
+    rebalance,
+    simulate_placement,
+    snapshot_export,
 )
+from igvm.query_cache import QueryCache
+from igvm.session import Session
+from igvm.settings import HYPERVISOR_CHECK_CONCURRENCY
+from igvm.ssh import close_ssh_connections
 from igvm.utils.cli import white, red
 from igvm.utils.virtutils import close_virtconns
 
+log = logging.getLogger(__name__)
+
+# These commands are only reading Serveradmin, so they can use the cache.
+# The placement is only read-only without the commit argument.  Restarting
+# is not, as the VM is redefined from its Serveradmin object.  Starting,
+# stopping and the information about a VM are not either, as they would
+# use the cached hypervisor of the VM, even if it has been migrated in
+# the meantime.
+READ_ONLY_COMMANDS = [
+    snapshot_export,
+    vm_place,
+]
+
 
 class IGVMArgumentParser(ArgumentParser):
     def error(self, message):
@@ -65,10 +88,52 @@ class IGVMArgumentParser(ArgumentParser):
         return '\n'.join(out)
 
 
-def parse_args():
+class OnlyModeAction(Action):
+    """Accept the flag of the only mode of a command
+
+    Nothing is passed to the command for the flag.
+    """
+    def __init__(self, option_strings, dest, **kwargs):
+        super(OnlyModeAction, self).__init__(
+            option_strings, SUPPRESS, nargs=0, **kwargs
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        pass
+
+
+def parse_args(args=None):
     top_parser = IGVMArgumentParser('igvm')
     top_parser.add_argument('--silent', '-s', action='count', default=0)
     top_parser.add_argument('--verbose', '-v', action='count', default=0)
+    top_parser.add_argument(
+        '--cached',
+        action='store_true',
+        help=(
+            'Read Serveradmin through the local cache for the read-only '
+            'commands'
+        ),
+    )
+    top_parser.add_argument(
+        '--agent',
+        action='store_true',
+        help=(
+            'Run the commands on the hypervisors through an agent started '
+            'once instead of a new SSH session for every command'
+        ),
+    )
+    top_parser.add_argument(
+        '--check-concurrency',
+        dest='check_concurrency',
+        type=int,
+        default=HYPERVISOR_CHECK_CONCURRENCY,
+        help=(
+            'Number of the best hypervisors to connect to and validate '
+            'concurrently when selecting one for a VM (default: {}, to only '
+            'connect to the ones needed)'
+            .format(HYPERVISOR_CHECK_CONCURRENCY)
+        ),
+    )
 
     subparsers = top_parser.add_subparsers(help='Actions')
 
@@ -102,6 +167,50 @@ def parse_args():
         help='Force build on a Host which has the state online_reserved',
     )
 
+    subparser = subparsers.add_parser(
+        'build-many',
+        description=vm_build_many.__doc__,
+    )
+    subparser.set_defaults(func=vm_build_many)
+    subparser.add_argument(
+        'vm_hostnames',
+        nargs='+',
+        help='Hostnames of the guest systems',
+    )
+    subparser.add_argument(
+        '--nopuppet',
+        action='store_true',
+        help='Skip running puppet in chroot before powering up',
+    )
+    subparser.add_argument(
+        '--ignore-reserved',
+        dest='ignore_reserved',
+        action='store_true',
+        help='Force build on Hosts which have the state online_reserved',
+    )
+
+    subparser = subparsers.add_parser(
+        'place',
+        description=vm_place.__doc__,
+    )
+    subparser.set_defaults(func=vm_place)
+    subparser.add_argument(
+        'vm_hostnames',
+        nargs='+',
+        help='Hostnames of the guest systems',
+    )
+    subparser.add_argument(
+        '--commit',
+        action='store_true',
+        help='Set the selected hypervisors on Serveradmin',
+    )
+    subparser.add_argument(
+        '--ignore-reserved',
+        dest='ignore_reserved',
+        action='store_true',
+        help='Allow Hosts which have the state online_reserved',
+    )
+
     subparser = subparsers.add_parser(
         'migrate',
         description=migratevm.__doc__,
@@ -339,20 +448,89 @@ def parse_args():
         help='Shutdown VM, if running',
     )
 
-    return vars(top_parser.parse_args())
+    subparser = subparsers.add_parser(
+        'rebalance',
+        description=rebalance.__doc__,
+    )
+    subparser.set_defaults(func=rebalance)
+    subparser.add_argument(
+        '--plan',
+        action=OnlyModeAction,
+        help=(
+            'Only print the planned migrations, which is the default and '
+            'the only mode'
+        ),
+    )
+    subparser.add_argument(
+        '--max-moves',
+        dest='max_moves',
+        type=int,
+        default=10,
+        help='Maximum number of migrations to plan',
+    )
+
+    subparser = subparsers.add_parser(
+        'snapshot',
+        description=snapshot_export.__doc__,
+    )
+    subparser.set_defaults(func=snapshot_export)
+    subparser.add_argument(
+        'path',
+        help='File to write the snapshot to',
+    )
+
+    subparser = subparsers.add_parser(
+        'simulate',
+        description=simulate_placement.__doc__,
+    )
+    subparser.set_defaults(func=simulate_placement)
+    subparser.add_argument(
+        'path',
+        help='Snapshot file to simulate the placements on',
+    )
+    subparser.add_argument(
+        '--count',
+        type=int,
+        default=1000,
+        help='Number of placement requests to replay',
+    )
+    subparser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for generating the placement requests',
+    )
+
+    return vars(top_parser.parse_args(args))
 
 
 def main():
     args = parse_args()
     configure_logging(args.pop('silent'), args.pop('verbose'))
 
+    func = args.pop('func')
+    query_cache = None
+    if args.pop('cached'):
+        if func in READ_ONLY_COMMANDS and not args.get('commit'):
+            query_cache = QueryCache()
+        else:
+            log.warning(
+                'The cache is not used for the commands changing servers.'
+            )
+
     try:
-        args.pop('func')(**args)
+        # The servers are shared by everything the command does.
+        with Session(
+            query_cache, args.pop('agent'), args.pop('check_concurrency')
+        ):
+            func(**args)
     finally:
         # Fabric requires the disconnect function to be called after every
         # use.  We are also taking our chance to disconnect from
         # the hypervisors.
         disconnect_all()
+        close_agents()
+        close_ssh_connections()
         close_virtconns()
 
         # The underlying library of Fabric, Paramiko, raises an error, on
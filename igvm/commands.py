@@ -8,10 +8,23 @@ import logging
 from fabric.colors import green, red, white, yellow
 from fabric.network import disconnect_all
 
-from igvm.exceptions import InvalidStateError
-from igvm.host import with_fabric_settings
+from igvm.agent import close_agents
+from igvm.exceptions import IGVMError, InvalidStateError
+from igvm.placement import BatchPlacement
+from igvm.rebalance import RebalancePlanner
+from igvm.simulation import (
+    PlacementSimulator,
+    export_snapshot,
+    load_snapshot,
+)
+from igvm.settings import (
+    HYPERVISOR_CONTROL_ATTRIBUTES,
+    HYPERVISOR_DEFINE_ATTRIBUTES,
+)
+from igvm.ssh import close_ssh_connections
+from igvm.utils.transaction import Transaction
 from igvm.utils.units import parse_size
-from igvm.vm import VM
+from igvm.vm import VM, load_vms
 
 log = logging.getLogger(__name__)
 
@@ -33,10 +46,13 @@ def _check_defined(vm, fail_hard=True):
             log.info(error)
 
 
-@with_fabric_settings
 def vcpu_set(vm_hostname, count, offline=False, ignore_reserved=False):
     """Change the number of CPUs in a VM"""
-    vm = VM(vm_hostname, ignore_reserved=ignore_reserved)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=ignore_reserved,
+        hypervisor_attributes=HYPERVISOR_DEFINE_ATTRIBUTES,
+    )
     _check_defined(vm)
 
     if offline and not vm.is_running():
@@ -56,7 +72,6 @@ def vcpu_set(vm_hostname, count, offline=False, ignore_reserved=False):
         vm.start()
 
 
-@with_fabric_settings
 def mem_set(vm_hostname, size, offline=False, ignore_reserved=False):
     """Change the memory size of a VM
 
@@ -65,7 +80,11 @@ def mem_set(vm_hostname, size, offline=False, ignore_reserved=False):
     difference in the size.  Reducing memory is only allowed while the VM is
     powered off.
     """
-    vm = VM(vm_hostname, ignore_reserved=ignore_reserved)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=ignore_reserved,
+        hypervisor_attributes=HYPERVISOR_DEFINE_ATTRIBUTES,
+    )
     _check_defined(vm)
 
     if size.startswith('+'):
@@ -92,7 +111,6 @@ def mem_set(vm_hostname, size, offline=False, ignore_reserved=False):
         vm.start()
 
 
-@with_fabric_settings
 def disk_set(vm_hostname, size, ignore_reserved=False):
     """Change the disk size of a VM
 
@@ -102,7 +120,11 @@ def disk_set(vm_hostname, size, ignore_reserved=False):
     a relative difference in the size.  Of course, minus is going to
     error out.
     """
-    vm = VM(vm_hostname, ignore_reserved=ignore_reserved)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=ignore_reserved,
+        hypervisor_attributes=HYPERVISOR_CONTROL_ATTRIBUTES,
+    )
     _check_defined(vm)
 
     current_size_gib = vm.dataset_obj['disk_size_gib']
@@ -119,10 +141,9 @@ def disk_set(vm_hostname, size, ignore_reserved=False):
     vm.hypervisor.vm_set_disk_size_gib(vm, new_size_gib)
 
     vm.dataset_obj['disk_size_gib'] = new_size_gib
-    vm.dataset_obj.commit()
+    vm.commit()
 
 
-@with_fabric_settings
 def vm_build(vm_hostname, localimage=None, nopuppet=False, postboot=None,
              ignore_reserved=False):
     """Create a VM and start it
@@ -132,20 +153,115 @@ def vm_build(vm_hostname, localimage=None, nopuppet=False, postboot=None,
 
     vm = VM(vm_hostname)
 
+    # The hypervisor is reset, if the build fails.
+    with Transaction() as tx:
+        # Could also have been set in serveradmin already.
+        if not vm.hypervisor:
+            vm.set_best_hypervisor(
+                ['online', 'online_reserved'] if ignore_reserved
+                else ['online'],
+                tx,
+            )
+
+        vm.build(
+            localimage=localimage,
+            runpuppet=not nopuppet,
+            postboot=postboot,
+            tx=tx,
+        )
+
+
+def _place_vms(vm_hostnames, ignore_reserved=False, commit=False):
+    """Place the VMs without a hypervisor together
+
+    The selected hypervisors are validated for the VMs.  They are only
+    set on Serveradmin, if commit is set.  The VMs are returned in
+    the given order.
+    """
+    vms = load_vms(vm_hostnames)
+
     # Could also have been set in serveradmin already.
-    if not vm.hypervisor:
-        vm.set_best_hypervisor(
-            ['online', 'online_reserved'] if ignore_reserved else ['online']
+    unplaced_vms = []
+    for vm in vms:
+        if vm.hypervisor:
+            log.info(
+                '"{}" is already placed on "{}".'
+                .format(vm.fqdn, vm.hypervisor)
+            )
+        else:
+            unplaced_vms.append(vm)
+
+    if unplaced_vms:
+        placement = BatchPlacement.query(
+            set(vm.dataset_obj['route_network'] for vm in unplaced_vms),
+            ['online', 'online_reserved'] if ignore_reserved else ['online'],
         )
+        for vm, hypervisor in placement.place_all(unplaced_vms, check=True):
+            if commit:
+                vm.set_hypervisor(hypervisor)
+            else:
+                vm.hypervisor = hypervisor
 
-    vm.build(
-        localimage=localimage,
-        runpuppet=not nopuppet,
-        postboot=postboot,
-    )
+    return vms
+
+
+def vm_place(vm_hostnames, commit=False, ignore_reserved=False):
+    """Select hypervisors for multiple VMs at once
+
+    The hypervisors are selected for all of the VMs together considering
+    the previously selected ones.  The selection is only printed, unless
+    the commit argument is passed to set it on Serveradmin.
+    """
+    vms = _place_vms(vm_hostnames, ignore_reserved, commit)
+
+    max_fqdn_len = max(len(vm.fqdn) for vm in vms)
+    for vm in vms:
+        print('{} : {}'.format(vm.fqdn.ljust(max_fqdn_len), vm.hypervisor))
+
+
+def vm_build_many(vm_hostnames, nopuppet=False, ignore_reserved=False):
+    """Create multiple VMs and start them
+
+    The hypervisors are selected for all of the VMs together and
+    committed, before building them one after another, so the other igvm
+    processes see them as taken.  The selected hypervisor is reset,
+    if the build of the VM fails.  The selected hypervisors of the VMs
+    not built yet are reset, if we stop on an unexpected error.
+    """
+    vms = _place_vms(vm_hostnames, ignore_reserved)
+
+    # Could also have been set in serveradmin already.
+    placed_vms = [vm for vm in vms if not vm.dataset_obj['xen_host']]
+    for vm in placed_vms:
+        vm.set_hypervisor(vm.hypervisor)
+
+    unbuilt_vms = list(placed_vms)
+    failed = []
+    try:
+        for vm in vms:
+            # The transaction of the build resets the hypervisor from now on.
+            if vm in unbuilt_vms:
+                unbuilt_vms.remove(vm)
+            try:
+                with Transaction() as tx:
+                    if vm in placed_vms:
+                        tx.on_rollback(
+                            'reset hypervisor', vm.reset_hypervisor
+                        )
+                    vm.build(runpuppet=not nopuppet, tx=tx)
+            except IGVMError as error:
+                log.error('Building "{}" failed:  {}'.format(vm.fqdn, error))
+                failed.append(vm.fqdn)
+    finally:
+        for vm in unbuilt_vms:
+            vm.reset_hypervisor()
+
+    if failed:
+        raise IGVMError(
+            'Failed to build {} VMs: {}'.format(len(failed), ', '.join(failed))
+        )
 
 
-@with_fabric_settings
 def vm_rebuild(vm_hostname, force=False):
     """Destroy and reinstall a VM"""
     vm = VM(vm_hostname, ignore_reserved=True)
@@ -161,10 +277,9 @@ def vm_rebuild(vm_hostname, force=False):
     vm.build()
 
 
-@with_fabric_settings
 def vm_start(vm_hostname):
     """Start a VM"""
-    vm = VM(vm_hostname)
+    vm = VM(vm_hostname, hypervisor_attributes=HYPERVISOR_CONTROL_ATTRIBUTES)
     _check_defined(vm)
 
     if vm.is_running():
@@ -173,10 +288,9 @@ def vm_start(vm_hostname):
     vm.start()
 
 
-@with_fabric_settings
 def vm_stop(vm_hostname, force=False):
     """Gracefully stop a VM"""
-    vm = VM(vm_hostname)
+    vm = VM(vm_hostname, hypervisor_attributes=HYPERVISOR_CONTROL_ATTRIBUTES)
     _check_defined(vm)
 
     if not vm.is_running():
@@ -189,7 +303,6 @@ def vm_stop(vm_hostname, force=False):
     log.info('"{}" is stopped.'.format(vm.fqdn))
 
 
-@with_fabric_settings
 def vm_restart(vm_hostname, force=False, no_redefine=False):
     """Restart a VM
 
@@ -197,7 +310,11 @@ def vm_restart(vm_hostname, force=False, no_redefine=False):
     useful to discard temporary changes or adapt new hypervisor optimizations.
     No data will be lost.
     """
-    vm = VM(vm_hostname, ignore_reserved=True)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=True,
+        hypervisor_attributes=HYPERVISOR_DEFINE_ATTRIBUTES,
+    )
     _check_defined(vm)
 
     if not vm.is_running():
@@ -215,7 +332,6 @@ def vm_restart(vm_hostname, force=False, no_redefine=False):
     log.info('"{}" is restarted.'.format(vm.fqdn))
 
 
-@with_fabric_settings
 def vm_delete(vm_hostname, force=False, retire=False):
     """Delete the VM from the hypervisor and from serveradmin
 
@@ -228,7 +344,11 @@ def vm_delete(vm_hostname, force=False, retire=False):
     state will be updated to 'retired'.
     """
 
-    vm = VM(vm_hostname, ignore_reserved=True)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=True,
+        hypervisor_attributes=HYPERVISOR_CONTROL_ATTRIBUTES,
+    )
     # Make sure the VM has a hypervisor and that it is defined on it.
     # Abort if the VM has not been defined and force is not True.
     _check_defined(vm, fail_hard=not force)
@@ -249,27 +369,30 @@ def vm_delete(vm_hostname, force=False, retire=False):
     # or update its state to 'retired' if retire is True.
     if retire:
         vm.dataset_obj['state'] = 'retired'
-        vm.dataset_obj.commit()
+        vm.commit()
         log.info(
             '"{}" is destroyed and set to "retired" state.'
             .format(vm.fqdn)
         )
     else:
         vm.dataset_obj.delete()
-        vm.dataset_obj.commit()
+        vm.commit()
         log.info(
             '"{}" is destroyed and deleted from Serveradmin'
             .format(vm.fqdn)
         )
 
 
-@with_fabric_settings
 def vm_sync(vm_hostname):
     """Synchronize VM resource attributes to Serveradmin
 
     This command collects actual resource allocation of a VM from the
     hypervisor and overwrites outdated attribute values in Serveradmin."""
-    vm = VM(vm_hostname, ignore_reserved=True)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=True,
+        hypervisor_attributes=HYPERVISOR_CONTROL_ATTRIBUTES,
+    )
     _check_defined(vm)
 
     attributes = vm.hypervisor.vm_sync_from_hypervisor(vm)
@@ -283,7 +406,7 @@ def vm_sync(vm_hostname):
         vm.dataset_obj[attrib] = value
         changed.append(attrib)
     if changed:
-        vm.dataset_obj.commit()
+        vm.commit()
         log.info(
             '"{}" is synchronized {} attributes ({}).'
             .format(vm.fqdn, len(changed), ', '.join(changed))
@@ -294,18 +417,23 @@ def vm_sync(vm_hostname):
         )
 
 
-@with_fabric_settings
 def host_info(vm_hostname):
     """Extract runtime information about a VM
 
     Library consumers should use VM.info() directly.
     """
-    vm = VM(vm_hostname, ignore_reserved=True)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=True,
+        hypervisor_attributes=HYPERVISOR_CONTROL_ATTRIBUTES,
+    )
 
     info = vm.info()
 
-    # Disconnect fabric now to avoid messages after the table
+    # Disconnect now to avoid messages after the table
     disconnect_all()
+    close_agents()
+    close_ssh_connections()
 
     categories = (
         ('General', (
@@ -399,7 +527,6 @@ def host_info(vm_hostname):
             print('{} : {}'.format(k.ljust(max_key_len), value))
 
 
-@with_fabric_settings
 def vm_rename(vm_hostname, new_hostname, offline=False):
     """Redefine the VM on the same hypervisor with a different name
 
@@ -407,7 +534,11 @@ def vm_rename(vm_hostname, new_hostname, offline=False):
     to be shut down.  No data will be lost.
     """
 
-    vm = VM(vm_hostname, ignore_reserved=True)
+    vm = VM(
+        vm_hostname,
+        ignore_reserved=True,
+        hypervisor_attributes=HYPERVISOR_DEFINE_ATTRIBUTES,
+    )
     _check_defined(vm)
 
     if not offline:
@@ -420,3 +551,58 @@ def vm_rename(vm_hostname, new_hostname, offline=False):
         )
 
     vm.rename(new_hostname)
+
+
+def rebalance(max_moves=10):
+    """Plan VM migrations to reduce the CPU over-allocation
+
+    The migrations are simulated using the same preferences as for
+    selecting hypervisors.  The planned migrations are printed as igvm
+    commands to run.
+    """
+    planner = RebalancePlanner.query()
+    before = planner.get_over_allocations()
+    moves = planner.plan(max_moves)
+    after = planner.get_over_allocations()
+
+    if not moves:
+        log.info('No migration would improve the over-allocation.')
+        return
+
+    rows = planner.aggregates.rows
+    for vm_obj, source, target in moves:
+        print(
+            'igvm migrate {} {}  # {:.2f} -> {:.2f}, {:.2f} -> {:.2f}'
+            .format(
+                vm_obj['hostname'],
+                target,
+                before[rows[source]],
+                after[rows[source]],
+                before[rows[target]],
+                after[rows[target]],
+            )
+        )
+    log.info(
+        'Maximum CPU over-allocation would change from {:.2f} to {:.2f} '
+        'with {} migrations.'
+        .format(before.max(), after.max(), len(moves))
+    )
+
+
+def snapshot_export(path):
+    """Write the hypervisors with their VMs to a snapshot file
+
+    The snapshot can be used to simulate placements without Serveradmin.
+    """
+    count = export_snapshot(path)
+    log.info('{} hypervisors written to "{}".'.format(count, path))
+
+
+def simulate_placement(path, count=1000, seed=0):
+    """Replay generated placement requests against a snapshot file
+
+    The decision latencies and the quality of the placements are printed.
+    """
+    simulator = PlacementSimulator(load_snapshot(path), seed=seed)
+    for line in simulator.run(count).format():
+        print(line)
@@ -3,148 +3,354 @@
 Copyright (c) 2018, InnoGames GmbH
 """
 
-from StringIO import StringIO
+from base64 import b64decode
+from pipes import quote
 
 from adminapi.dataset import Query
 from adminapi.filters import ExactMatch, Startswith, Or
 
-import fabric.api
-import fabric.state
-from fabric.contrib import files
-
-from paramiko import transport
+from igvm.agent import get_agent
 from igvm.exceptions import ConfigError, RemoteCommandError, InvalidStateError
+from igvm.query_cache import QueryCache, query
+from igvm.route_network_index import clear_route_network_index
+from igvm.session import get_session
 from igvm.settings import (
-    COMMON_FABRIC_SETTINGS,
     VM_ATTRIBUTES,
     HYPERVISOR_ATTRIBUTES,
 )
+from igvm.ssh import get_command, get_ssh_connection
 from igvm.utils.lazy_property import lazy_property
 from igvm.utils.network import get_network_config
 
 
-def get_server(hostname, servertype):
+def get_server(hostname, servertype, reload=False, attributes=None):
     """Get a server from Serveradmin by hostname and servertype
 
     The function is accepting hostnames in any length as long as it resolves
     to a single server on Serveradmin.  It returns the adminapi DatasetObject.
+    The object is shared within the active session, unless it is reloaded.
+    The attributes needed by all commands are loaded, unless the attributes
+    for the operation are given.
     """
+    session = get_session()
+    if session is None:
+        return _query_server(hostname, servertype, attributes)
+
+    if not reload:
+        server = session.get_server(hostname, servertype)
+        if server is not None:
+            return server
+
+    return session.add_server(
+        hostname,
+        servertype,
+        _query_server(hostname, servertype, attributes),
+        reload,
+    )
+
+
+def get_servers(hostnames, servertype):
+    """Get multiple servers from Serveradmin with a single Query
+
+    The hostnames are accepted like get_server() does.  The objects are
+    returned in the same order.  ConfigError is raised, if a hostname
+    doesn't resolve to a single server.  The objects already in the active
+    session are not queried again.
+    """
+    session = get_session()
+    servers = {}
+    if session is not None:
+        for hostname in hostnames:
+            server = session.get_server(hostname, servertype)
+            if server is not None:
+                servers[hostname] = server
+
+    missing = [h for h in hostnames if h not in servers]
+    if missing:
+        results = query({
+            'servertype': servertype,
+            'hostname': Or(*(c for h in missing for c in _get_conditions(h))),
+        }, _get_attributes(servertype))
+        for hostname in missing:
+            matches = [r for r in results if _matches(hostname, r['hostname'])]
+            if len(matches) != 1:
+                raise ConfigError(
+                    '{} servers of servertype "{}" found for "{}".'
+                    .format(len(matches), servertype, hostname)
+                )
+            servers[hostname] = matches[0]
+            if session is not None:
+                servers[hostname] = session.add_server(
+                    hostname, servertype, matches[0]
+                )
 
+    return [servers[h] for h in hostnames]
+
+
+def get_fqdn(hostname):
+    """Return the FQDN of the server with the hostname"""
+    if hostname.endswith('.ig.local'):
+        return hostname
+    return hostname + '.ig.local'
+
+
+def _query_server(hostname, servertype, attributes=None):
+    filters = {
+        'servertype': servertype,
+        'hostname': Or(*_get_conditions(hostname)),
+    }
+    if attributes is None:
+        attributes = _get_attributes(servertype)
+    servers = query(filters, attributes)
+    if len(servers) != 1:
+        # Let adminapi raise its error
+        Query(filters, attributes).get()
+    return servers[0]
+
+
+def _get_conditions(hostname):
     conditions = [ExactMatch(hostname)]
     if hostname.endswith('.ig.local'):
         conditions.append(ExactMatch(hostname[:-len('.ig.local')]))
     else:
         conditions.append(Startswith(hostname + '.'))
+    return conditions
 
-    return Query(
-        {
-            'servertype': servertype,
-            'hostname': Or(*conditions),
-        },
-        HYPERVISOR_ATTRIBUTES if servertype == 'hypervisor' else VM_ATTRIBUTES
-    ).get()
 
+def _matches(hostname, server_hostname):
+    """Check the server hostname with the conditions above"""
+    if hostname.endswith('.ig.local'):
+        return server_hostname in (hostname, hostname[:-len('.ig.local')])
+    return (
+        server_hostname == hostname or
+        server_hostname.startswith(hostname + '.')
+    )
+
+
+def _get_attributes(servertype):
+    if servertype == 'hypervisor':
+        return HYPERVISOR_ATTRIBUTES
+    return VM_ATTRIBUTES
+
+
+class CommandBatch(object):
+    """Steps to run on a host by a single remote shell
+
+    The steps are run one after another by the same shell, so they can
+    use the variables set by the previous ones.  The batch stops at the
+    first failing step and RemoteCommandError is raised naming it.  Every
+    step is preceded by a marker line to split the output by the steps.
+    """
+    marker = '--- igvm step {} ---'
+
+    def __init__(self, host, silent=False):
+        self.host = host
+        self.silent = silent
+        self.steps = []
+
+    def add(self, command):
+        self.steps.append(command)
+
+    def get_script(self):
+        return '\n'.join(
+            "printf '\\n%s\\n' '{}'\n{{ {}\n}} || exit $?".format(
+                self.marker.format(index), step
+            )
+            for index, step in enumerate(self.steps)
+        )
+
+    def run(self, stdin=None):
+        """Run the steps and return their outputs
+
+        The stdin data is read by the steps reading their standard input.
+        """
+        if not self.steps:
+            return []
+
+        result = self.host.run(
+            self.get_script(), silent=self.silent, warn_only=True, stdin=stdin
+        )
+        outputs = []
+        for line in result.splitlines():
+            if line == self.marker.format(len(outputs)):
+                outputs.append([])
+            elif outputs:
+                outputs[-1].append(line)
 
-def with_fabric_settings(fn):
-    """Decorator to run a function with COMMON_FABRIC_SETTINGS."""
-    def decorator(*args, **kwargs):
-        with fabric.api.settings(**COMMON_FABRIC_SETTINGS):
-            return fn(*args, **kwargs)
-    decorator.__name__ = '{}_with_fabric'.format(fn.__name__)
-    decorator.__doc__ = fn.__doc__
-    return decorator
+        if result.failed:
+            raise RemoteCommandError(
+                'Step {} of {} failed on "{}" with exit code {}: {}\n{}'
+                .format(
+                    len(outputs),
+                    len(self.steps),
+                    self.host,
+                    result.return_code,
+                    self.steps[len(outputs) - 1] if outputs else '',
+                    result.stderr,
+                )
+            )
+        return ['\n'.join(o).strip() for o in outputs]
 
 
 class Host(object):
     """A remote host on which commands can be executed."""
 
-    def __init__(self, name_or_obj, ignore_reserved=False):
+    # The agent is only started on the hosts known to have Python
+    agent_supported = False
+
+    def __init__(self, name_or_obj, ignore_reserved=False, attributes=None):
+        self.attributes = attributes
         if isinstance(name_or_obj, (str, unicode)):
-            self.dataset_obj = get_server(name_or_obj, self.servertype)
+            self.dataset_obj = get_server(
+                name_or_obj, self.servertype, attributes=attributes
+            )
         else:
             self.dataset_obj = name_or_obj
 
-        if self.dataset_obj['hostname'].endswith('.ig.local'):
-            self.fqdn = self.dataset_obj['hostname']
-        else:
-            self.fqdn = self.dataset_obj['hostname'] + '.ig.local'
+        self.fqdn = get_fqdn(self.dataset_obj['hostname'])
 
-        if (
-            not ignore_reserved and
-            self.dataset_obj['state'] == 'online_reserved'
-        ):
-            raise InvalidStateError(
-                'Server "{0}" is online_reserved.'.format(self.fqdn)
+        if not ignore_reserved:
+            self.check_reserved()
+
+    @classmethod
+    def get_shared(cls, name_or_obj, ignore_reserved=False, attributes=None):
+        """Return the host shared within the active session
+
+        A new host is created, if there is no session or the host is not
+        in the session yet.  The host is shared with the attributes it was
+        first loaded with.
+        """
+        session = get_session()
+        if session is None:
+            return cls(name_or_obj, ignore_reserved, attributes)
+
+        if isinstance(name_or_obj, (str, unicode)):
+            hostname = get_server(
+                name_or_obj, cls.servertype, attributes=attributes
+            )['hostname']
+        else:
+            # The given object is shared, so the lookups by the name
+            # return the same one.
+            hostname = name_or_obj['hostname']
+            name_or_obj = session.add_server(
+                hostname, cls.servertype, name_or_obj
+            )
+        host = session.get_host(cls.servertype, hostname)
+        if host is None:
+            return session.add_host(
+                cls(name_or_obj, ignore_reserved, attributes)
             )
 
+        if not ignore_reserved:
+            host.check_reserved()
+        return host
+
     def __str__(self):
         return self.fqdn
 
     def __eq__(self, other):
         return isinstance(other, Host) and self.fqdn == other.fqdn
 
-    def fabric_settings(self, *args, **kwargs):
-        """Builds a fabric context manager to run commands on this host."""
-        settings = COMMON_FABRIC_SETTINGS.copy()
-        settings.update({
-            'abort_exception': RemoteCommandError,
-            'host_string': str(self.dataset_obj['intern_ip']),
-        })
-        settings.update(kwargs)
-        return fabric.api.settings(*args, **settings)
-
-    def run(self, *args, **kwargs):
+    def check_reserved(self):
+        if self.dataset_obj['state'] == 'online_reserved':
+            raise InvalidStateError(
+                'Server "{0}" is online_reserved.'.format(self.fqdn)
+            )
+
+    @property
+    def ssh_connection(self):
+        return get_ssh_connection(str(self.dataset_obj['intern_ip']))
+
+    @property
+    def agent(self):
+        """Returns the agent to run the commands through or None
+
+        The agent is only used, if the session asks for it."""
+        session = get_session()
+        if not self.agent_supported or session is None or (
+            not session.use_agent
+        ):
+            return None
+        return get_agent(self.ssh_connection)
+
+    def run(self, command, silent=False, warn_only=False, with_sudo=True,
+            shell=True, stdin=None):
         """Runs a command on the remote host.
+
+        The commands can be run on multiple hosts or on the same host by
+        multiple threads at the same time.
         :param warn_only: If set, no exception is raised if the command fails
-        :param silent: If set, no output is written for successful runs"""
-        settings = []
-        warn_only = kwargs.get('warn_only', False)
-        with_sudo = kwargs.get('with_sudo', True)
-        if kwargs.get('silent', False):
-            hide = 'everything' if warn_only else 'commands'
-            settings.append(fabric.api.hide(hide))
-
-        # Purge settings that should not be passed to run()
-        for setting in ['warn_only', 'silent', 'with_sudo']:
-            if setting in kwargs:
-                del kwargs[setting]
-
-        with self.fabric_settings(*settings, warn_only=warn_only):
-            try:
-                if with_sudo:
-                    return fabric.api.sudo(*args, **kwargs)
-                else:
-                    return fabric.api.run(*args, **kwargs)
-            except transport.socket.error:
-                # Retry once if connection was lost
-                host = fabric.api.env.host_string
-                if host and host in fabric.state.connections:
-                    fabric.state.connections[host].get_transport().close()
-                if with_sudo:
-                    return fabric.api.sudo(*args, **kwargs)
-                else:
-                    return fabric.api.run(*args, **kwargs)
-
-    def file_exists(self, *args, **kwargs):
-        """Run a fabric.contrib.files.exists on this host with sudo."""
-        with self.fabric_settings():
-            try:
-                return files.exists(*args, **kwargs)
-            except transport.socket.error:
-                # Retry once if connection was lost
-                host = fabric.api.env.host_string
-                if host and host in fabric.state.connections:
-                    fabric.state.connections[host].get_transport().close()
-                return files.exists(*args, **kwargs)
+        :param silent: If set, no output is written for successful runs
+        :param shell: If set, the command is run inside a shell
+        :param stdin: Data to send to the standard input of the command
+
+        The commands are run through the agent as root inside a shell,
+        if there is one."""
+        agent = self.agent
+        if agent is not None:
+            return agent.run(command, silent, warn_only, stdin)
+        return self.ssh_connection.run(
+            get_command(command, with_sudo, shell), silent, warn_only, stdin
+        )
+
+    def batch(self, silent=False):
+        """Returns a batch to run multiple commands at once"""
+        return CommandBatch(self, silent)
+
+    def file_exists(self, path):
+        """Checks whether the path exists on this host."""
+        agent = self.agent
+        if agent is not None:
+            return agent.stat(path) is not None
+        return self.run(
+            'test -e {}'.format(quote(path)),
+            silent=True,
+            warn_only=True,
+            with_sudo=False,
+        ).succeeded
 
     def read_file(self, path):
         """Reads a file from the remote host and returns contents."""
         if '*' in path:
             raise ValueError('No globbing supported')
-        with self.fabric_settings(fabric.api.hide('commands')):
-            fd = StringIO()
-            fabric.api.get(path, fd)
-            return fd.getvalue()
+        agent = self.agent
+        if agent is not None:
+            return agent.read_files([path])[path]
+        return self.ssh_connection.read_file(path)
+
+    def read_files(self, paths):
+        """Reads multiple files from the remote host at once
+
+        The files are encoded with base64 by the steps of a single batch,
+        so their contents cannot be confused with the markers.  Returns
+        a dictionary of the contents by the paths."""
+        if any('*' in p for p in paths):
+            raise ValueError('No globbing supported')
+        agent = self.agent
+        if agent is not None:
+            return agent.read_files(paths)
+        batch = self.batch(silent=True)
+        for path in paths:
+            batch.add('base64 {}'.format(quote(path)))
+        return {
+            p: b64decode(o).decode('utf-8', 'replace')
+            for p, o in zip(paths, batch.run())
+        }
+
+    def commit(self, tx=None):
+        """Commits the changes of the server object to Serveradmin
+
+        The changes are only staged on the transaction, if one is given,
+        to be committed together with the following ones.  The cached
+        Queries and route networks are cleared, because they can include
+        the server.
+        """
+        if tx is not None:
+            tx.stage(self)
+            return
+        self.dataset_obj.commit()
+        QueryCache().clear()
+        clear_route_network_index()
 
     def reload(self):
         """Reloads the server object from serveradmin."""
@@ -153,7 +359,10 @@ class Host(object):
                 'Serveradmin object must be committed before reloading'
             )
         self.dataset_obj = get_server(
-            self.dataset_obj['hostname'], self.servertype
+            self.dataset_obj['hostname'],
+            self.servertype,
+            reload=True,
+            attributes=self.attributes,
         )
 
     @lazy_property  # Requires fabric call on hypervisor, evaluate lazily.
@@ -6,11 +6,15 @@ Copyright (c) 2018, InnoGames GmbH
 import logging
 import math
 import urllib2
-
-from libvirt import VIR_DOMAIN_SHUTOFF
-
-from adminapi.dataset import Query
-from adminapi.filters import Any, Empty, Not
+from contextlib import contextmanager
+from threading import Lock
+
+from libvirt import (
+    VIR_DOMAIN_EVENT_DEFINED,
+    VIR_DOMAIN_EVENT_UNDEFINED,
+    VIR_DOMAIN_SHUTOFF,
+    libvirtError,
+)
 
 from igvm.exceptions import (
     ConfigError,
@@ -20,8 +24,14 @@ from igvm.exceptions import (
     StorageError,
 )
 from igvm.host import Host
+from igvm.hypervisor_facts import FactsCache, HypervisorFacts, LVM_COMMAND
+from igvm.hypervisor_stats import HypervisorStats
+from igvm.lvm import LVMInventory, get_seqno_command
+from igvm.query_cache import query
+from igvm.route_network_index import get_route_network_index
 from igvm.settings import (
     HOST_RESERVED_MEMORY,
+    HYPERVISOR_VM_ATTRIBUTES,
     VG_NAME,
     RESERVED_DISK,
     FOREMAN_IMAGE_URL,
@@ -36,7 +46,8 @@ from igvm.utils.kvm import (
     set_memory,
     set_vcpus,
 )
-from igvm.utils.virtutils import get_virtconn
+from igvm.utils.lazy_property import lazy_property
+from igvm.utils.virtutils import get_virtconn, register_domain_events
 
 log = logging.getLogger(__name__)
 
@@ -44,6 +55,7 @@ log = logging.getLogger(__name__)
 class Hypervisor(Host):
     """Hypervisor interface."""
     servertype = 'hypervisor'
+    agent_supported = True
 
     def __init__(self, *args, **kwargs):
         super(Hypervisor, self).__init__(*args, **kwargs)
@@ -57,6 +69,77 @@ class Hypervisor(Host):
         # We cannot store these in the VM object due to migrations.
         self._mount_path = {}
 
+        # The statistics of the domains are collected once and reused,
+        # until we change the domains.
+        self._stats = None
+
+        # The domains are indexed by their names for the connection
+        # the events of which are dropping the index.  The events are
+        # received by another thread, so the index is guarded by the lock.
+        # The generation is increased every time the index is dropped.
+        self._domains = None
+        self._domains_conn = None
+        self._domains_generation = 0
+        self._domains_lock = Lock()
+
+        # The logical volumes are listed once and updated for our changes.
+        # The decisions on the space check whether others have changed them
+        # since, unless no decision has used them since they were listed.
+        self._lvm = None
+        self._lvm_used = False
+
+        # The facts are gathered or read from the cache on first use.
+        # The boot ID is the last one we have seen on the hypervisor.
+        self._facts = None
+        self._boot_id = None
+
+    @lazy_property
+    def vms(self):
+        """Return the VM objects on the hypervisor
+
+        Only the Queries for placement include them in the hypervisor
+        object, otherwise they are queried on first access.
+        """
+        if 'vms' in self.dataset_obj:
+            return list(self.dataset_obj['vms'])
+
+        return query({
+            'servertype': 'vm',
+            'xen_host': self.dataset_obj['hostname'],
+        }, HYPERVISOR_VM_ATTRIBUTES)
+
+    @property
+    def facts(self):
+        """Return the facts gathered by a single remote command
+
+        The static facts are read from the cache, if they are cached for
+        the current boot ID of the hypervisor.  The boot ID is listed
+        together with the logical volumes, if we don't know it yet.
+        Otherwise the facts are gathered, and the boot ID and
+        the inventory of the logical volumes are taken from the same
+        output, so nothing is listed before.
+        """
+        if self._facts is None:
+            facts = FactsCache().get(self.fqdn)
+            if facts is not None:
+                if self._boot_id is None:
+                    self._get_lvm()
+                if facts.boot_id != self._boot_id:
+                    facts = None
+            if facts is None:
+                facts = HypervisorFacts.gather(self)
+                FactsCache().put(self.fqdn, facts)
+                self._lvm = LVMInventory(facts.lvm_output, VG_NAME)
+                self._lvm_used = False
+                self._boot_id = facts.boot_id
+            self._facts = facts
+        return self._facts
+
+    @property
+    def num_cpus(self):
+        """Returns the number of online CPUs"""
+        return self.facts.num_cpus
+
     def vm_disk_path(self, name):
         return '/dev/{}/{}'.format(VG_NAME, name)
 
@@ -73,10 +156,9 @@ class Hypervisor(Host):
     def vlan_for_vm(self, vm):
         """Returns the VLAN number a VM should use on this hypervisor.
         None for untagged."""
-        vlans = [v['vlan_tag'] for v in Query({
-            'hostname': Any(*self.dataset_obj['vlan_networks']),
-            'vlan_tag': Not(Empty()),
-        }, ['vlan_tag'])]
+        vlans = get_route_network_index().get_vlan_tags(
+            self.dataset_obj['vlan_networks']
+        )
 
         vm_vlan = vm.network_config['vlan_tag']
         if not vlans:
@@ -170,6 +252,8 @@ class Hypervisor(Host):
         log.info('Defining "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
 
         self.conn().defineXML(generate_domain_xml(self, vm))
+        self.invalidate_stats()
+        self.invalidate_domains()
 
         # Refresh storage pools to register the vm image
         for pool_name in self.conn().listStoragePools():
@@ -231,7 +315,7 @@ class Hypervisor(Host):
             )
 
         vm.dataset_obj['num_cpu'] = num_cpu
-        vm.dataset_obj.commit()
+        vm.commit()
 
     def vm_set_memory(self, vm, memory):
         self._check_committed(vm)
@@ -262,6 +346,7 @@ class Hypervisor(Host):
         else:
             old_total = vm.meminfo()['MemTotal']
             set_memory(self, vm, self._get_domain(vm))
+            self.invalidate_stats()
             # Hypervisor might take some time to propagate memory changes,
             # wait until MemTotal changes.
             retry_wait_backoff(
@@ -277,15 +362,14 @@ class Hypervisor(Host):
                 'changes will not be committed.'
             )
 
-        vm.dataset_obj.commit()
+        vm.commit()
 
     def vm_set_disk_size_gib(self, vm, new_size_gib):
         """Changes disk size of a VM."""
         if new_size_gib < vm.dataset_obj['disk_size_gib']:
             raise NotImplementedError('Cannot shrink the disk.')
         domain = self._get_domain(vm)
-        with self.fabric_settings():
-            self.lvresize(self.vm_disk_path(domain.name()), new_size_gib)
+        self.lvresize(self.vm_disk_path(domain.name()), new_size_gib)
 
         self._vm_set_disk_size_gib(vm, new_size_gib)
 
@@ -374,8 +458,10 @@ class Hypervisor(Host):
         """Unmount VM filesystem."""
         if vm not in self._mount_path:
             return
-        self.umount_temp(self._mount_path[vm])
-        self.remove_temp(self._mount_path[vm])
+        batch = self.batch()
+        batch.add('umount {0}'.format(self._mount_path[vm]))
+        batch.add('rmdir {0}'.format(self._mount_path[vm]))
+        batch.run()
         del self._mount_path[vm]
         vm.mounted = False
 
@@ -384,16 +470,14 @@ class Hypervisor(Host):
         the hypervisor. Returns a dict with all collected values."""
         # Update disk size
         result = {}
-        lvs = self.get_logical_volumes()
         domain = self._get_domain(vm)
-        for lv in lvs:
-            if lv['name'] == domain.name():
-                result['disk_size_gib'] = int(math.ceil(lv['size_MiB'] / 1024))
-                break
-        else:
+        # The volume might be created by others since we listed them.
+        lv = self._get_lvm(current=True).get(domain.name())
+        if lv is None:
             raise HypervisorError(
                 'Unable to find source LV and determine its size.'
             )
+        result['disk_size_gib'] = int(math.ceil(lv['size_MiB'] / 1024))
 
         self._vm_sync_from_hypervisor(vm, result)
         return result
@@ -409,7 +493,7 @@ class Hypervisor(Host):
 
     def num_numa_nodes(self):
         """Return the number of NUMA nodes"""
-        return self.conn().getInfo()[4]
+        return len(self.facts.numa_cpulists)
 
     def _find_domain(self, vm):
         """Search and return the domain on hypervisor
@@ -417,21 +501,70 @@ class Hypervisor(Host):
         It is erroring out when multiple domains found, and returning None,
         when none found.
         """
+        domains = self._get_domains()
+
+        # The domain can be named by the FQDN or any prefix of it ending
+        # before a dot.
+        names = [vm.fqdn[:i] for i, c in enumerate(vm.fqdn) if c == '.']
+        names.append(vm.fqdn)
+
         found = None
-        # We are not using lookupByName(), because it prints ugly messages to
-        # the console.
-        for domain in self.conn().listAllDomains():
-            name = domain.name()
-            if not (vm.fqdn == name or vm.fqdn.startswith(name + '.')):
+        for name in names:
+            if name not in domains:
                 continue
             if found is not None:
                 raise HypervisorError(
                     'Same VM is defined multiple times as "{}" and "{}".'
                     .format(found.name(), name)
                 )
-            found = domain
+            found = domains[name]
         return found
 
+    def _get_domains(self):
+        """Return the domains on the hypervisor indexed by their names
+
+        We are not using lookupByName(), because it prints ugly messages to
+        the console.  Instead all domains are listed once and reused, until
+        they are changed by us or by others according to the libvirt events.
+        """
+        conn = self.conn()
+        with self._domains_lock:
+            if self._domains_conn is not conn:
+                self._domains = None
+                self._domains_generation += 1
+                self._domains_conn = conn
+                try:
+                    register_domain_events(self.fqdn, self._domain_event)
+                except libvirtError as error:
+                    log.debug(
+                        'Cannot register for domain events on "{}": {}'
+                        .format(self.fqdn, error)
+                    )
+            domains = self._domains
+            generation = self._domains_generation
+        if domains is not None:
+            return domains
+
+        # The domains are listed without holding the lock.  The listing
+        # is only kept, if the index hasn't been dropped in the meantime.
+        domains = {d.name(): d for d in conn.listAllDomains()}
+        with self._domains_lock:
+            if self._domains_generation == generation:
+                self._domains = domains
+        return domains
+
+    def _domain_event(self, conn, domain, event, detail, opaque):
+        """Drop the cached information changed by a lifecycle event"""
+        self._stats = None
+        if event in (VIR_DOMAIN_EVENT_DEFINED, VIR_DOMAIN_EVENT_UNDEFINED):
+            self.invalidate_domains()
+
+    def invalidate_domains(self):
+        """Drop the index of the domains after defining or undefining"""
+        with self._domains_lock:
+            self._domains = None
+            self._domains_generation += 1
+
     def _get_domain(self, vm):
         domain = self._find_domain(vm)
         if not domain:
@@ -480,11 +613,15 @@ class Hypervisor(Host):
         else:
             target_hypervisor.create_vm_storage(vm, domain.name(), tx)
             migrate_live(self, target_hypervisor, vm, self._get_domain(vm))
+            self.invalidate_stats()
+            self.invalidate_domains()
+            target_hypervisor.invalidate_stats()
+            target_hypervisor.invalidate_domains()
 
     def total_vm_memory(self):
         """Get amount of memory in MiB available to hypervisor"""
         # Start with what OS sees as total memory (not installed memory)
-        total_mib = self.conn().getMemoryStats(-1)['total'] / 1024
+        total_mib = self.facts.mem_total_kib / 1024
         # Always keep some extra memory free for Hypervisor
         total_mib -= HOST_RESERVED_MEMORY
         return total_mib
@@ -496,15 +633,35 @@ class Hypervisor(Host):
         # Calculate memory used by other VMs.
         # We can not trust conn().getFreeMemory(), sum up memory used by
         # each VM instead
-        used_kib = 0
-        for dom_id in self.conn().listDomainsID():
-            dom = self.conn().lookupByID(dom_id)
-            used_kib += dom.info()[2]
+        used_kib = self.get_stats().used_memory_kib()
         free_mib = total_mib - used_kib / 1024
         return free_mib
 
+    def get_stats(self):
+        """Get the statistics of the domains on the hypervisor
+
+        They are collected on first use and reused for the next checks.
+        """
+        if self._stats is None:
+            self._stats = HypervisorStats(self.conn())
+        return self._stats
+
+    def get_domain_stats(self, domain):
+        """Get the statistics of the domain from the ones of all domains
+
+        They are collected again, if the domain is not in them.
+        """
+        if domain.name() not in self.get_stats():
+            self.invalidate_stats()
+        return self.get_stats()[domain.name()]
+
+    def invalidate_stats(self):
+        """Drop the statistics of the domains after changing them"""
+        self._stats = None
+
     def _vm_set_num_cpu(self, vm, num_cpu):
         set_vcpus(self, vm, self._get_domain(vm), num_cpu)
+        self.invalidate_stats()
 
     def _vm_set_disk_size_gib(self, vm, disk_size_gib):
         # TODO: Use libvirt
@@ -519,6 +676,7 @@ class Hypervisor(Host):
 
     def start_vm(self, vm):
         log.info('Starting "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
+        self.invalidate_stats()
         if self._get_domain(vm).create() != 0:
             raise HypervisorError('"{0}" failed to start'.format(vm.fqdn))
 
@@ -539,11 +697,13 @@ class Hypervisor(Host):
 
     def stop_vm(self, vm):
         log.info('Shutting down "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
+        self.invalidate_stats()
         if self._get_domain(vm).shutdown() != 0:
             raise HypervisorError('Unable to stop "{}".'.format(vm.fqdn))
 
     def stop_vm_force(self, vm):
         log.info('Force-stopping "{}" on "{}"...'.format(vm.fqdn, self.fqdn))
+        self.invalidate_stats()
         if self._get_domain(vm).destroy() != 0:
             raise HypervisorError(
                 'Unable to force-stop "{}".'.format(vm.fqdn)
@@ -556,6 +716,8 @@ class Hypervisor(Host):
             )
         log.info('Undefining "{}" on "{}"'.format(vm.fqdn, self.fqdn))
         domain = self._get_domain(vm)
+        self.invalidate_stats()
+        self.invalidate_domains()
         if domain.undefine() != 0:
             raise HypervisorError('Unable to undefine "{}".'.format(vm.fqdn))
         if not keep_storage:
@@ -565,26 +727,29 @@ class Hypervisor(Host):
         domain = self._get_domain(vm)
         self.delete_vm(vm, keep_storage=True)
         if domain.name() != vm.fqdn:
-            with self.fabric_settings():
-                self.lvrename(self.vm_disk_path(domain.name()), vm.fqdn)
+            self.lvrename(self.vm_disk_path(domain.name()), vm.fqdn)
         self.define_vm(vm)
 
     def rename_vm(self, vm, new_fqdn):
         domain = self._get_domain(vm)
         self.delete_vm(vm, keep_storage=True)
-        with self.fabric_settings():
-            self.lvrename(self.vm_disk_path(domain.name()), new_fqdn)
+        self.lvrename(self.vm_disk_path(domain.name()), new_fqdn)
         vm.fqdn = new_fqdn
         self.define_vm(vm)
 
     def _vm_sync_from_hypervisor(self, vm, result):
-        vm_info = self._get_domain(vm).info()
-
-        mem = int(vm_info[2] / 1024)
+        domain = self._get_domain(vm)
+        stats = self.get_domain_stats(domain)
+        memory_kib, num_cpu = stats.memory_kib, stats.num_cpu
+        if not memory_kib or not num_cpu:
+            # The stopped domains don't report their current values.
+            vm_info = domain.info()
+            memory_kib, num_cpu = vm_info[2], vm_info[3]
+
+        mem = int(memory_kib / 1024)
         if mem > 0:
             result['memory'] = mem
 
-        num_cpu = vm_info[3]
         if num_cpu > 0:
             result['num_cpu'] = num_cpu
 
@@ -593,68 +758,139 @@ class Hypervisor(Host):
         props = DomainProperties.from_running(self, vm, self._get_domain(vm))
         return props.info()
 
+    def _get_lvm(self, refresh=False, current=False):
+        """Return the inventory of the logical volumes
+
+        The volumes and the free space are listed by a single command on
+        first use, or when the inventory is stale or a refresh is requested.
+        Otherwise the inventory kept up-to-date with our changes is
+        returned.  The decisions on the space ask for the current
+        inventory.  For them, the volumes are listed again, if the metadata
+        sequence number of the volume group has changed since, unless no
+        decision has used the inventory since it was listed.
+        """
+        if (
+            current and
+            self._lvm_used and
+            self._lvm is not None and
+            not self._lvm.stale and (
+                # The sequence number is unknown after our changes.
+                self._lvm.vg_seqno is None or
+                self._lvm.vg_seqno != self._get_vg_seqno()
+            )
+        ):
+            refresh = True
+        if self._lvm is None or self._lvm.stale or refresh:
+            facts = HypervisorFacts.parse(self.run(LVM_COMMAND, silent=True))
+            self._lvm = LVMInventory(facts.lvm_output, VG_NAME)
+            self._lvm_used = False
+
+            # The facts are not valid anymore, if the hypervisor has been
+            # rebooted.
+            self._boot_id = facts.boot_id
+            if self._facts and self._facts.boot_id != facts.boot_id:
+                log.info(
+                    'Hypervisor "{}" has been rebooted, gathering its facts '
+                    'again.'.format(self.fqdn)
+                )
+                self._facts = None
+        if current:
+            self._lvm_used = True
+        return self._lvm
+
+    def _get_vg_seqno(self):
+        """Return the metadata sequence number of the volume group"""
+        return int(self.run(get_seqno_command(VG_NAME), silent=True).strip())
+
+    @contextmanager
+    def _changing_lvm(self):
+        """Yield the inventory to update for a change of the volumes
+
+        Our changes are applied to the inventory in place.  It is
+        dropped, if the change fails, because we cannot know what has
+        changed.  It is marked as stale by the update, if it doesn't know
+        the changed volume.
+        """
+        try:
+            yield self._lvm
+        except BaseException:
+            self._lvm = None
+            raise
+
+    def _run_lvm(self, command, op, **args):
+        """Run the LVM command or the operation of the agent"""
+        agent = self.agent
+        if agent is None:
+            self.run(command)
+        else:
+            log.info('[{}] agent {}: {}'.format(self.fqdn, op, args))
+            agent.call(op, **args)
+
     def get_logical_volumes(self):
-        lvolumes = []
-        lvs = self.run(
-            'lvs --noheadings -o name,vg_name,lv_size --unit b --nosuffix'
-            ' 2>/dev/null',
-            silent=True
-        )
-        for lv_line in lvs.splitlines():
-            lv_name, vg_name, lv_size = lv_line.split()
-            lvolumes.append({
-                'path': '/dev/{}/{}'.format(vg_name, lv_name),
-                'name': lv_name,
-                'vg_name': vg_name,
-                'size_MiB': math.ceil(float(lv_size) / 1024 ** 2),
-            })
-        return lvolumes
+        return list(self._get_lvm().volumes.values())
 
     def lvremove(self, lv):
-        self.run('lvremove -f {0}'.format(lv))
+        with self._changing_lvm() as lvm:
+            self._run_lvm('lvremove -f {0}'.format(lv), 'lvremove', path=lv)
+            if lvm:
+                lvm.remove(lv)
 
     def lvresize(self, volume, size_gib):
         """Extend the volume, return the new size"""
 
-        self.run('lvresize {0} -L {1}g'.format(volume, size_gib))
+        with self._changing_lvm() as lvm:
+            self._run_lvm(
+                'lvresize {0} -L {1}g'.format(volume, size_gib),
+                'lvresize',
+                path=volume,
+                size_gib=size_gib,
+            )
+            if lvm:
+                lvm.resize(volume, size_gib)
 
     def lvrename(self, volume, newname):
-        self.run('lvrename {0} {1}'.format(volume, newname))
+        with self._changing_lvm() as lvm:
+            self._run_lvm(
+                'lvrename {0} {1}'.format(volume, newname),
+                'lvrename',
+                path=volume,
+                new_name=newname,
+            )
+            if lvm:
+                lvm.rename(volume, newname)
 
     def get_free_disk_size_gib(self, safe=True):
         """Return free disk space as float in GiB"""
-        vgs_line = self.run(
-            'vgs --noheadings -o vg_name,vg_free --unit b --nosuffix {0}'
-            ' 2>/dev/null'
-            .format(VG_NAME),
-            silent=True,
-        )
-        vg_name, vg_size_gib = vgs_line.split()
         # Floor instead of ceil because we check free instead of used space
-        vg_size_gib = math.floor(float(vg_size_gib) / 1024 ** 3)
+        vg_size_gib = math.floor(
+            self._get_lvm(current=True).vg_free / 1024 ** 3
+        )
         if safe is True:
             vg_size_gib -= RESERVED_DISK
-        assert vg_name == VG_NAME
         return vg_size_gib
 
     def create_storage(self, name, disk_size_gib):
-        self.run('lvcreate -y -L {}g -n {} {}'.format(
-            disk_size_gib,
-            name,
-            VG_NAME,
-        ))
+        with self._changing_lvm() as lvm:
+            self._run_lvm(
+                'lvcreate -y -L {}g -n {} {}'.format(
+                    disk_size_gib,
+                    name,
+                    VG_NAME,
+                ),
+                'lvcreate',
+                vg_name=VG_NAME,
+                name=name,
+                size_gib=disk_size_gib,
+            )
+            if lvm:
+                lvm.add(name, disk_size_gib)
 
     def mount_temp(self, device, suffix=''):
-        mount_dir = self.run('mktemp -d --suffix {}'.format(suffix))
-        self.run('mount {0} {1}'.format(device, mount_dir))
-        return mount_dir
-
-    def umount_temp(self, device_or_path):
-        self.run('umount {0}'.format(device_or_path))
-
-    def remove_temp(self, mount_path):
-
-        self.run('rmdir {0}'.format(mount_path))
+        batch = self.batch()
+        batch.add('mount_dir=$(mktemp -d --suffix {})'.format(suffix))
+        batch.add('mount {0} "$mount_dir"'.format(device))
+        batch.add('echo "$mount_dir"')
+        return batch.run()[-1]
 
     def format_storage(self, device):
         self.run('mkfs.xfs -f {}'.format(device))
@@ -0,0 +1,157 @@
+"""igvm - Hypervisor Aggregates
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import numpy
+
+# The attributes of the VMs summed up for every hypervisor
+AGGREGATED_ATTRIBUTES = ('disk_size_gib', 'memory', 'num_cpu')
+
+
+class HypervisorAggregates(object):
+    """Index of the resources allocated to the VMs on the hypervisors
+
+    The index is built from the hypervisor objects returned by a Query
+    in a single pass over their VMs.  The hypervisors keep their order
+    in the Query result as the rows of the index, so the columns can be
+    used together with other arrays in the same order.
+
+    The anti-affinity index for the given attribute lists is built
+    in the same pass.  The attributes of the hypervisors are converted to
+    columns on first use.
+    """
+    def __init__(self, hypervisor_objs, anti_affinity_attributes=(),
+                 attributes=AGGREGATED_ATTRIBUTES):
+        self.hypervisor_objs = []
+        self.hostnames = []
+        self.rows = {}
+        self.anti_affinity = AntiAffinityIndex(anti_affinity_attributes)
+        sums = {a: [] for a in attributes}
+        vm_counts = []
+
+        for row, hypervisor_obj in enumerate(hypervisor_objs):
+            self.hypervisor_objs.append(hypervisor_obj)
+            self.hostnames.append(hypervisor_obj['hostname'])
+            self.rows[hypervisor_obj['hostname']] = row
+
+            row_sums = dict.fromkeys(attributes, 0)
+            vm_count = 0
+            for vm_obj in hypervisor_obj['vms']:
+                for attribute in attributes:
+                    row_sums[attribute] += vm_obj[attribute]
+                vm_count += 1
+                self.anti_affinity.add_vm(row, vm_obj)
+
+            for attribute in attributes:
+                sums[attribute].append(row_sums[attribute])
+            vm_counts.append(vm_count)
+
+        self.sums = {a: numpy.array(s, dtype=float) for a, s in sums.items()}
+        self.vm_counts = numpy.array(vm_counts, dtype=int)
+        self._attributes = {}
+
+    def __len__(self):
+        return len(self.hostnames)
+
+    def __contains__(self, hostname):
+        return hostname in self.rows
+
+    def add_vm(self, hostname, vm_obj):
+        """Account a VM placed on the hypervisor"""
+        row = self.rows[hostname]
+        for attribute, sums in self.sums.items():
+            sums[row] += vm_obj[attribute]
+        self.vm_counts[row] += 1
+        self.anti_affinity.add_vm(row, vm_obj)
+
+    def remove_vm(self, hostname, vm_obj):
+        """Stop accounting a VM moved away from the hypervisor"""
+        row = self.rows[hostname]
+        for attribute, sums in self.sums.items():
+            sums[row] -= vm_obj[attribute]
+        self.vm_counts[row] -= 1
+        self.anti_affinity.remove_vm(row, vm_obj)
+
+    def hypervisor_attribute(self, attribute):
+        """Return an attribute of the hypervisors as a float column
+
+        Missing values are represented as NaN.
+        """
+        if attribute not in self._attributes:
+            self._attributes[attribute] = numpy.array([
+                numpy.nan if o[attribute] is None else o[attribute]
+                for o in self.hypervisor_objs
+            ], dtype=float)
+
+        return self._attributes[attribute].copy()
+
+    def vms_sum(self, attribute, hostname=None):
+        """Return the sums of an attribute of the VMs
+
+        The sums of all hypervisors are returned as a column, unless
+        a hostname is given.
+        """
+        if hostname is not None:
+            return self.sums[attribute][self.rows[hostname]]
+        return self.sums[attribute].copy()
+
+    def vm_count(self, hostname=None):
+        """Return the number of the VMs on the hypervisors"""
+        if hostname is not None:
+            return self.vm_counts[self.rows[hostname]]
+        return self.vm_counts.copy()
+
+
+class AntiAffinityIndex(object):
+    """Index of the hypervisors by the attribute values of their VMs
+
+    For every list of attributes the index maps the values of the VMs to
+    the hypervisor rows and the hostnames of the VMs on them, so checking
+    a hypervisor for other VMs with the same values is a lookup.
+    """
+    def __init__(self, attribute_lists):
+        self._index = {tuple(a): {} for a in attribute_lists}
+
+    def __contains__(self, attributes):
+        return tuple(attributes) in self._index
+
+    def add_vm(self, row, vm_obj):
+        for attributes, index in self._index.items():
+            key = _get_key(vm_obj, attributes)
+            index.setdefault(key, {}).setdefault(row, set()).add(
+                vm_obj['hostname']
+            )
+
+    def remove_vm(self, row, vm_obj):
+        for attributes, index in self._index.items():
+            key = _get_key(vm_obj, attributes)
+            hostnames = index[key][row]
+            hostnames.remove(vm_obj['hostname'])
+            if not hostnames:
+                del index[key][row]
+
+    def other_vms(self, attributes, vm_obj, length):
+        """Return a column marking the hypervisors with other VMs with
+        the same values"""
+        column = numpy.zeros(length, dtype=bool)
+        for row, hostnames in self._get_rows(attributes, vm_obj).items():
+            column[row] = any(h != vm_obj['hostname'] for h in hostnames)
+        return column
+
+    def _get_rows(self, attributes, vm_obj):
+        attributes = tuple(attributes)
+        if attributes not in self._index:
+            raise KeyError(
+                'Attributes {!r} are not indexed for anti-affinity'
+                .format(list(attributes))
+            )
+        return self._index[attributes].get(_get_key(vm_obj, attributes), {})
+
+
+def _get_key(obj, attributes):
+    """Return the values of the attributes in a hashable form"""
+    return tuple(
+        frozenset(v) if isinstance(v, (set, frozenset, list)) else v
+        for v in (obj[a] for a in attributes)
+    )
@@ -0,0 +1,188 @@
+"""igvm - Hypervisor Facts
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from os import makedirs
+from os.path import dirname, isdir
+
+from igvm.lvm import get_inventory_command
+from igvm.settings import FACTS_CACHE_PATH, FACTS_CACHE_TTL, VG_NAME
+
+log = logging.getLogger(__name__)
+
+# The line separating the facts from the LVM inventory
+SEPARATOR = '--- lvm ---'
+
+BOOT_ID_COMMAND = 'echo boot_id $(cat /proc/sys/kernel/random/boot_id)'
+
+# Every fact is printed on its own line prefixed by its name.  The NUMA
+# nodes are listed in the same order as the glob.
+FACTS_COMMAND = '; '.join([
+    'echo num_cpus $(grep -c vendor_id /proc/cpuinfo)',
+    'for f in /sys/devices/system/node/node*/cpulist;'
+    ' do echo numa_cpulist $(cat $f); done',
+    "echo mem_total_kib $(awk '/^MemTotal:/ {print $2}' /proc/meminfo)",
+    BOOT_ID_COMMAND,
+    'virsh -c qemu:///system version 2>/dev/null | sed -n'
+    " -e 's/^Using library: libvirt /libvirt_version /p'"
+    " -e 's/^Running hypervisor: QEMU /qemu_version /p'",
+    'echo ' + SEPARATOR,
+    get_inventory_command(VG_NAME),
+])
+
+# The LVM inventory changes all the time, so it is listed again on every
+# run together with the boot ID to validate the cached facts.
+LVM_COMMAND = '; '.join([
+    BOOT_ID_COMMAND,
+    'echo ' + SEPARATOR,
+    get_inventory_command(VG_NAME),
+])
+
+# The facts not changing until the hypervisor is rebooted
+STATIC_FACTS = (
+    'num_cpus',
+    'numa_cpulists',
+    'mem_total_kib',
+    'boot_id',
+    'libvirt_version',
+    'qemu_version',
+)
+
+
+class HypervisorFacts(object):
+    """Facts about a hypervisor gathered by a single remote command
+
+    The versions are None, if they couldn't be determined.  The hosts
+    without NUMA nodes are considered to have a single one with all of
+    the CPUs.  The output of the LVM inventory command is kept to build
+    the inventory from it.  It is None for the facts read from the cache.
+    """
+    def __init__(self, num_cpus=None, numa_cpulists=[], mem_total_kib=None,
+                 boot_id=None, libvirt_version=None, qemu_version=None,
+                 lvm_output=None):
+        self.num_cpus = num_cpus
+        self.numa_cpulists = _get_numa_cpulists(numa_cpulists, num_cpus)
+        self.mem_total_kib = mem_total_kib
+        self.boot_id = boot_id
+        self.libvirt_version = libvirt_version and tuple(libvirt_version)
+        self.qemu_version = qemu_version and tuple(qemu_version)
+        self.lvm_output = lvm_output
+
+    @classmethod
+    def gather(cls, host):
+        return cls.parse(host.run(FACTS_COMMAND, silent=True))
+
+    @classmethod
+    def parse(cls, output):
+        """Parse the output of the facts or the LVM command"""
+        facts, lvm_output = output.split(SEPARATOR, 1)
+
+        self = cls(lvm_output=lvm_output)
+        for line in facts.splitlines():
+            if not line.strip():
+                continue
+            name, value = (line.strip().split(None, 1) + [''])[:2]
+            if name == 'num_cpus':
+                self.num_cpus = int(value)
+            elif name == 'numa_cpulist':
+                self.numa_cpulists.append(value)
+            elif name == 'mem_total_kib':
+                self.mem_total_kib = int(value)
+            elif name == 'boot_id':
+                self.boot_id = value
+            elif name == 'libvirt_version':
+                self.libvirt_version = _parse_version(value)
+            elif name == 'qemu_version':
+                self.qemu_version = _parse_version(value)
+        self.numa_cpulists = _get_numa_cpulists(
+            self.numa_cpulists, self.num_cpus
+        )
+        return self
+
+
+class FactsCache(object):
+    """Cache of the static facts of the hypervisors on the local disk
+
+    The facts are shared by the igvm processes running on the same host.
+    They are kept by the FQDN of the hypervisor together with its boot ID
+    for the given number of seconds.  The callers must compare the boot
+    ID to the current one to not use the facts from before a reboot.
+    The cache is skipped, if the file cannot be used.
+    """
+    def __init__(self, path=FACTS_CACHE_PATH, ttl=FACTS_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def get(self, fqdn):
+        """Return the cached facts of the hypervisor or None"""
+        row = self._execute(
+            'SELECT facts FROM hypervisor_facts '
+            'WHERE fqdn = ? AND gathered > ?',
+            (fqdn, time.time() - self.ttl),
+        )
+        if not row:
+            return None
+        return HypervisorFacts(**json.loads(row[0]))
+
+    def put(self, fqdn, facts):
+        # The facts from the previous boot are replaced.
+        self._execute(
+            'INSERT OR REPLACE INTO hypervisor_facts VALUES (?, ?, ?, ?)',
+            (fqdn, facts.boot_id, time.time(), json.dumps({
+                k: getattr(facts, k) for k in STATIC_FACTS
+            })),
+        )
+
+    def _execute(self, query, params):
+        if not self.ttl:
+            return None
+        try:
+            if not isdir(dirname(self.path)):
+                makedirs(dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=5)
+            try:
+                with conn:
+                    conn.execute(
+                        'CREATE TABLE IF NOT EXISTS hypervisor_facts ('
+                        'fqdn TEXT PRIMARY KEY, boot_id TEXT, gathered REAL, '
+                        'facts TEXT)'
+                    )
+                    return conn.execute(query, params).fetchone()
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error) as error:
+            log.debug(
+                'Cannot use facts cache "{}": {}'.format(self.path, error)
+            )
+            return None
+
+
+def _get_numa_cpulists(numa_cpulists, num_cpus):
+    """Return the cpulists of the NUMA nodes or the one of all CPUs"""
+    if not numa_cpulists and num_cpus:
+        return ['0-{}'.format(num_cpus - 1)]
+    return list(numa_cpulists)
+
+
+def _parse_version(value):
+    """Parse the leading major.minor.release from a version string"""
+    if not value:
+        return None
+    numbers = []
+    for part in value.split()[0].split('.')[:3]:
+        digits = ''
+        for char in part:
+            if not char.isdigit():
+                break
+            digits += char
+        if not digits:
+            break
+        numbers.append(int(digits))
+    if not numbers:
+        return None
+    return tuple(numbers + [0] * (3 - len(numbers)))
@@ -1,10 +1,14 @@
 """igvm - Hypervisor Preferences
 
 This module contains preferences to select hypervisors.  Preferences
-return a value of any comparable datatype.  Only the return values of
-the same preference is compared with each other.  Smaller values mark
-hypervisors as more preferred.  Keep in mind that for booleans false
-is less than true.
+are evaluated for all candidate hypervisors at once.  They return a NumPy
+array of comparable values with one value for every hypervisor of
+the ranking.  Only the return values of the same preference is compared
+with each other.  Smaller values mark hypervisors as more preferred.  Keep
+in mind that for booleans false is less than true.
+
+Every preference lists the attributes of the hypervisors and the attributes
+of the VMs on them it needs, so only those are queried from Serveradmin.
 
 Copyright (c) 2018, InnoGames GmbH
 """
@@ -13,12 +17,16 @@ Copyright (c) 2018, InnoGames GmbH
 # they would as well just be a function, but we keep them all as classes
 # to have a consistent style.
 
+import numpy
+
 
 class InsufficientResource(object):
     """Check a resource of hypervisor would be sufficient"""
     def __init__(self, attribute, reserved=0):
         self.attribute = attribute
         self.reserved = reserved
+        self.hypervisor_attributes = [attribute]
+        self.vm_attributes = [attribute]
 
     def __repr__(self):
         args = repr(self.attribute)
@@ -27,9 +35,9 @@ class InsufficientResource(object):
 
         return '{}({})'.format(type(self).__name__, args)
 
-    def __call__(self, vm, hv):
-        total_size = hv.dataset_obj[self.attribute]
-        vms_size = sum(v[self.attribute] for v in hv.dataset_obj['vms'])
+    def __call__(self, vm, ranking):
+        total_size = ranking.hypervisor_attribute(self.attribute)
+        vms_size = ranking.vms_sum(self.attribute)
         remaining_size = total_size - vms_size - self.reserved
 
         return remaining_size < vm.dataset_obj[self.attribute]
@@ -41,6 +49,8 @@ class OtherVMs(object):
         assert values is None or len(attributes) == len(values)
         self.attributes = attributes
         self.values = values
+        self.hypervisor_attributes = []
+        self.vm_attributes = attributes
 
     def __repr__(self):
         args = ''
@@ -51,37 +61,34 @@ class OtherVMs(object):
 
         return '{}({})'.format(type(self).__name__, args)
 
-    def __call__(self, vm, hv):
-        result = 0
-        for other_vm in hv.dataset_obj['vms']:
-            if other_vm['hostname'] == vm.dataset_obj['hostname']:
-                continue
-            if self.values and not all(
-                vm.dataset_obj[a] == v
-                for a, v in zip(self.attributes, self.values)
-            ):
-                continue
-            if all(
-                other_vm[a] == vm.dataset_obj[a]
-                for a in self.attributes
-            ):
-                result = 1
-
-        return result
+    def __call__(self, vm, ranking):
+        if self.values and not all(
+            vm.dataset_obj[a] == v
+            for a, v in zip(self.attributes, self.values)
+        ):
+            return numpy.zeros(len(ranking), dtype=int)
+
+        return ranking.other_vms(self.attributes).astype(int)
 
 
 class HypervisorAttributeValue(object):
     """Return inverse of an attribute value of the hypervisor"""
     def __init__(self, attribute):
         self.attribute = attribute
+        self.hypervisor_attributes = [attribute]
+        self.vm_attributes = []
 
     def __repr__(self):
         args = repr(self.attribute)
 
         return '{}({})'.format(type(self).__name__, args)
 
-    def __call__(self, vm, hv):
-        return hv.dataset_obj[self.attribute]
+    def __call__(self, vm, ranking):
+        values = ranking.hypervisor_attribute(self.attribute)
+
+        # Missing values used to be None which is less than any number.
+        values[numpy.isnan(values)] = -numpy.inf
+        return values
 
 
 class HypervisorAttributeValueLimit(object):
@@ -89,50 +96,101 @@ class HypervisorAttributeValueLimit(object):
     def __init__(self, attribute, limit):
         self.attribute = attribute
         self.limit = limit
+        self.hypervisor_attributes = [attribute]
+        self.vm_attributes = []
 
     def __repr__(self):
         args = repr(self.attribute) + ', ' + repr(self.limit)
 
         return '{}({})'.format(type(self).__name__, args)
 
-    def __call__(self, vm, hv):
-        return hv.dataset_obj[self.attribute] > self.limit
+    def __call__(self, vm, ranking):
+        return ranking.hypervisor_attribute(self.attribute) > self.limit
 
 
 class OverAllocation(object):
     """Check for an attribute being over allocated than the current one"""
     def __init__(self, attribute):
         self.attribute = attribute
+        self.hypervisor_attributes = [attribute]
+        self.vm_attributes = [attribute]
 
     def __repr__(self):
         args = repr(self.attribute)
 
         return '{}({})'.format(type(self).__name__, args)
 
-    def __call__(self, vm, hv):
+    def __call__(self, vm, ranking):
         # New VM has no xen_host attribute yet.
         if not vm.hypervisor:
-            return False
+            return numpy.zeros(len(ranking), dtype=bool)
 
-        cur_hv_cpus = sum(
-            v[self.attribute] for v in vm.hypervisor.dataset_obj['vms']
-        )
+        cur_hv_cpus = ranking.source_vms_sum(self.attribute)
         cur_hv_rl_cpus = vm.hypervisor.dataset_obj[self.attribute]
         cur_ovr_allc = float(cur_hv_cpus) / float(cur_hv_rl_cpus)
 
-        tgt_hv_cpus = vm.dataset_obj[self.attribute] + sum(
-            v[self.attribute] for v in hv.dataset_obj['vms']
+        tgt_hv_cpus = (
+            vm.dataset_obj[self.attribute] + ranking.vms_sum(self.attribute)
         )
-        tgt_hv_rl_cpus = hv.dataset_obj[self.attribute]
-        tgt_ovr_allc = float(tgt_hv_cpus) / float(tgt_hv_rl_cpus)
+        tgt_hv_rl_cpus = ranking.hypervisor_attribute(self.attribute)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            tgt_ovr_allc = tgt_hv_cpus / tgt_hv_rl_cpus
 
         return tgt_ovr_allc > cur_ovr_allc
 
 
 class HashDifference(object):
     """Return some arbitrary number to have stable ordering"""
+    def __init__(self):
+        self.hypervisor_attributes = []
+        self.vm_attributes = []
+
     def __repr__(self):
         return '{}()'.format(type(self).__name__)
 
-    def __call__(self, vm, hv):
-        return hash(hv.fqdn) - hash(vm.fqdn)
+    def __call__(self, vm, ranking):
+        # Subtracting the hash of the VM would not change the ordering.
+        return numpy.array(
+            [hash(hv.fqdn) for hv in ranking.hypervisors], dtype=numpy.int64
+        )
+
+
+def get_anti_affinity_attributes(preferences):
+    """Return the attribute lists needed to index for the preferences
+
+    OtherVMs() without attributes is answered by the VM counts.
+    """
+    return [
+        p.attributes for p in preferences
+        if isinstance(p, OtherVMs) and p.attributes
+    ]
+
+
+def get_required_preferences(preferences):
+    """Return the leading preferences until the over-allocation
+
+    The best hypervisors by them are likely to be the best ones by all
+    preferences.  All preferences are returned, if there is no
+    over-allocation.
+    """
+    for index, preference in enumerate(preferences):
+        if isinstance(preference, OverAllocation):
+            return preferences[:index + 1]
+    return list(preferences)
+
+
+def get_disqualifying_preferences(preferences):
+    """Return the leading preferences disqualifying hypervisors
+
+    The hypervisors true for any of them are ranked after all others.
+    They only need the attributes of the hypervisors and the sums of
+    their VMs.
+    """
+    disqualifying = []
+    for preference in preferences:
+        if not isinstance(preference, (
+            InsufficientResource, HypervisorAttributeValueLimit
+        )):
+            break
+        disqualifying.append(preference)
+    return disqualifying
@@ -3,55 +3,198 @@
 Copyright (c) 2018, InnoGames GmbH
 """
 
-from igvm.settings import HYPERVISOR_PREFERENCES
+import numpy
+
+from igvm.host import get_fqdn
+from igvm.hypervisor_aggregates import (
+    AGGREGATED_ATTRIBUTES,
+    HypervisorAggregates,
+)
+from igvm.hypervisor_preferences import (
+    get_anti_affinity_attributes,
+    get_disqualifying_preferences,
+)
+from igvm.settings import HYPERVISOR_ATTRIBUTES, HYPERVISOR_PREFERENCES
+
+
+def get_query_attributes(preferences=HYPERVISOR_PREFERENCES,
+                         hypervisor_attributes=(), vm_attributes=()):
+    """Return the attributes to query the hypervisors for ranking
+
+    Only the attributes needed by the preferences and the aggregates are
+    included for the VMs on the hypervisors.  The callers can request
+    more attributes.
+    """
+    hypervisor_attributes = set(HYPERVISOR_ATTRIBUTES).union(
+        hypervisor_attributes
+    )
+    vm_attributes = set(AGGREGATED_ATTRIBUTES).union(vm_attributes)
+    vm_attributes.add('hostname')
+    for preference in preferences:
+        hypervisor_attributes.update(preference.hypervisor_attributes)
+        vm_attributes.update(preference.vm_attributes)
+
+    return sorted(hypervisor_attributes) + [{'vms': sorted(vm_attributes)}]
 
 
 class HypervisorRanking(object):
-    """Encapsulate hypervisors for lazy comparison of their rankings"""
-    def __init__(self, vm, hypervisor):
+    """Rank the hypervisors for a VM by evaluating the preferences column-wise
+
+    Every preference is evaluated only once for all of the hypervisors.
+    The resulting columns are sorted lexicographically in a single pass,
+    so the first preference is the most important one, and the next ones
+    are only deciding between the hypervisors with the same values.
+
+    The aggregates must be built from the same hypervisors in the same
+    order.  They are built here, if not given.  The ranking can be limited
+    to the given rows of the aggregates with the hypervisors in the same
+    order.  If the hypervisors are not given, lightweight candidates are
+    ranked instead.
+    """
+    def __init__(self, vm, hypervisors=None, aggregates=None,
+                 preferences=HYPERVISOR_PREFERENCES, rows=None):
         self.vm = vm
-        self.hypervisor = hypervisor
-        self.ranks = []
-
-    # It is sufficient to define the __lt__() method only, because this class
-    # is only for sorting, and Python sort routines are guaranteed to use
-    # this method only.
-    def __lt__(self, other):
-        assert self.vm == other.vm
-
-        # Compare the current preferences
-        rank_len = min(len(self.ranks), len(other.ranks))
-        ranks = self.ranks[:rank_len]
-        other_ranks = other.ranks[:rank_len]
-        if ranks < other_ranks:
-            return True
-        if ranks > other_ranks:
-            return False
-
-        # Check new preferences
-        for index in range(rank_len, len(HYPERVISOR_PREFERENCES)):
-            rank = self.get_rank(index)
-            other_rank = other.get_rank(index)
-            if rank < other_rank:
-                return True
-            if rank > other_rank:
-                return False
-
-        raise Exception(
-            'Exact same preferences for hypervisor "{}" and "{}"'
-            .format(self.hypervisor, other.hypervisor)
-        )
-
-    def get_rank(self, index):
-        if len(self.ranks) == index:
-            preference = HYPERVISOR_PREFERENCES[index]
-            rank = preference(self.vm, self.hypervisor)
-            self.ranks.append(rank)
-        else:
-            rank = self.ranks[index]
-
-        return rank
-
-    def get_last_preference_index(self):
-        """Return the index of the last needed preference"""
-        return len(self.ranks) - 1
+        if hypervisors is not None:
+            hypervisors = list(hypervisors)
+        if aggregates is None:
+            aggregates = HypervisorAggregates(
+                (h.dataset_obj for h in hypervisors),
+                get_anti_affinity_attributes(preferences),
+            )
+        if rows is None:
+            rows = numpy.arange(len(aggregates))
+        assert hypervisors is None or len(rows) == len(hypervisors)
+        self.aggregates = aggregates
+        self.rows = numpy.asarray(rows, dtype=int)
+        self.preferences = preferences
+        self._hypervisors = hypervisors
+        self._source_aggregates = None
+        self._columns = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def hypervisors(self):
+        """Return the hypervisors in the order of the rows"""
+        if self._hypervisors is None:
+            self._hypervisors = [
+                HypervisorCandidate(self.aggregates, row) for row in self.rows
+            ]
+        return self._hypervisors
+
+    def __iter__(self):
+        """Iterate the hypervisors from the most preferred one
+
+        We yield the index of the last needed preference together with every
+        hypervisor to provide good logging.
+        """
+        if not len(self):
+            return
+
+        columns = self.get_columns()
+
+        # The last key is the primary one for lexsort().
+        order = numpy.lexsort(columns[::-1])
+
+        # Find the first preference deciding between the neighbours
+        decisive = numpy.full(len(order) - 1, len(columns) - 1)
+        undecided = numpy.ones(len(order) - 1, dtype=bool)
+        for index, column in enumerate(columns):
+            column = column[order]
+            differs = undecided & (column[:-1] != column[1:])
+            decisive[differs] = index
+            undecided &= ~differs
+
+        for position, row in enumerate(order):
+            index = 0
+            if position > 0:
+                index = max(index, decisive[position - 1])
+            if position < len(decisive):
+                index = max(index, decisive[position])
+
+            yield self.hypervisors[row], int(index)
+
+    def get_columns(self):
+        """Return the values of the preferences for all hypervisors"""
+        if self._columns is None:
+            self._columns = [
+                numpy.asarray(preference(self.vm, self))
+                for preference in self.preferences
+            ]
+        return self._columns
+
+    def hypervisor_attribute(self, attribute):
+        """Return an attribute of all hypervisors as a float column
+
+        Missing values are represented as NaN.
+        """
+        return self.aggregates.hypervisor_attribute(attribute)[self.rows]
+
+    def vms_sum(self, attribute):
+        """Return the sums of an attribute of the VMs on the hypervisors"""
+        return self.aggregates.vms_sum(attribute)[self.rows]
+
+    def source_vms_sum(self, attribute):
+        """Return the sum of an attribute of the VMs on the current
+        hypervisor of our VM"""
+        hostname = self.vm.hypervisor.dataset_obj['hostname']
+        if hostname in self.aggregates:
+            return self.aggregates.vms_sum(attribute, hostname)
+
+        # The current hypervisor is not necessarily one of the candidates.
+        if self._source_aggregates is None:
+            self._source_aggregates = HypervisorAggregates([{
+                'hostname': hostname,
+                'vms': self.vm.hypervisor.vms,
+            }])
+        return self._source_aggregates.vms_sum(attribute, hostname)
+
+    def other_vms(self, attributes):
+        """Return whether the hypervisors have other VMs with the same
+        attributes as our VM"""
+        if not attributes:
+            vm_counts = self.aggregates.vm_count()
+            xen_host = self.vm.dataset_obj['xen_host']
+            if xen_host in self.aggregates:
+                vm_counts[self.aggregates.rows[xen_host]] -= 1
+            return vm_counts[self.rows] > 0
+
+        return self.aggregates.anti_affinity.other_vms(
+            attributes, self.vm.dataset_obj, len(self.aggregates)
+        )[self.rows]
+
+
+class HypervisorCandidate(object):
+    """Compact record of a hypervisor in the aggregates for ranking
+
+    It provides what the preferences and the logging need from
+    the hypervisors.  The callers are responsible for constructing
+    the Hypervisor only for the candidates they are going to use.
+    """
+    __slots__ = ('row', 'dataset_obj', 'fqdn')
+
+    def __init__(self, aggregates, row):
+        self.row = row
+        self.dataset_obj = aggregates.hypervisor_objs[row]
+        self.fqdn = get_fqdn(self.dataset_obj['hostname'])
+
+    def __str__(self):
+        return self.fqdn
+
+
+def get_viable_rows(vm, aggregates, preferences=HYPERVISOR_PREFERENCES):
+    """Return whether the hypervisors are viable for the VM as a column
+
+    The hypervisors disqualified by the leading preferences are ranked
+    after all others, so the viable ones can be ranked separately without
+    changing their order.  The disqualifying preferences are evaluated
+    on the aggregates only.
+    """
+    ranking = HypervisorRanking(
+        vm, None, aggregates, get_disqualifying_preferences(preferences)
+    )
+    viable = numpy.ones(len(aggregates), dtype=bool)
+    for column in ranking.get_columns():
+        viable &= ~column
+    return viable
@@ -0,0 +1,54 @@
+"""igvm - Hypervisor Statistics
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+from collections import namedtuple
+
+from libvirt import (
+    VIR_DOMAIN_SHUTOFF,
+    VIR_DOMAIN_STATS_BALLOON,
+    VIR_DOMAIN_STATS_STATE,
+    VIR_DOMAIN_STATS_VCPU,
+)
+
+# Memory is in KiB as libvirt reports it.  The values the domain doesn't
+# report, like the stopped ones, are 0.
+DomainStats = namedtuple(
+    'DomainStats', ['state', 'memory_kib', 'num_cpu', 'max_cpus']
+)
+
+
+class HypervisorStats(object):
+    """Snapshot of the domains on a hypervisor
+
+    The statistics of all domains are collected by a single libvirt call
+    instead of looking up every domain separately.  The snapshot is not
+    updated, so it has to be collected again after changing the domains.
+    """
+    def __init__(self, conn):
+        self.domains = {}
+        for domain, stats in conn.getAllDomainStats(
+            VIR_DOMAIN_STATS_STATE |
+            VIR_DOMAIN_STATS_BALLOON |
+            VIR_DOMAIN_STATS_VCPU
+        ):
+            self.domains[domain.name()] = DomainStats(
+                stats['state.state'],
+                stats.get('balloon.current', 0),
+                stats.get('vcpu.current', 0),
+                stats.get('vcpu.maximum', 0),
+            )
+
+    def __contains__(self, name):
+        return name in self.domains
+
+    def __getitem__(self, name):
+        return self.domains[name]
+
+    def used_memory_kib(self):
+        """Return the memory used by the active domains in KiB"""
+        return sum(
+            s.memory_kib for s in self.domains.values()
+            if s.state != VIR_DOMAIN_SHUTOFF
+        )
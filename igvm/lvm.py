@@ -0,0 +1,117 @@
+"""igvm - LVM Inventory
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import math
+from collections import OrderedDict
+
+# The line separating the outputs of lvs and vgs
+SEPARATOR = '--- vgs ---'
+
+
+def get_inventory_command(vg_name):
+    """Return the shell command to list the volumes and the free space"""
+    return (
+        'lvs --noheadings -o name,vg_name,lv_size --unit b --nosuffix'
+        ' 2>/dev/null; '
+        'echo {}; '
+        'vgs --noheadings -o vg_name,vg_free,vg_seqno --unit b --nosuffix {}'
+        ' 2>/dev/null'
+        .format(SEPARATOR, vg_name)
+    )
+
+
+def get_seqno_command(vg_name):
+    """Return the shell command to print the metadata sequence number
+
+    It is increased on every change of the volume group.
+    """
+    return 'vgs --noheadings -o vg_seqno {}'.format(vg_name)
+
+
+class LVMInventory(object):
+    """Logical volumes and free space of the volume group of a hypervisor
+
+    The inventory is parsed from the output of the command above.  It is
+    indexed by the names and the paths of the volumes, and updated in
+    place for the changes made by us.  It is marked as stale, when it
+    doesn't know the changed volume, so it must have been changed by
+    others.  The metadata sequence number of the volume group is kept to
+    detect the changes by others.  It is unknown after our changes.
+    """
+    def __init__(self, output, vg_name):
+        self.vg_name = vg_name
+        self.volumes = OrderedDict()
+        self.stale = False
+        self._names = {}
+
+        lvs, vgs = output.split(SEPARATOR)
+        for lv_line in lvs.splitlines():
+            if not lv_line.strip():
+                continue
+            lv_name, lv_vg_name, lv_size = lv_line.split()
+            self._add(lv_name, lv_vg_name, float(lv_size))
+
+        vgs_name, vg_free, vg_seqno = vgs.split()
+        assert vgs_name == vg_name
+        self.vg_free = float(vg_free)
+        self.vg_seqno = int(vg_seqno)
+
+    def get(self, name):
+        """Return the volume with the name or None"""
+        return self._names.get(name)
+
+    def add(self, name, size_gib):
+        """Account a volume created in our volume group"""
+        self._add(name, self.vg_name, size_gib * 1024.0 ** 3)
+        self.vg_free -= size_gib * 1024.0 ** 3
+        self.vg_seqno = None
+
+    def remove(self, path):
+        self.vg_seqno = None
+        if path not in self.volumes:
+            self.stale = True
+            return
+        volume = self.volumes.pop(path)
+        self._index_names()
+        if volume['vg_name'] == self.vg_name:
+            self.vg_free += volume['size_MiB'] * 1024.0 ** 2
+
+    def resize(self, path, size_gib):
+        self.vg_seqno = None
+        if path not in self.volumes:
+            self.stale = True
+            return
+        volume = self.volumes[path]
+        new_size_mib = math.ceil(size_gib * 1024.0)
+        if volume['vg_name'] == self.vg_name:
+            self.vg_free -= (new_size_mib - volume['size_MiB']) * 1024.0 ** 2
+        volume['size_MiB'] = new_size_mib
+
+    def rename(self, path, new_name):
+        self.vg_seqno = None
+        if path not in self.volumes:
+            self.stale = True
+            return
+        volume = self.volumes.pop(path)
+        volume['name'] = new_name
+        volume['path'] = '/dev/{}/{}'.format(volume['vg_name'], new_name)
+        self.volumes[volume['path']] = volume
+        self._index_names()
+
+    def _add(self, lv_name, vg_name, size):
+        path = '/dev/{}/{}'.format(vg_name, lv_name)
+        self.volumes[path] = {
+            'path': path,
+            'name': lv_name,
+            'vg_name': vg_name,
+            'size_MiB': math.ceil(size / 1024 ** 2),
+        }
+        self._names.setdefault(lv_name, self.volumes[path])
+
+    def _index_names(self):
+        # The first volume with the name is found like listing them.
+        self._names = {}
+        for volume in self.volumes.values():
+            self._names.setdefault(volume['name'], volume)
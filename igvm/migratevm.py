@@ -6,7 +6,6 @@ Copyright (c) 2018, InnoGames GmbH
 import logging
 
 from igvm.exceptions import IGVMError, InconsistentAttributeError
-from igvm.host import with_fabric_settings
 from igvm.hypervisor import Hypervisor
 from igvm.utils.transaction import run_in_transaction
 from igvm.vm import VM
@@ -15,8 +14,7 @@ from igvm.settings import MIGRATE_COMMANDS
 log = logging.getLogger(__name__)
 
 
-@with_fabric_settings   # NOQA: C901
-@run_in_transaction
+@run_in_transaction   # NOQA: C901
 def migratevm(vm_hostname, hypervisor_hostname=None, newip=None,
               runpuppet=False, maintenance=False, offline=False, tx=None,
               ignore_reserved=False):
@@ -27,7 +25,7 @@ def migratevm(vm_hostname, hypervisor_hostname=None, newip=None,
 
     # If not specified automatically find a new better hypervisor
     if hypervisor_hostname:
-        hypervisor = Hypervisor(
+        hypervisor = Hypervisor.get_shared(
             hypervisor_hostname, ignore_reserved=ignore_reserved
         )
     else:
@@ -78,10 +76,10 @@ def migratevm(vm_hostname, hypervisor_hostname=None, newip=None,
     # setting new IP!)
     hypervisor.check_vm(vm)
 
-    # Commit previously changed IP address.
+    # Commit previously changed IP address.  It is committed right away
+    # like the maintenance state, and not rolled back.
     if newip:
-        # TODO: This commit is not rolled back.
-        vm.dataset_obj.commit()
+        vm.commit()
         tx.on_rollback('newip warning', log.info, '--newip is not rolled back')
 
     if maintenance or offline:
@@ -101,20 +99,22 @@ def migratevm(vm_hostname, hypervisor_hostname=None, newip=None,
     tx.on_rollback('reset hypervisor', _reset_hypervisor)
 
     if runpuppet:
+        # Puppet configures the VM by the attributes on Serveradmin.
+        tx.flush()
         hypervisor.mount_vm_storage(vm, tx)
         vm.run_puppet(clear_cert=False, tx=tx)
         hypervisor.umount_vm_storage(vm)
 
     if offline and was_running:
         vm.start(tx=tx)
-    vm.reset_state()
+    vm.reset_state(tx)
 
     # Update Serveradmin
     vm.dataset_obj['xen_host'] = hypervisor.dataset_obj['hostname']
-    vm.dataset_obj.commit()
+    vm.commit(tx)
 
     # If removing the existing VM fails we shouldn't risk undoing the newly
-    # migrated one.
+    # migrated one.  The staged changes are committed together here.
     tx.checkpoint()
 
     previous_hypervisor.delete_vm(vm)
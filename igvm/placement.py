@@ -0,0 +1,166 @@
+"""igvm - Batch Placement
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import logging
+from os import environ
+
+import numpy
+
+from adminapi.filters import Any
+
+from igvm.exceptions import HypervisorError
+from igvm.hypervisor import Hypervisor
+from igvm.hypervisor_aggregates import HypervisorAggregates
+from igvm.hypervisor_preferences import (
+    InsufficientResource,
+    get_anti_affinity_attributes,
+)
+from igvm.hypervisor_ranking import (
+    HypervisorCandidate,
+    HypervisorRanking,
+    get_query_attributes,
+)
+from igvm.query_cache import query
+from igvm.settings import HYPERVISOR_PREFERENCES
+from igvm.vm import VMError
+
+log = logging.getLogger(__name__)
+
+
+class BatchPlacement(object):
+    """Place multiple VMs on the hypervisors at once
+
+    The hypervisors are queried only once.  The VMs are placed one after
+    another on the best ranked hypervisor having sufficient resources.
+    Every placed VM is accounted in the aggregates, so the next VMs are
+    ranked considering the previous ones including their anti-affinity.
+    """
+    def __init__(self, hypervisor_objs, preferences=HYPERVISOR_PREFERENCES):
+        self.preferences = preferences
+        self.aggregates = HypervisorAggregates(
+            hypervisor_objs, get_anti_affinity_attributes(preferences)
+        )
+        self.candidates = [
+            HypervisorCandidate(self.aggregates, r)
+            for r in range(len(self.aggregates))
+        ]
+        # The hypervisors are only constructed when they are selected.
+        self._hypervisors = {}
+
+    @classmethod
+    def query(cls, route_networks, hv_states=['online'],
+              preferences=HYPERVISOR_PREFERENCES):
+        """Query the hypervisors for the given route networks"""
+        return cls(query({
+            'servertype': 'hypervisor',
+            'environment': environ.get('IGVM_MODE', 'production'),
+            'vlan_networks': Any(*route_networks),
+            'state': Any(*hv_states),
+        }, get_query_attributes(preferences)), preferences)
+
+    def place(self, vm, check=False):
+        """Select the hypervisor for a VM and account the VM on it"""
+        hypervisor, values = self.select(vm, check)
+        self.aggregates.add_vm(
+            hypervisor.dataset_obj['hostname'], vm.dataset_obj
+        )
+        return hypervisor
+
+    def select(self, vm, check=False):
+        """Select the hypervisor for a VM without accounting the VM
+
+        The selected hypervisor is validated for the VM, if check is set,
+        and the next ranked one is tried, if it doesn't pass, like
+        VM.get_best_hypervisor() does.  We return the hypervisor together
+        with the values of the preferences for it.
+        """
+        candidate, values = self.select_candidate(vm, check)
+        return self._get_hypervisor(candidate), values
+
+    def select_candidate(self, vm, check=False):
+        """Select the candidate for a VM like select()
+
+        The hypervisors are only constructed to validate them, so nothing
+        but the ranking is done, unless check is set.
+        """
+        ranking = HypervisorRanking(
+            vm, self.candidates, self.aggregates, self.preferences
+        )
+        columns = ranking.get_columns()
+
+        # We cannot place the VM on the hypervisors not having its route
+        # network or not having enough resources left.
+        eligible = numpy.array([
+            vm.dataset_obj['route_network'] in o['vlan_networks']
+            for o in self.aggregates.hypervisor_objs
+        ], dtype=bool)
+        for preference, column in zip(self.preferences, columns):
+            if isinstance(preference, InsufficientResource):
+                eligible &= ~column
+
+        for candidate, index in ranking:
+            if not eligible[candidate.row]:
+                continue
+
+            # The actual resources are not checked by the ranking.
+            if check:
+                hypervisor = self._get_hypervisor(candidate)
+                try:
+                    hypervisor.check_vm(vm)
+                except HypervisorError as error:
+                    log.warning(
+                        'Preferred hypervisor "{}" is skipped:  {}'
+                        .format(hypervisor, error)
+                    )
+                    continue
+
+            log.debug(
+                'Hypervisor "{}" selected for "{}" with decisive '
+                'preference {!r}.'
+                .format(candidate, vm.fqdn, self.preferences[index])
+            )
+            return candidate, [column[candidate.row] for column in columns]
+
+        raise VMError('Cannot find a hypervisor for "{}"'.format(vm.fqdn))
+
+    def _get_hypervisor(self, candidate):
+        if candidate.row not in self._hypervisors:
+            # The states are already filtered by the Query.
+            self._hypervisors[candidate.row] = Hypervisor.get_shared(
+                candidate.dataset_obj, ignore_reserved=True
+            )
+        return self._hypervisors[candidate.row]
+
+    def place_all(self, vms, check=False):
+        """Place the VMs starting with the biggest ones
+
+        We return the list of the VMs and the hypervisors selected for them.
+        """
+        return [
+            (vm, self.place(vm, check))
+            for vm in sorted(vms, key=_get_vm_size, reverse=True)
+        ]
+
+
+class SimulatedVM(object):
+    """VM only existing in memory to rank the hypervisors for it
+
+    It is sufficient for the preferences.  The VM attributes are taken
+    from a dictionary like the VMs of the hypervisor objects.
+    """
+    def __init__(self, vm_obj, hypervisor=None):
+        self.dataset_obj = dict(vm_obj, xen_host=(
+            hypervisor.dataset_obj['hostname'] if hypervisor else None
+        ))
+        self.hypervisor = hypervisor
+        self.fqdn = vm_obj['hostname']
+
+
+def _get_vm_size(vm):
+    return (
+        vm.dataset_obj['memory'],
+        vm.dataset_obj['disk_size_gib'],
+        vm.dataset_obj['num_cpu'],
+    )
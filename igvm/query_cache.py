@@ -0,0 +1,109 @@
+"""igvm - Serveradmin Query Cache
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import logging
+import pickle
+import sqlite3
+import time
+from os import makedirs
+from os.path import dirname, exists, isdir
+
+from adminapi.dataset import Query
+
+from igvm.session import get_session
+from igvm.settings import SERVERADMIN_CACHE_PATH, SERVERADMIN_CACHE_TTLS
+
+log = logging.getLogger(__name__)
+
+
+def query(filters, attributes):
+    """Return the results of the Query as a list
+
+    The results are read through the cache of the active session, if
+    it has one.
+    """
+    session = get_session()
+    if session is None or session.query_cache is None:
+        return list(Query(filters, attributes))
+    return session.query_cache.query(filters, attributes)
+
+
+class QueryCache(object):
+    """Read-through cache of the Serveradmin Queries on the local disk
+
+    The results are kept by the filters and the attributes of the Query
+    for the TTL of the servertype they are restricted to.  The Queries
+    with a servertype without a TTL are not cached.  The results of
+    the Queries are related to each other, for example the hypervisors
+    include their VMs, so the whole cache is cleared on every commit.
+    The cache is skipped, if the file cannot be used.
+    """
+    def __init__(self, path=SERVERADMIN_CACHE_PATH,
+                 ttls=SERVERADMIN_CACHE_TTLS):
+        self.path = path
+        self.ttls = ttls
+
+    def query(self, filters, attributes):
+        ttl = self.get_ttl(filters)
+        if not ttl:
+            return list(Query(filters, attributes))
+
+        key = repr((sorted(filters.items()), sorted(attributes)))
+        row = self._execute(
+            'SELECT results FROM queries WHERE key = ? AND stored > ?',
+            (key, time.time() - ttl),
+        )
+        if row:
+            log.debug('Serveradmin Query read from the cache: ' + key)
+            return pickle.loads(bytes(row[0]))
+
+        results = list(Query(filters, attributes))
+        try:
+            data = pickle.dumps(results, 2)
+        except Exception as error:
+            # Caching is only best-effort, the results are still good.
+            log.debug('Cannot cache Serveradmin Query: {}'.format(error))
+        else:
+            self._execute(
+                'INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                (key, time.time(), sqlite3.Binary(data)),
+            )
+        return results
+
+    def get_ttl(self, filters):
+        """Return the TTL of the servertype of the Query or 0
+
+        None is used for the Queries not restricted to a single
+        servertype.
+        """
+        servertype = filters.get('servertype')
+        if not isinstance(servertype, (str, unicode)):
+            servertype = None
+        return self.ttls.get(servertype, 0)
+
+    def clear(self):
+        # The file is not created just to clear it.
+        if exists(self.path):
+            self._execute('DELETE FROM queries', ())
+
+    def _execute(self, query, params):
+        try:
+            if not isdir(dirname(self.path)):
+                makedirs(dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=5)
+            try:
+                with conn:
+                    conn.execute(
+                        'CREATE TABLE IF NOT EXISTS queries ('
+                        'key TEXT PRIMARY KEY, stored REAL, results BLOB)'
+                    )
+                    return conn.execute(query, params).fetchone()
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error) as error:
+            log.debug('Cannot use Serveradmin cache "{}": {}'.format(
+                self.path, error
+            ))
+            return None
@@ -0,0 +1,235 @@
+"""igvm - Rebalancing Planner
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import logging
+from os import environ
+
+import numpy
+
+from adminapi.filters import Any
+
+from igvm.hypervisor_aggregates import HypervisorAggregates
+from igvm.hypervisor_preferences import (
+    HashDifference,
+    HypervisorAttributeValue,
+    HypervisorAttributeValueLimit,
+    OverAllocation,
+    get_anti_affinity_attributes,
+)
+from igvm.hypervisor_ranking import (
+    HypervisorCandidate,
+    HypervisorRanking,
+    get_query_attributes,
+)
+from igvm.placement import SimulatedVM
+from igvm.query_cache import query
+from igvm.settings import HYPERVISOR_PREFERENCES
+
+log = logging.getLogger(__name__)
+
+# These preferences only depend on the attributes of the hypervisors, so
+# moving the VMs around doesn't change their values.
+STATIC_PREFERENCES = (
+    HashDifference,
+    HypervisorAttributeValue,
+    HypervisorAttributeValueLimit,
+)
+
+
+class RebalancePlanner(object):
+    """Plan VM migrations to reduce the over-allocation of the hypervisors
+
+    The migrations are simulated in memory.  On every step, the VMs of
+    the most over-allocated hypervisors are ranked for the other
+    hypervisors with the same preferences used for placement.  A VM is
+    only moved to a hypervisor satisfying all preferences until the
+    over-allocation, which ends up less over-allocated than the source
+    hypervisor was.
+
+    The scoring is incremental.  The static preferences are evaluated
+    only once.  After every move, only the rows of the source and
+    the target hypervisors are updated in the aggregates and in
+    the over-allocation column, so the next step is ranked considering
+    the previous moves.
+    """
+    def __init__(self, hypervisor_objs, attribute='num_cpu',
+                 preferences=HYPERVISOR_PREFERENCES):
+        hypervisor_objs = list(hypervisor_objs)
+        self.attribute = attribute
+        self.preferences = preferences
+        self.aggregates = HypervisorAggregates(
+            hypervisor_objs, get_anti_affinity_attributes(preferences)
+        )
+        # Only the hostnames of the hypervisors are returned, so they are
+        # never constructed.
+        self.candidates = [
+            HypervisorCandidate(self.aggregates, r)
+            for r in range(len(self.aggregates))
+        ]
+        self.vm_objs = [list(o['vms']) for o in hypervisor_objs]
+        self.capacities = numpy.array(
+            [o[attribute] for o in hypervisor_objs], dtype=float
+        )
+        self.cpu_utils = numpy.array([
+            -numpy.inf if o['cpu_util_pct'] is None else o['cpu_util_pct']
+            for o in hypervisor_objs
+        ], dtype=float)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.over_allocations = (
+                self.aggregates.vms_sum(attribute) / self.capacities
+            )
+
+        # The preferences before and including the over-allocation must be
+        # satisfied by the hypervisor to move the VM to.
+        self.required_preferences = len(preferences)
+        for index, preference in enumerate(preferences):
+            if isinstance(preference, OverAllocation):
+                self.required_preferences = index + 1
+                break
+
+        self._route_networks = {}
+
+        ranking = HypervisorRanking(
+            None, self.candidates, self.aggregates, preferences
+        )
+        self._static_columns = {
+            index: numpy.asarray(preference(None, ranking))
+            for index, preference in enumerate(preferences)
+            if isinstance(preference, STATIC_PREFERENCES)
+        }
+
+    @classmethod
+    def query(cls, hv_states=['online'], attribute='num_cpu',
+              preferences=HYPERVISOR_PREFERENCES):
+        """Query the hypervisors of the environment
+
+        We need to know the route networks of the VMs to find
+        the hypervisors they can be moved to.
+        """
+        return cls(query({
+            'servertype': 'hypervisor',
+            'environment': environ.get('IGVM_MODE', 'production'),
+            'state': Any(*hv_states),
+        }, get_query_attributes(
+            preferences, [attribute, 'cpu_util_pct'], ['route_network']
+        )), attribute, preferences)
+
+    def get_over_allocations(self):
+        """Return the over-allocation of all hypervisors as a column"""
+        return self.over_allocations.copy()
+
+    def plan(self, max_moves=10, max_sources=10):
+        """Return the list of the planned moves
+
+        The moves are returned as the VM objects with the hostnames of
+        the source and the target hypervisors.
+        """
+        moves = []
+        while len(moves) < max_moves:
+            move = self._find_move(max_sources)
+            if not move:
+                break
+            self._apply_move(*move)
+            moves.append((
+                move[0],
+                self.aggregates.hostnames[move[1]],
+                self.aggregates.hostnames[move[2]],
+            ))
+
+        return moves
+
+    def _find_move(self, max_sources):
+        over_allocations = self.over_allocations
+        mean = numpy.mean(over_allocations[numpy.isfinite(over_allocations)])
+
+        # The last key is the primary one for lexsort().
+        sources = numpy.lexsort((-self.cpu_utils, -over_allocations))
+        for source in sources[:max_sources]:
+            # Moving VMs away from the hypervisors less over-allocated than
+            # the average would not improve the distribution.
+            if not over_allocations[source] > mean:
+                break
+
+            vm_objs = sorted(
+                self.vm_objs[source],
+                key=lambda v: v[self.attribute],
+                reverse=True,
+            )
+            for vm_obj in vm_objs:
+                target = self._find_target(vm_obj, source)
+                if target is not None:
+                    return vm_obj, source, target
+
+        return None
+
+    def _find_target(self, vm_obj, source):
+        columns = self._get_columns(
+            SimulatedVM(vm_obj, self.candidates[source])
+        )
+
+        eligible = self._get_route_network_mask(vm_obj['route_network'])
+        for column in columns[:self.required_preferences]:
+            eligible &= ~column.astype(bool)
+        eligible[source] = False
+
+        # The target must end up less over-allocated than the source was.
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            eligible &= (
+                self.over_allocations + vm_obj[self.attribute] /
+                self.capacities < self.over_allocations[source]
+            )
+
+        rows = numpy.flatnonzero(eligible)
+        if not len(rows):
+            return None
+
+        # The last key is the primary one for lexsort().  Sorting only
+        # the eligible rows gives the same first one as ranking them all.
+        order = numpy.lexsort([c[rows] for c in columns[::-1]])
+        return int(rows[order[0]])
+
+    def _get_columns(self, vm):
+        """Return the values of the preferences for all hypervisors
+
+        Only the preferences depending on the VM or on the VMs of
+        the hypervisors are evaluated.
+        """
+        ranking = HypervisorRanking(
+            vm, self.candidates, self.aggregates, self.preferences
+        )
+        return [
+            self._static_columns[index] if index in self._static_columns
+            else numpy.asarray(preference(vm, ranking))
+            for index, preference in enumerate(self.preferences)
+        ]
+
+    def _apply_move(self, vm_obj, source, target):
+        log.debug(
+            'Moving "{}" from "{}" to "{}"'
+            .format(
+                vm_obj['hostname'],
+                self.aggregates.hostnames[source],
+                self.aggregates.hostnames[target],
+            )
+        )
+        self.aggregates.remove_vm(self.aggregates.hostnames[source], vm_obj)
+        self.aggregates.add_vm(self.aggregates.hostnames[target], vm_obj)
+        self.vm_objs[source].remove(vm_obj)
+        self.vm_objs[target].append(vm_obj)
+
+        rows = [source, target]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.over_allocations[rows] = (
+                self.aggregates.sums[self.attribute][rows] /
+                self.capacities[rows]
+            )
+
+    def _get_route_network_mask(self, route_network):
+        if route_network not in self._route_networks:
+            self._route_networks[route_network] = numpy.array([
+                route_network in o['vlan_networks']
+                for o in self.aggregates.hypervisor_objs
+            ], dtype=bool)
+        return self._route_networks[route_network].copy()
@@ -0,0 +1,152 @@
+"""igvm - Remote Agent
+
+Copyright (c) 2018, InnoGames GmbH
+
+This program is started on the hosts by igvm.agent.  It must only use
+the standard library of both Python 2 and 3, because it is run by
+whatever Python the host has.
+"""
+
+import errno
+import json
+import os
+import stat
+import subprocess
+import sys
+from base64 import b64decode, b64encode
+from threading import Lock, Thread
+
+PROTOCOL_VERSION = 1
+
+
+def op_run(command, stdin=None):
+    """Run the command in a shell and return its output and exit code"""
+    proc = subprocess.Popen(
+        ['/bin/sh', '-c', command],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True,
+    )
+    stdout, stderr = proc.communicate(b64decode(stdin) if stdin else b'')
+    return {
+        'return_code': proc.returncode,
+        'stdout': _decode(stdout),
+        'stderr': _decode(stderr),
+    }
+
+
+def op_stat(path):
+    """Return the attributes of the file or None, if it doesn't exist"""
+    try:
+        result = os.stat(path)
+    except OSError as error:
+        if error.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+    return {
+        'size': result.st_size,
+        'mode': stat.S_IMODE(result.st_mode),
+        'mtime': result.st_mtime,
+        'is_dir': stat.S_ISDIR(result.st_mode),
+        'is_file': stat.S_ISREG(result.st_mode),
+    }
+
+
+def op_read_files(paths):
+    """Return the contents of the files encoded with base64"""
+    contents = {}
+    for path in paths:
+        with open(path, 'rb') as fd:
+            contents[path] = b64encode(fd.read()).decode('ascii')
+    return contents
+
+
+def op_lvcreate(vg_name, name, size_gib):
+    _check_call(['lvcreate', '-y', '-L', '{}g'.format(size_gib), '-n', name,
+                 vg_name])
+
+
+def op_lvremove(path):
+    _check_call(['lvremove', '-f', path])
+
+
+def op_lvresize(path, size_gib):
+    _check_call(['lvresize', path, '-L', '{}g'.format(size_gib)])
+
+
+def op_lvrename(path, new_name):
+    _check_call(['lvrename', path, new_name])
+
+
+OPS = {
+    'run': op_run,
+    'stat': op_stat,
+    'read_files': op_read_files,
+    'lvcreate': op_lvcreate,
+    'lvremove': op_lvremove,
+    'lvresize': op_lvresize,
+    'lvrename': op_lvrename,
+}
+
+
+def main():
+    """Serve the requests read line by line from the standard input
+
+    Every request is a JSON object with its ID, the name of the
+    operation and its arguments.  The requests are served by their own
+    threads, so the slow ones don't block the others.  The responses
+    are written in the order they finish with the ID of the request and
+    either the result or the error.  The agent exits, when the standard
+    input is closed.
+    """
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stdout_lock = Lock()
+
+    def write(response):
+        line = json.dumps(response).encode('utf-8') + b'\n'
+        with stdout_lock:
+            stdout.write(line)
+            stdout.flush()
+
+    def serve(request):
+        try:
+            result = OPS[request['op']](**request.get('args', {}))
+        except Exception as error:
+            write({
+                'id': request['id'],
+                'error': '{}: {}'.format(type(error).__name__, error),
+            })
+        else:
+            write({'id': request['id'], 'result': result})
+
+    write({'ready': True, 'version': PROTOCOL_VERSION})
+    for line in iter(stdin.readline, b''):
+        thread = Thread(target=serve, args=(json.loads(line.decode('utf-8')),))
+        thread.daemon = True
+        thread.start()
+
+
+def _check_call(args):
+    proc = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=True,
+    )
+    stdout, stderr = proc.communicate(b'')
+    if proc.returncode != 0:
+        raise OSError(
+            '"{}" failed with exit code {}: {}'
+            .format(' '.join(args), proc.returncode, _decode(stderr).strip())
+        )
+
+
+def _decode(data):
+    return data.decode('utf-8', 'replace')
+
+
+if __name__ == '__main__':
+    main()
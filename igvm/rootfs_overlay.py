@@ -0,0 +1,67 @@
+"""igvm - Root Filesystem Overlay
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import tarfile
+import time
+from io import BytesIO
+from os.path import join
+
+from jinja2 import Environment, PackageLoader
+
+
+class RootfsOverlay(object):
+    """Files to write into the mounted image of a VM at once
+
+    The files are rendered locally into a tar archive kept in memory.
+    The archive is streamed to the hypervisor and extracted into the
+    image by a single command.  The files to copy from the hypervisor
+    itself are copied there by the same command instead of downloading
+    and uploading them again.
+    """
+    def __init__(self):
+        self.files = []
+        self.copies = []
+
+    def add_file(self, path, content, mode=0o644):
+        self.files.append((path, content, mode))
+
+    def add_template(self, filename, path, context=None, mode=0o644):
+        jenv = Environment(loader=PackageLoader('igvm', 'templates'))
+        self.add_file(
+            path, jenv.get_template(filename).render(**(context or {})), mode
+        )
+
+    def add_copy(self, source, path, mode=0o644):
+        """Copy the file from the hypervisor"""
+        self.copies.append((source, path, mode))
+
+    def get_archive(self):
+        fd = BytesIO()
+        tar = tarfile.open(fileobj=fd, mode='w')
+        for path, content, mode in self.files:
+            if not isinstance(content, bytes):
+                content = content.encode('utf-8')
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(content)
+            info.mode = mode
+            info.mtime = time.time()
+            info.uname = info.gname = 'root'
+            tar.addfile(info, BytesIO(content))
+        tar.close()
+        return fd.getvalue()
+
+    def extract(self, vm):
+        """Write the files into the mounted image of the VM"""
+        hypervisor = vm.hypervisor
+        mount_path = hypervisor.vm_mount_path(vm)
+
+        batch = hypervisor.batch(silent=True)
+        if self.files:
+            batch.add('tar -x -p -C {}'.format(mount_path))
+        for source, path, mode in self.copies:
+            batch.add('install -m {:o} {} {}'.format(
+                mode, source, join(mount_path, path.lstrip('/'))
+            ))
+        batch.run(stdin=self.get_archive() if self.files else None)
@@ -0,0 +1,207 @@
+"""igvm - Route Network Index
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import logging
+from itertools import islice
+from threading import Lock
+
+from adminapi.filters import Any, Empty, Not
+
+from igvm.exceptions import ConfigError
+from igvm.query_cache import query
+
+log = logging.getLogger(__name__)
+
+ROUTE_NETWORK_ATTRIBUTES = [
+    'hostname',
+    'intern_ip',
+    'default_gateway',
+    'internal_gateway',
+    'primary_ip6',
+    'state',
+    'vlan_tag',
+]
+
+GATEWAY_ATTRIBUTES = [
+    'hostname',
+    'intern_ip',
+    'primary_ip6',
+]
+
+_index = None
+_index_lock = Lock()
+
+
+def get_route_network_index():
+    """Return the index of the route networks loaded once per process"""
+    global _index
+
+    with _index_lock:
+        if _index is None:
+            _index = RouteNetworkIndex.load()
+    return _index
+
+
+def clear_route_network_index():
+    """Drop the index to load it again after changing the route networks"""
+    global _index
+
+    with _index_lock:
+        _index = None
+
+
+class RouteNetworkIndex(object):
+    """Non-retired route networks with their gateways
+
+    The route networks are loaded with a single Query together with
+    a single one for all of their gateways.  The networks containing
+    an address are then found in a prefix trie by their intern_ip
+    attribute like the Contains filter would instead of asking Serveradmin
+    for every server.  The networks are also indexed by their names to
+    resolve the VLANs of the hypervisors.  The retired networks are only
+    indexed by their names, as they were never filtered out for the VLANs.
+    """
+    def __init__(self, route_network_objs, gateway_objs):
+        self.route_networks = {}
+        self.gateways = {}
+        self._tries = {}
+        self._other_networks = {}
+        self._lock = Lock()
+
+        for route_network in route_network_objs:
+            self.route_networks[route_network['hostname']] = route_network
+            if route_network.get('state') == 'retired':
+                continue
+            if route_network.get('intern_ip'):
+                self._insert(route_network['intern_ip'], route_network)
+
+        for gateway in gateway_objs:
+            self.gateways[gateway['hostname']] = gateway
+
+    @classmethod
+    def load(cls):
+        route_network_objs = query({
+            'servertype': 'route_network',
+        }, ROUTE_NETWORK_ATTRIBUTES)
+
+        gateway_names = set()
+        for route_network in route_network_objs:
+            if route_network.get('state') == 'retired':
+                continue
+            for attribute in ('default_gateway', 'internal_gateway'):
+                if route_network.get(attribute):
+                    gateway_names.add(route_network[attribute])
+        if gateway_names:
+            gateway_objs = query({
+                'state': Not('retired'),
+                'hostname': Any(*gateway_names),
+            }, GATEWAY_ATTRIBUTES)
+        else:
+            gateway_objs = []
+
+        log.debug('Loaded {} route networks with {} gateways.'.format(
+            len(route_network_objs), len(gateway_objs)
+        ))
+        return cls(route_network_objs, gateway_objs)
+
+    def get(self, hostname):
+        """Return the route network with the name or None"""
+        return self.route_networks.get(hostname)
+
+    def lookup(self, address):
+        """Return the route network containing the address
+
+        We raise ConfigError, if there is none or more than one, like
+        getting the single result of the Contains filter would.
+        """
+        address = getattr(address, 'ip', address)
+        node = self._tries.get(address.version)
+        route_networks = []
+        for bit in _get_bits(int(address), address.max_prefixlen):
+            if node is None:
+                break
+            route_networks.extend(node[2])
+            node = node[bit]
+        else:
+            if node is not None:
+                route_networks.extend(node[2])
+        if not route_networks:
+            raise ConfigError(
+                'No route network contains the address {}.'.format(address)
+            )
+        if len(route_networks) > 1:
+            raise ConfigError(
+                'Route networks {} all contain the address {}.'.format(
+                    ', '.join(r['hostname'] for r in route_networks), address
+                )
+            )
+        return route_networks[0]
+
+    def get_gateways(self, route_network):
+        """Return the default and the internal gateway of the route network
+
+        Empty dictionaries are returned for the undefined gateways to
+        simulate Serveradmin objects.
+        """
+        return tuple(
+            self.gateways.get(route_network.get(attribute), {})
+            for attribute in ('default_gateway', 'internal_gateway')
+        )
+
+    def get_vlan_tags(self, hostnames):
+        """Return the VLAN tags of the route networks with the names
+
+        Every network is only counted once like in the result of a Query.
+        The VLAN networks are not restricted to the route networks, so
+        the other servers with the names are queried once.
+        """
+        hostnames = sorted(set(hostnames))
+        with self._lock:
+            missing = [
+                h for h in hostnames
+                if h not in self.route_networks and
+                h not in self._other_networks
+            ]
+            if missing:
+                networks = {
+                    n['hostname']: n
+                    for n in self._query_other_networks(missing)
+                }
+                for hostname in missing:
+                    self._other_networks[hostname] = networks.get(hostname)
+
+        vlan_tags = []
+        for hostname in hostnames:
+            network = (
+                self.route_networks.get(hostname) or
+                self._other_networks.get(hostname)
+            )
+            if network and network.get('vlan_tag') is not None:
+                vlan_tags.append(network['vlan_tag'])
+        return vlan_tags
+
+    def _query_other_networks(self, hostnames):
+        return query({
+            'hostname': Any(*hostnames),
+            'vlan_tag': Not(Empty()),
+        }, ['hostname', 'vlan_tag'])
+
+    def _insert(self, network, route_network):
+        # The nodes are lists of the children for bit 0 and 1 and
+        # the route networks ending at the node.
+        network = getattr(network, 'network', network)
+        address = network.network_address
+        node = self._tries.setdefault(address.version, [None, None, []])
+        bits = _get_bits(int(address), address.max_prefixlen)
+        for bit in islice(bits, network.prefixlen):
+            if node[bit] is None:
+                node[bit] = [None, None, []]
+            node = node[bit]
+        node[2].append(route_network)
+
+
+def _get_bits(number, length):
+    for index in range(length - 1, -1, -1):
+        yield (number >> index) & 1
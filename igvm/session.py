@@ -0,0 +1,85 @@
+"""igvm - Session
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+from threading import RLock
+
+from igvm.settings import HYPERVISOR_CHECK_CONCURRENCY
+
+_session = None
+
+
+def get_session():
+    """Return the active session or None"""
+    return _session
+
+
+class Session(object):
+    """Identity map of the Serveradmin objects and the hosts of a command
+
+    The same server is looked up several times by a single command, for
+    example the hypervisor of a VM by the VM and by the placement.  They
+    share the same objects within the session, so only the first lookup
+    queries Serveradmin, and the hosts share their lazy properties and
+    connections.  The objects are kept by their servertype and their
+    hostname.  The names they have been looked up with are mapped to
+    the hostnames.  The Queries are read through the cache, if one is
+    given.  The commands are run through the agents on the hosts
+    supporting them, if use_agent is set.  The given number of
+    hypervisors are validated concurrently for placement.  The session is
+    activated as a context manager.
+    """
+    def __init__(self, query_cache=None, use_agent=False,
+                 check_concurrency=HYPERVISOR_CHECK_CONCURRENCY):
+        self.query_cache = query_cache
+        self.use_agent = use_agent
+        self.check_concurrency = check_concurrency
+        self._names = {}
+        self._servers = {}
+        self._hosts = {}
+        self._lock = RLock()
+        self._previous = None
+
+    def __enter__(self):
+        global _session
+
+        self._previous = _session
+        _session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _session
+
+        _session = self._previous
+        self._previous = None
+
+    def get_server(self, name, servertype):
+        """Return the object looked up with the name before or None"""
+        with self._lock:
+            hostname = self._names.get((servertype, name), name)
+            return self._servers.get((servertype, hostname))
+
+    def add_server(self, name, servertype, server, replace=False):
+        """Add the object looked up with the name and return the shared one
+
+        The object already in the session is returned, unless it is
+        replaced, because another thread could have looked it up in the
+        meantime.
+        """
+        with self._lock:
+            key = (servertype, server['hostname'])
+            if replace or key not in self._servers:
+                self._servers[key] = server
+            self._names[(servertype, name)] = server['hostname']
+            return self._servers[key]
+
+    def get_host(self, servertype, hostname):
+        with self._lock:
+            return self._hosts.get((servertype, hostname))
+
+    def add_host(self, host):
+        """Add the host and return the shared one like add_server()"""
+        with self._lock:
+            key = (host.servertype, host.dataset_obj['hostname'])
+            return self._hosts.setdefault(key, host)
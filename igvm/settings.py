@@ -3,6 +3,8 @@
 Copyright (c) 2018, InnoGames GmbH
 """
 
+from os.path import expanduser
+
 from igvm.hypervisor_preferences import (
     HashDifference,
     HypervisorAttributeValue,
@@ -12,15 +14,10 @@ from igvm.hypervisor_preferences import (
     OverAllocation,
 )
 
-COMMON_FABRIC_SETTINGS = dict(
-    disable_known_hosts=True,
-    use_ssh_config=True,
-    always_use_pty=False,
-    forward_agent=True,
-    shell='/bin/sh -c',
-    timeout=5,
-    connection_attempts=1,
-)
+# The SSH connections are established with the timeout and kept alive
+# by sending a packet in the interval in seconds.
+SSH_TIMEOUT = 5
+SSH_KEEPALIVE = 30
 
 # Swap size in MiB
 DEFAULT_SWAP_SIZE = 1024
@@ -33,6 +30,24 @@ RESERVED_DISK = 5.0
 # Reserved memory for host OS in MiB
 HOST_RESERVED_MEMORY = 2 * 1024
 
+# The static facts of the hypervisors are cached for the igvm processes on
+# the same host until the hypervisor is rebooted or the TTL in seconds
+# expires.  Set the TTL to 0 to disable the cache.
+FACTS_CACHE_PATH = expanduser('~/.cache/igvm/facts.sqlite')
+FACTS_CACHE_TTL = 24 * 60 * 60
+
+# The read-only commands can read Serveradmin through a cache with
+# the --cached option.  The TTLs in seconds are set by the servertypes
+# the Queries are restricted to.  None is for the Queries not restricted
+# to a single servertype.  The others are not cached.
+SERVERADMIN_CACHE_PATH = expanduser('~/.cache/igvm/serveradmin.sqlite')
+SERVERADMIN_CACHE_TTLS = {
+    'vm': 5 * 60,
+    'hypervisor': 5 * 60,
+    'route_network': 60 * 60,
+    None: 60 * 60,
+}
+
 
 # Default max number of CPUs, unless the hypervisor has fewer cores or num_cpu
 # is larger than this value.
@@ -102,34 +117,53 @@ VM_ATTRIBUTES = [
     'xen_host',
 ]
 
-HYPERVISOR_ATTRIBUTES = [
-    'cpu_util_pct',
-    'cpu_util_vm_pct',
+# The attributes of the VMs on a hypervisor loaded when something reads
+# them outside of the placement.  The placement queries the attributes
+# needed by the preferences together with the hypervisors.
+HYPERVISOR_VM_ATTRIBUTES = [
     'disk_size_gib',
-    'hardware_model',
+    'environment',
+    'function',
     'hostname',
-    'intern_ip',
+    'game_market',
+    'game_world',
+    'game_type',
     'memory',
     'num_cpu',
-    'os',
+    'project',
+]
+
+# The attributes of the hypervisors needed by the commands only connecting
+# to them to control the VMs
+HYPERVISOR_CONTROL_ATTRIBUTES = [
+    'hostname',
+    'intern_ip',
     'state',
+]
+
+# The attributes of the hypervisors needed by the commands defining the VMs
+# on them again
+HYPERVISOR_DEFINE_ATTRIBUTES = HYPERVISOR_CONTROL_ATTRIBUTES + [
+    'hardware_model',
     'vlan_networks',
-    {
-        'vms': [
-            'disk_size_gib',
-            'environment',
-            'function',
-            'hostname',
-            'game_market',
-            'game_world',
-            'game_type',
-            'memory',
-            'num_cpu',
-            'project',
-        ],
-    },
 ]
 
+# The attributes of the hypervisors needed by the commands building and
+# moving the VMs.  The resources are included to compare them with
+# the current hypervisor of a VM.
+HYPERVISOR_ATTRIBUTES = HYPERVISOR_DEFINE_ATTRIBUTES + [
+    'disk_size_gib',
+    'memory',
+    'num_cpu',
+    'os',
+]
+
+# Number of the best ranked hypervisors validated concurrently for placement.
+# The connections to as many hypervisors are established while the ranking
+# is running.  By default, the hypervisors are validated one after another,
+# so we only connect to the ones needed.
+HYPERVISOR_CHECK_CONCURRENCY = 1
+
 # The list is ordered from more important to less important.  The next
 # preference is only going to be checked when the previous ones return all
 # the same values.
@@ -0,0 +1,190 @@
+"""igvm - Placement Simulation
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import gzip
+import json
+import logging
+import random
+import time
+from os import environ
+
+import numpy
+
+from adminapi.filters import Any
+
+from igvm.hypervisor_preferences import OtherVMs
+from igvm.hypervisor_ranking import get_query_attributes
+from igvm.placement import BatchPlacement, SimulatedVM
+from igvm.query_cache import query
+from igvm.settings import HYPERVISOR_PREFERENCES
+from igvm.vm import VMError
+
+log = logging.getLogger(__name__)
+
+
+def export_snapshot(path, hv_states=['online'],
+                    preferences=HYPERVISOR_PREFERENCES):
+    """Write the hypervisors with their VMs to a gzipped JSON file
+
+    The snapshot contains everything needed to rank the hypervisors
+    without Serveradmin.  The route networks of the VMs are included
+    to generate requests like the existing VMs.  We return the number
+    of hypervisors written.
+    """
+    hypervisor_objs = [dict(o) for o in query({
+        'servertype': 'hypervisor',
+        'environment': environ.get('IGVM_MODE', 'production'),
+        'state': Any(*hv_states),
+    }, get_query_attributes(preferences, vm_attributes=['route_network']))]
+
+    with gzip.open(path, 'wb') as fd:
+        fd.write(json.dumps(
+            {'hypervisors': hypervisor_objs},
+            default=_encode_value,
+            separators=(',', ':'),
+            sort_keys=True,
+        ).encode())
+
+    return len(hypervisor_objs)
+
+
+def load_snapshot(path):
+    """Read the hypervisor objects from a snapshot file"""
+    with gzip.open(path, 'rb') as fd:
+        hypervisor_objs = json.loads(fd.read().decode())['hypervisors']
+
+    for hypervisor_obj in hypervisor_objs:
+        hypervisor_obj['vlan_networks'] = set(hypervisor_obj['vlan_networks'])
+
+    return hypervisor_objs
+
+
+def _encode_value(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    # IP addresses and everything else Serveradmin can return
+    return str(value)
+
+
+class PlacementSimulator(object):
+    """Replay placement requests against the hypervisors of a snapshot
+
+    The requests are generated from the VMs in the snapshot, so they
+    follow the same distribution of sizes and attributes.  Every request
+    is placed like the hypervisor selection of the build command except
+    for the checks on the hypervisors, and accounted for the following
+    ones.  The hypervisors are not constructed, so the latencies are
+    the ones of the ranking.  The random generator is seeded to make the runs reproducible.
+    """
+    def __init__(self, hypervisor_objs, preferences=HYPERVISOR_PREFERENCES,
+                 seed=0):
+        self.hypervisor_objs = list(hypervisor_objs)
+        self.preferences = preferences
+        self.random = random.Random(seed)
+        self.vm_objs = [
+            v for h in self.hypervisor_objs for v in h['vms']
+            if v.get('route_network')
+        ]
+
+    def generate_requests(self, count):
+        """Generate VM objects similar to the existing ones"""
+        return [
+            dict(
+                self.random.choice(self.vm_objs),
+                hostname='simulated-{}'.format(index),
+            )
+            for index in range(count)
+        ]
+
+    def run(self, count):
+        """Place the number of requests and return the report"""
+        placement = BatchPlacement(self.hypervisor_objs, self.preferences)
+        report = SimulationReport(self.preferences)
+
+        for vm_obj in self.generate_requests(count):
+            vm = SimulatedVM(vm_obj)
+            start = time.time()
+            try:
+                candidate, values = placement.select_candidate(vm)
+            except VMError:
+                report.add_failure(time.time() - start)
+                continue
+            report.add_placement(time.time() - start, values)
+            placement.aggregates.add_vm(
+                candidate.dataset_obj['hostname'], vm_obj
+            )
+
+        report.set_allocations(placement)
+        return report
+
+
+class SimulationReport(object):
+    """Decision latencies and quality metrics of a simulation"""
+    def __init__(self, preferences):
+        self.preferences = preferences
+        self.latencies = []
+        self.failures = 0
+        # Number of the placements on hypervisors with other VMs having
+        # the same attributes for every anti-affinity preference
+        self.violations = [0 for p in preferences]
+        self.allocations = {}
+
+    def add_placement(self, latency, values):
+        self.latencies.append(latency)
+        for index, (preference, value) in enumerate(
+            zip(self.preferences, values)
+        ):
+            if isinstance(preference, OtherVMs) and value:
+                self.violations[index] += 1
+
+    def add_failure(self, latency):
+        self.latencies.append(latency)
+        self.failures += 1
+
+    def set_allocations(self, placement):
+        """Calculate the allocation ratios of the hypervisors at the end"""
+        for attribute in ('num_cpu', 'memory', 'disk_size_gib'):
+            capacities = placement.aggregates.hypervisor_attribute(attribute)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                ratios = placement.aggregates.vms_sum(attribute) / capacities
+            self.allocations[attribute] = ratios[numpy.isfinite(ratios)]
+
+    def format(self):
+        """Return the report as lines of text"""
+        latencies = numpy.array(self.latencies) * 1000
+        lines = [
+            'Placements: {} ({} failed)'.format(
+                len(self.latencies), self.failures
+            ),
+        ]
+        if len(latencies):
+            lines.append(
+                'Latency per placement ms: mean {:.2f}, p50 {:.2f}, '
+                'p95 {:.2f}, p99 {:.2f}, max {:.2f}'
+                .format(
+                    latencies.mean(),
+                    numpy.percentile(latencies, 50),
+                    numpy.percentile(latencies, 95),
+                    numpy.percentile(latencies, 99),
+                    latencies.max(),
+                )
+            )
+        for preference, violations in zip(self.preferences, self.violations):
+            if isinstance(preference, OtherVMs):
+                lines.append('Placed next to other VMs for {!r}: {}'.format(
+                    preference, violations
+                ))
+        for attribute, ratios in sorted(self.allocations.items()):
+            if len(ratios):
+                lines.append(
+                    'Allocation of {}: mean {:.2f}, p99 {:.2f}, max {:.2f}'
+                    .format(
+                        attribute,
+                        ratios.mean(),
+                        numpy.percentile(ratios, 99),
+                        ratios.max(),
+                    )
+                )
+        return lines
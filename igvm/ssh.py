@@ -0,0 +1,264 @@
+"""igvm - SSH Connections
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import logging
+import socket
+from os import environ
+from os.path import expanduser, isfile
+from pipes import quote
+from threading import Lock, Thread
+
+from fabric.api import env
+from paramiko import (
+    AutoAddPolicy,
+    ProxyCommand,
+    SFTPClient,
+    SSHClient,
+    SSHConfig,
+    SSHException,
+)
+from paramiko.agent import AgentRequestHandler
+
+from igvm.exceptions import RemoteCommandError
+from igvm.settings import SSH_KEEPALIVE, SSH_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+_conns = {}
+_conns_lock = Lock()
+
+
+def get_ssh_connection(host_string):
+    """Return the connection to the host shared by the threads
+
+    The connection is only established on first use.
+    """
+    with _conns_lock:
+        if host_string not in _conns:
+            _conns[host_string] = SSHConnection(host_string)
+        return _conns[host_string]
+
+
+def close_ssh_connections():
+    with _conns_lock:
+        for host_string in list(_conns.keys()):
+            _conns.pop(host_string).close()
+
+
+def get_command(command, with_sudo=True, shell=True):
+    """Wrap the command into a shell and sudo like Fabric does"""
+    if shell:
+        command = '/bin/sh -c {}'.format(quote(command))
+    if with_sudo:
+        command = 'sudo -n ' + command
+    return command
+
+
+class CommandResult(str):
+    """Output of a command with its exit code like Fabric returns"""
+    def __new__(cls, output, return_code, stderr=''):
+        self = super(CommandResult, cls).__new__(cls, output)
+        self.return_code = return_code
+        self.stderr = stderr
+        self.succeeded = return_code == 0
+        self.failed = not self.succeeded
+        return self
+
+
+class SSHConnection(object):
+    """Connection to a host to run the commands through
+
+    The commands are run on their own channels of the same transport, so
+    the connection can be used by multiple threads at the same time.
+    The transport is kept alive, and connected again, if it has been
+    lost before running a command.  The SSH configuration of the user
+    and the agent are used like Fabric does.  The errors of
+    the connection are raised as RemoteCommandError like Fabric does.
+    """
+    def __init__(self, host_string):
+        self.host_string = host_string
+        self._client = None
+        self._lock = Lock()
+
+    def get_transport(self):
+        with self._lock:
+            if self._client is not None:
+                transport = self._client.get_transport()
+                if transport is not None and transport.is_active():
+                    return transport
+                self._client.close()
+            self._client = self._connect()
+            return self._client.get_transport()
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def open_session(self):
+        """Open a channel connecting again, if the connection was lost"""
+        try:
+            return self.get_transport().open_session()
+        except (socket.error, SSHException) as error:
+            log.debug('Connecting to "{}" again: {}'.format(
+                self.host_string, error
+            ))
+            self.close()
+        try:
+            return self.get_transport().open_session()
+        except (socket.error, SSHException) as error:
+            raise RemoteCommandError(
+                'Cannot open a session on "{}": {}'
+                .format(self.host_string, error)
+            )
+
+    def run(self, command, silent=False, warn_only=False, stdin=None):
+        """Run the command and return its output
+
+        The output is logged line by line, unless silent is set.
+        RemoteCommandError is raised, if the command fails, unless
+        warn_only is set.  The stdin data is sent to the command.
+        """
+        if not silent:
+            log.info('[{}] run: {}'.format(self.host_string, command))
+
+        channel = self.open_session()
+        try:
+            stdout, stderr, return_code = self._run_channel(
+                channel, command, silent, stdin
+            )
+        except (socket.error, SSHException) as error:
+            raise RemoteCommandError(
+                'Command on "{}" failed: {}\n{}'
+                .format(self.host_string, command, error)
+            )
+        finally:
+            channel.close()
+
+        # Fabric is also stripping the output.
+        result = CommandResult(
+            ''.join(stdout).strip(),
+            return_code,
+            ''.join(stderr).strip(),
+        )
+        if result.failed and not warn_only:
+            raise RemoteCommandError(
+                'Command on "{}" failed with exit code {}: {}\n{}'.format(
+                    self.host_string, return_code, command, result.stderr
+                )
+            )
+        return result
+
+    def _run_channel(self, channel, command, silent, stdin):
+        """Run the command on the channel and return its outputs"""
+        if environ.get('SSH_AUTH_SOCK'):
+            AgentRequestHandler(channel)
+        channel.exec_command(command)
+
+        # Standard input is sent and standard error is read by other
+        # threads, so neither of them blocks the command, when it writes
+        # a lot before reading its input.
+        stderr = []
+        threads = [Thread(
+            target=self._read_stderr, args=(channel, stderr, silent)
+        )]
+        if stdin is not None:
+            threads.append(Thread(
+                target=self._send_stdin, args=(channel, stdin)
+            ))
+        else:
+            channel.shutdown_write()
+        for thread in threads:
+            thread.start()
+
+        stdout = []
+        for line in channel.makefile('rb'):
+            line = _to_str(line)
+            if not silent:
+                log.info('[{}] out: {}'.format(
+                    self.host_string, line.rstrip('\r\n')
+                ))
+            stdout.append(line)
+        for thread in threads:
+            thread.join()
+        return stdout, stderr, channel.recv_exit_status()
+
+    def _read_stderr(self, channel, stderr, silent):
+        # Fabric is also logging the standard error of the commands.
+        for line in channel.makefile_stderr('rb'):
+            line = _to_str(line)
+            if not silent:
+                log.info('[{}] err: {}'.format(
+                    self.host_string, line.rstrip('\r\n')
+                ))
+            stderr.append(line)
+
+    def _send_stdin(self, channel, stdin):
+        try:
+            channel.sendall(stdin)
+            channel.shutdown_write()
+        except (socket.error, SSHException) as error:
+            # The command may exit without reading all of its input.
+            log.debug('Sending to "{}" failed: {}'.format(
+                self.host_string, error
+            ))
+
+    def read_file(self, path):
+        """Read the file over SFTP"""
+        try:
+            sftp = SFTPClient.from_transport(self.get_transport())
+        except (socket.error, SSHException) as error:
+            raise RemoteCommandError(
+                'Cannot open SFTP on "{}": {}'.format(self.host_string, error)
+            )
+        try:
+            with sftp.open(path, 'rb') as fd:
+                return _to_str(fd.read())
+        finally:
+            sftp.close()
+
+    def _connect(self):
+        # The user can be given in the host string like for Fabric.
+        user, _, host = self.host_string.rpartition('@')
+        config = {}
+        config_path = expanduser('~/.ssh/config')
+        if isfile(config_path):
+            ssh_config = SSHConfig()
+            with open(config_path) as fd:
+                ssh_config.parse(fd)
+            config = ssh_config.lookup(host)
+
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        try:
+            client.connect(
+                config.get('hostname', host),
+                port=int(config.get('port', 22)),
+                # The integration tests set the user in the environment of
+                # Fabric, which the libvirt connections are using too.
+                username=user or config.get('user', env.get('user')),
+                key_filename=config.get('identityfile'),
+                sock=(
+                    ProxyCommand(config['proxycommand'])
+                    if config.get('proxycommand') else None
+                ),
+                timeout=SSH_TIMEOUT,
+            )
+        except (socket.error, SSHException) as error:
+            client.close()
+            raise RemoteCommandError(
+                'Cannot connect to "{}": {}'.format(self.host_string, error)
+            )
+        client.get_transport().set_keepalive(SSH_KEEPALIVE)
+        log.debug('Connected to "{}".'.format(self.host_string))
+        return client
+
+
+def _to_str(data):
+    # Paramiko returns bytes on Python 3.
+    if not isinstance(data, str):
+        data = data.decode('utf-8', 'replace')
+    return data
@@ -113,7 +113,11 @@ class DomainProperties(object):
         self.uuid = domain.UUIDString()
         self.hugepages = tree.find('memoryBacking/hugepages') is not None
         self.num_nodes = max(len(tree.findall('cpu/numa/cell')), 1)
-        self.max_cpus = domain.vcpusFlags(VIR_DOMAIN_VCPU_MAXIMUM)
+        # The statistics are shared by all domains of the hypervisor.
+        self.max_cpus = (
+            hypervisor.get_domain_stats(domain).max_cpus or
+            domain.vcpusFlags(VIR_DOMAIN_VCPU_MAXIMUM)
+        )
         self.mem_hotplug = tree.find('maxMemory') is not None
 
         memballoon = tree.find('devices/memballoon')
@@ -385,6 +389,9 @@ def generate_domain_xml(hypervisor, vm):
 
 
 def _get_qemu_version(hypervisor):
+    if hypervisor.facts.qemu_version:
+        return hypervisor.facts.qemu_version
+
     version = hypervisor.conn().getVersion()
     # According to documentation:
     # value is major * 1,000,000 + minor * 1,000 + release
@@ -436,10 +443,7 @@ def _place_numa(hypervisor, vm, tree, props):
     num_vcpus = props.max_cpus
 
     # Which physical CPU belongs to which physical node
-    pcpu_sets = hypervisor.run(
-        'cat /sys/devices/system/node/node*/cpulist',
-        silent=True,
-    ).splitlines()
+    pcpu_sets = list(hypervisor.facts.numa_cpulists)
     num_nodes = len(pcpu_sets)
     assert num_nodes == len(pcpu_sets)
     nodeset = ','.join(str(i) for i in range(0, num_nodes))
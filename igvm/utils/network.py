@@ -5,8 +5,7 @@ Copyright (c) 2018, InnoGames GmbH
 
 import logging
 
-from adminapi.dataset import Query
-from adminapi.filters import Contains, Not
+from igvm.route_network_index import get_route_network_index
 
 log = logging.getLogger(__name__)
 
@@ -15,18 +14,7 @@ def get_network_config(server):
     ret = {}
     # It is impossible to use server['route_network']
     # if IP address of a server was changed via --newip.
-    route_network = Query({
-        'servertype': 'route_network',
-        'state': Not('retired'),
-        'intern_ip': Contains(server['intern_ip']),
-    }, [
-        'hostname',
-        'intern_ip',
-        'default_gateway',
-        'internal_gateway',
-        'primary_ip6',
-        'vlan_tag',
-    ]).get()
+    route_network = get_route_network_index().lookup(server['intern_ip'])
 
     default_gateway_route, internal_gateway_route = get_gateways(route_network)
 
@@ -54,21 +42,4 @@ def get_gateways(network):
         for given network. If they are not defined, return
         empty dictionaries to simulate Serveradmin objects.
     """
-
-    if network.get('default_gateway'):
-        default_gateway = Query({
-            'state': Not('retired'),
-            'hostname': network['default_gateway'],
-        }).get()
-    else:
-        default_gateway = {}
-
-    if network.get('internal_gateway'):
-        internal_gateway = Query({
-            'state': Not('retired'),
-            'hostname': network['internal_gateway'],
-        }).get()
-    else:
-        internal_gateway = {}
-
-    return default_gateway, internal_gateway
+    return get_route_network_index().get_gateways(network)
@@ -12,9 +12,13 @@ class Transaction(object):
     """Context of an igvm action with rollback support.
     Each successful step register a callback to undo its changes.
     If the transaction fails, all registered callbacks are invoked in
-    LIFO order."""
+    LIFO order.
+    The hosts with staged changes are committed together on the next
+    checkpoint to save the round trips to Serveradmin.  Their changes
+    are discarded, if the transaction fails before."""
     def __init__(self):
         self._actions = []
+        self._staged = []
 
     def __enter__(self):
         return self
@@ -23,9 +27,28 @@ class Transaction(object):
         if traceback:
             self.rollback()
         else:
-            self.checkpoint()
+            try:
+                self.checkpoint()
+            except Exception:
+                self.rollback()
+                raise
         return False
 
+    def stage(self, host):
+        """Commit the changes of the host on the next checkpoint"""
+        if host not in self._staged:
+            self._staged.append(host)
+
+    def flush(self):
+        """Commit the staged changes now"""
+        # The host is only removed after it is committed, so its changes
+        # are discarded on rollback, if the commit fails.
+        while self._staged:
+            host = self._staged[0]
+            if host.dataset_obj.is_dirty():
+                host.commit()
+            self._staged.pop(0)
+
     def on_rollback(self, name, fn, *args, **kwargs):
         assert callable(fn)
         if self._actions is None:
@@ -33,6 +56,13 @@ class Transaction(object):
         self._actions.append((name, fn, args, kwargs))
 
     def rollback(self):
+        # The staged changes are discarded before running the rollback
+        # actions, so the actions committing the same hosts don't commit
+        # them.
+        for host in self._staged:
+            host.dataset_obj.rollback()
+        self._staged = []
+
         if not self._actions:
             return
         log.info('Rolling back transaction')
@@ -49,7 +79,9 @@ class Transaction(object):
 
     def checkpoint(self):
         """Marks a safe state within the transaction. All previous on_rollback
-        actions will not be invoked, even if the transaction fails later on."""
+        actions will not be invoked, even if the transaction fails later on.
+        The staged changes are committed first."""
+        self.flush()
         log.debug('Checkpoint reached, all previous actions are now permanent')
         self._actions = []
 
@@ -3,11 +3,25 @@
 Copyright (c) 2018, InnoGames GmbH
 """
 
-from libvirt import open as libvirt_open, libvirtError
+import logging
+from threading import Lock, Thread
+
+from libvirt import (
+    VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+    open as libvirt_open,
+    libvirtError,
+    virEventRegisterDefaultImpl,
+    virEventRunDefaultImpl,
+)
 
 from fabric.api import env
 
+log = logging.getLogger(__name__)
+
 _conns = {}
+_conns_lock = Lock()
+_callback_ids = {}
+_event_loop = None
 
 
 def get_virtconn(fqdn):
@@ -18,26 +32,81 @@ def get_virtconn(fqdn):
         username = ''
 
     if fqdn not in _conns:
+        _start_event_loop()
         url = 'qemu+ssh://{}{}/system'.format(username, fqdn)
-        _conns[fqdn] = libvirt_open(url)
+        conn = libvirt_open(url)
+
+        # Hypervisors are validated concurrently on placement.  We don't
+        # hold the lock while connecting to let the connections to multiple
+        # hypervisors be established at the same time.
+        with _conns_lock:
+            if fqdn in _conns:
+                conn.close()
+            else:
+                _conns[fqdn] = conn
     return _conns[fqdn]
 
 
+def register_domain_events(fqdn, callback):
+    """Register the callback for the lifecycle events of the domains
+
+    The callback is deregistered, when the connection is closed.  We
+    return the connection the callback is registered for.
+    """
+    conn = get_virtconn(fqdn)
+    callback_id = conn.domainEventRegisterAny(
+        None, VIR_DOMAIN_EVENT_ID_LIFECYCLE, callback, None
+    )
+    with _conns_lock:
+        _callback_ids.setdefault(fqdn, []).append(callback_id)
+    return conn
+
+
+def _start_event_loop():
+    """Run the libvirt event loop to receive the domain events
+
+    The event loop must be registered before opening the connections.
+    The events are only used to drop the cached information, so we
+    continue without them, if the event loop cannot be started.
+    """
+    global _event_loop
+
+    with _conns_lock:
+        if _event_loop is not None:
+            return
+        try:
+            virEventRegisterDefaultImpl()
+        except libvirtError as error:
+            log.debug('Cannot register libvirt event loop: {}'.format(error))
+            _event_loop = False
+            return
+        _event_loop = Thread(target=_run_event_loop, name='libvirt-events')
+        _event_loop.daemon = True
+        _event_loop.start()
+
+
+def _run_event_loop():
+    while True:
+        virEventRunDefaultImpl()
+
+
 def close_virtconn(fqdn):
-    if fqdn in _conns:
-        conn = _conns[fqdn]
+    with _conns_lock:
+        conn = _conns.pop(fqdn, None)
+        callback_ids = _callback_ids.pop(fqdn, [])
+    if conn is None:
+        return
+    for callback_id in callback_ids:
         try:
-            conn.close()
+            conn.domainEventDeregisterAny(callback_id)
         except libvirtError:
             pass
-        del _conns[fqdn]
+    try:
+        conn.close()
+    except libvirtError:
+        pass
 
 
 def close_virtconns():
-    for fqdn in _conns.keys():
-        conn = _conns[fqdn]
-        try:
-            conn.close()
-        except libvirtError:
-            pass
-        del _conns[fqdn]
+    for fqdn in list(_conns.keys()):
+        close_virtconn(fqdn)
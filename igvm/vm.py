@@ -7,15 +7,19 @@ import logging
 import time
 
 from base64 import b64decode
-from fabric.api import cd, get, put, run, settings
+from collections import deque
 from hashlib import sha1, sha256
 from ipaddress import ip_address
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from os import environ
+from pipes import quote
 from re import compile as re_compile
 from StringIO import StringIO
 from uuid import uuid4
 
-from adminapi.dataset import Query
+import numpy
+
 from adminapi.filters import Any
 
 from igvm.exceptions import (
@@ -23,18 +27,30 @@ from igvm.exceptions import (
     HypervisorError,
     RemoteCommandError,
 )
-from igvm.host import Host
+from igvm.host import Host, get_fqdn, get_servers
 from igvm.hypervisor import Hypervisor
-from igvm.hypervisor_ranking import HypervisorRanking
+from igvm.hypervisor_aggregates import HypervisorAggregates
+from igvm.hypervisor_preferences import (
+    get_anti_affinity_attributes,
+    get_required_preferences,
+)
+from igvm.hypervisor_ranking import (
+    HypervisorRanking,
+    get_query_attributes,
+    get_viable_rows,
+)
+from igvm.query_cache import query
+from igvm.rootfs_overlay import RootfsOverlay
+from igvm.session import get_session
 from igvm.settings import (
     DEFAULT_SWAP_SIZE,
-    HYPERVISOR_ATTRIBUTES,
+    HYPERVISOR_CHECK_CONCURRENCY,
     HYPERVISOR_PREFERENCES,
 )
+from igvm.ssh import get_ssh_connection
 from igvm.utils.cli import yellow
 from igvm.utils.network import get_network_config
 from igvm.utils.portping import wait_until
-from igvm.utils.template import upload_template
 from igvm.utils.transaction import run_in_transaction
 from igvm.utils.units import parse_size
 
@@ -50,13 +66,16 @@ class VM(Host):
     servertype = 'vm'
 
     def __init__(self, name_or_obj, ignore_reserved=False,
-                 hypervisor=None):
+                 hypervisor=None, hypervisor_attributes=None):
         super(VM, self).__init__(name_or_obj, ignore_reserved)
 
+        # The commands only needing some attributes of the hypervisor
+        # pass them.
         if not hypervisor and self.dataset_obj['xen_host']:
-            self.hypervisor = Hypervisor(
+            self.hypervisor = Hypervisor.get_shared(
                 self.dataset_obj['xen_host'],
-                ignore_reserved=True
+                ignore_reserved=True,
+                attributes=hypervisor_attributes,
             )
         else:
             self.hypervisor = hypervisor
@@ -88,14 +107,6 @@ class VM(Host):
                 )
             )
 
-    def vm_host(self):
-        """ Return correct ssh host for mounted and unmounted vm """
-
-        if self.mounted:
-            return self.hypervisor.fabric_settings()
-        else:
-            return self.fabric_settings()
-
     def vm_path(self, path=''):
         """ Append correct prefix to reach VM's / directory """
 
@@ -107,79 +118,98 @@ class VM(Host):
         else:
             return '/{}'.format(path)
 
-    def run(self, command, silent=False, with_sudo=True):
-        """ Same as Fabric's run() but works on mounted or running vm
+    def run(self, command, silent=False, with_sudo=True, warn_only=False,
+            stdin=None):
+        """ Same as Host.run() but works on mounted or running vm
 
             When running in a mounted VM image, run everything in chroot
-            and in separate shell inside chroot. Normally Fabric runs shell
-            around commands.
+            and in separate shell inside chroot. Normally Host.run() runs
+            shell around commands.
         """
-        with self.vm_host():
-            if self.mounted:
-                return self.hypervisor.run(
-                    'chroot {} /bin/sh -c \'{}\''.format(
-                        self.vm_path(''), command,
-                    ),
-                    shell=False, shell_escape=True,
-                    silent=silent,
-                    with_sudo=with_sudo,
-                )
-            else:
-                return super(VM, self).run(command, silent=silent)
+        if self.mounted:
+            return self.hypervisor.run(
+                'chroot {} /bin/sh -c {}'.format(
+                    self.vm_path(''), quote(command),
+                ),
+                shell=False,
+                silent=silent,
+                with_sudo=with_sudo,
+                warn_only=warn_only,
+                stdin=stdin,
+            )
+        else:
+            return super(VM, self).run(
+                command, silent=silent, warn_only=warn_only, stdin=stdin
+            )
 
     def read_file(self, path):
         """Read a file from a running VM or a mounted image on HV."""
-        with self.vm_host():
-            if self.mounted:
-                return self.hypervisor.read_file('{}/{}'.format(
-                    self.vm_path(''),
-                    path,
-                ))
-            return super(VM, self).read_file(path)
+        if self.mounted:
+            return self.hypervisor.read_file('{}/{}'.format(
+                self.vm_path(''),
+                path,
+            ))
+        return super(VM, self).read_file(path)
 
-    def upload_template(self, filename, destination, context=None):
-        """" Same as Fabric's template() but works on mounted or running vm """
-        with self.vm_host():
-            return upload_template(
-                filename, self.vm_path(destination), context
+    def read_files(self, paths):
+        """Read files from a running VM or a mounted image on HV at once"""
+        if self.mounted:
+            contents = self.hypervisor.read_files(
+                [self.vm_path(p) for p in paths]
             )
-
-    def get(self, remote_path, local_path):
-        """" Same as Fabric's get() but works on mounted or running vm """
-        with self.vm_host():
-            return get(self.vm_path(remote_path), local_path, temp_dir='/tmp')
+            return {p: contents[self.vm_path(p)] for p in paths}
+        return super(VM, self).read_files(paths)
 
     def put(self, remote_path, local_path, mode='0644'):
         """ Same as Fabric's put() but works on mounted or running vm
 
-            Setting permissions on files and using sudo via Fabric's put()
-            seems broken, at least for mounted VM. This is why we run
-            extra commands here.
+            The content of the local file or file object is sent to
+            the standard input of the commands writing it, so they run
+            through the same connection as root and inside the chroot.
         """
-        with self.vm_host():
-            tempfile = '/tmp/' + str(uuid4())
-            put(local_path, self.vm_path(tempfile))
-            self.run('mv {0} {1} ; chmod {2} {1}'.format(
-                tempfile, remote_path, mode
-            ))
+        if hasattr(local_path, 'read'):
+            # Fabric is also reading file objects from the start.
+            local_path.seek(0)
+            content = local_path.read()
+        else:
+            with open(local_path, 'rb') as fd:
+                content = fd.read()
+
+        tempfile = '/tmp/' + str(uuid4())
+        batch = self.batch(silent=True)
+        batch.add('cat > {0}'.format(tempfile))
+        batch.add('mv {0} {1}'.format(tempfile, remote_path))
+        batch.add('chmod {0} {1}'.format(mode, remote_path))
+        batch.run(stdin=content)
 
     def set_state(self, new_state, tx=None):
-        """Changes state of VM for LB and Nagios downtimes"""
+        """Changes state of VM for LB and Nagios downtimes
+
+        The state is committed right away for the downtimes to be effective
+        before we continue.
+        """
         self.previous_state = self.dataset_obj['state']
         if new_state == self.previous_state:
             return
         log.debug('Setting VM to state {}'.format(new_state))
         self.dataset_obj['state'] = new_state
-        self.dataset_obj.commit()
+        self.commit()
         if tx:
             tx.on_rollback('reset_state', self.reset_state)
 
-    def reset_state(self):
-        """Change state of VM to the original one"""
-        # Transaction is not necessary here, because reverting it
+    def reset_state(self, tx=None):
+        """Change state of VM to the original one
+
+        The state is only staged on the transaction, if one is given.
+        """
+        # Rollback is not necessary here, because reverting it
         # would set the value to the original one anyway.
-        if hasattr(self, 'previous_state'):
-            self.set_state(self.previous_state)
+        if (
+            hasattr(self, 'previous_state') and
+            self.dataset_obj['state'] != self.previous_state
+        ):
+            self.dataset_obj['state'] = self.previous_state
+            self.commit(tx)
 
     def set_num_cpu(self, num_cpu):
         """Changes the number of CPUs."""
@@ -266,9 +296,10 @@ class VM(Host):
             time.sleep(1)
         return False
 
-    def meminfo(self):
+    def meminfo(self, contents=None):
         """Returns a dictionary of /proc/meminfo entries."""
-        contents = self.read_file('/proc/meminfo')
+        if contents is None:
+            contents = self.read_file('/proc/meminfo')
         result = {}
         for line in contents.splitlines():
             try:
@@ -278,8 +309,9 @@ class VM(Host):
             result[key] = value
         return result
 
-    def memory_free(self):
-        meminfo = self.meminfo()
+    def memory_free(self, meminfo=None):
+        if meminfo is None:
+            meminfo = self.meminfo()
 
         if 'MemAvailable' in meminfo:
             kib_free = parse_size(meminfo['MemAvailable'], 'K')
@@ -312,11 +344,14 @@ class VM(Host):
 
         if self.hypervisor.vm_defined(self) and self.is_running():
             result.update(self.hypervisor.vm_sync_from_hypervisor(self))
+            proc = self.read_files(['/proc/meminfo', '/proc/loadavg'])
             result.update({
                 'status': 'running',
-                'memory_free': self.memory_free(),
+                'memory_free': self.memory_free(
+                    self.meminfo(proc['/proc/meminfo'])
+                ),
                 'disk_free_gib': self.disk_free(),
-                'load': self.read_file('/proc/loadavg').split()[:3],
+                'load': proc['/proc/loadavg'].split()[:3],
             })
             result.update(self.hypervisor.vm_info(self))
         elif self.hypervisor.vm_defined(self):
@@ -371,8 +406,9 @@ class VM(Host):
 
         # We are updating the information on the Serveradmin, before starting
         # the VM, because the VM would still be on the hypervisor even if it
-        # fails to start.
-        self.dataset_obj.commit()
+        # fails to start.  It is committed on the checkpoint together with
+        # the changes staged before.
+        self.commit(tx)
 
         # VM was successfully built, don't risk undoing all this just because
         # start fails.
@@ -392,11 +428,7 @@ class VM(Host):
         """Rename the VM"""
         assert tx is not None, 'tx populated by run_in_transaction'
 
-        new_fqdn = (
-            new_hostname
-            if new_hostname.endswith('.ig.local')
-            else new_hostname + '.ig.local'
-        )
+        new_fqdn = get_fqdn(new_hostname)
 
         if new_fqdn == self.fqdn:
             raise ConfigError('The VM already named as "{}"'.format(self.fqdn))
@@ -421,7 +453,7 @@ class VM(Host):
         self.shutdown(tx=tx)
         self.hypervisor.rename_vm(self, new_hostname)
 
-        self.dataset_obj.commit()
+        self.commit()
 
         self.start(tx=tx)
 
@@ -430,25 +462,21 @@ class VM(Host):
 
         VM storage must be mounted on the hypervisor.
         """
-        fd = StringIO(self.fqdn)
-        self.put('/etc/hostname', fd)
-        self.put('/etc/mailname', fd)
+        overlay = RootfsOverlay()
+        overlay.add_file('/etc/hostname', self.fqdn)
+        overlay.add_file('/etc/mailname', self.fqdn)
 
-        self.upload_template('etc/fstab', 'etc/fstab', {
+        overlay.add_template('etc/fstab', '/etc/fstab', {
             'blk_dev': self.hypervisor.vm_block_device_name(),
             'type': 'xfs',
             'mount_options': 'defaults'
         })
-        self.upload_template('etc/hosts', '/etc/hosts')
-        self.upload_template('etc/inittab', '/etc/inittab')
+        overlay.add_template('etc/hosts', '/etc/hosts')
+        overlay.add_template('etc/inittab', '/etc/inittab')
 
         # Copy resolv.conf from Hypervisor
-        fd = StringIO()
-        with self.hypervisor.fabric_settings(
-                cd(self.hypervisor.vm_mount_path(self))
-        ):
-            get('/etc/resolv.conf', fd)
-        self.put('/etc/resolv.conf', fd)
+        overlay.add_copy('/etc/resolv.conf', '/etc/resolv.conf')
+        overlay.extract(self)
 
         self.create_swap(DEFAULT_SWAP_SIZE)
         self.create_ssh_keys()
@@ -472,34 +500,34 @@ class VM(Host):
                 .format(key_type)
             )
 
-            fd = StringIO()
-            self.get('/etc/ssh/ssh_host_{0}_key.pub'.format(key_type), fd)
-            pub_key = b64decode(fd.getvalue().split(None, 2)[1])
+        pub_keys = self.read_files([
+            '/etc/ssh/ssh_host_{0}_key.pub'.format(key_type)
+            for key_id, key_type in key_types
+        ])
+        for key_id, key_type in key_types:
+            pub_key = b64decode(pub_keys[
+                '/etc/ssh/ssh_host_{0}_key.pub'.format(key_type)
+            ].split(None, 2)[1])
             for fp_id, fp_type in fp_types:
                 self.dataset_obj['sshfp'].add('{} {} {}'.format(
                     key_id, fp_id, fp_type(pub_key).hexdigest()
                 ))
 
     def create_swap(self, size_MiB):
-        self.run(
-            'dd if=/dev/zero of=/swap bs=1M count={}'.format(size_MiB)
-        )
-        self.run('/bin/chmod 0600 /swap')
-        self.run('/sbin/mkswap /swap')
+        batch = self.batch()
+        batch.add('dd if=/dev/zero of=/swap bs=1M count={}'.format(size_MiB))
+        batch.add('/bin/chmod 0600 /swap')
+        batch.add('/sbin/mkswap /swap')
+        batch.run()
 
     def run_puppet(self, clear_cert, tx):
         """Runs Puppet in chroot on the hypervisor."""
 
         if clear_cert:
-            with settings(
-                host_string=self.dataset_obj['puppet_ca'],
-                user='root',
+            get_ssh_connection('root@' + self.dataset_obj['puppet_ca']).run(
+                '/usr/bin/puppet cert clean {}'.format(self.fqdn),
                 warn_only=True,
-            ):
-                run(
-                    '/usr/bin/puppet cert clean {}'.format(self.fqdn),
-                    shell=False,
-                )
+            )
 
         self.block_autostart()
 
@@ -529,8 +557,11 @@ class VM(Host):
         self.unblock_autostart()
 
     def block_autostart(self):
-        fd = StringIO('#!/bin/sh\nexit 101\n')
-        self.put('/usr/sbin/policy-rc.d', fd, '0755')
+        overlay = RootfsOverlay()
+        overlay.add_file(
+            '/usr/sbin/policy-rc.d', '#!/bin/sh\nexit 101\n', 0o755
+        )
+        overlay.extract(self)
 
     def unblock_autostart(self):
         self.run('rm /usr/sbin/policy-rc.d')
@@ -538,30 +569,127 @@ class VM(Host):
     def copy_postboot_script(self, script):
         self.put('/buildvm-postboot', script, '0755')
 
-    def get_best_hypervisor(self, hv_states=['online']):
+    def get_best_hypervisor(self, hv_states=['online'],
+                            check_concurrency=None):
         """Get best hypervisor
 
         Get the best hypervisor and return it rather then directly setting it.
+        The given number of the best ranked hypervisors are validated
+        concurrently, by default the number of the active session.
         """
-        hypervisors = (Hypervisor(o) for o in Query({
+        if check_concurrency is None:
+            session = get_session()
+            check_concurrency = (
+                session.check_concurrency if session
+                else HYPERVISOR_CHECK_CONCURRENCY
+            )
+
+        hypervisor_objs = query({
             'servertype': 'hypervisor',
             'environment': environ.get('IGVM_MODE', 'production'),
             'vlan_networks': self.dataset_obj['route_network'],
             'state': Any(*hv_states),
-        }, HYPERVISOR_ATTRIBUTES))
+        }, get_query_attributes(HYPERVISOR_PREFERENCES))
+
+        # The VMs of the hypervisors are aggregated only once for all of
+        # the preferences.
+        aggregates = HypervisorAggregates(
+            hypervisor_objs,
+            get_anti_affinity_attributes(HYPERVISOR_PREFERENCES),
+        )
 
+        # The hypervisors disqualified by the leading preferences would be
+        # ranked after all others, so we only need them, if none of the
+        # viable ones passes the checks.
+        viable = get_viable_rows(self, aggregates)
+        log.debug(
+            '{} of {} hypervisors are viable.'
+            .format(viable.sum(), len(viable))
+        )
+        pool = None
+        warm_ups = {}
+        if check_concurrency > 1:
+            pool = ThreadPool(check_concurrency)
+            warm_ups = self._warm_up_hypervisors(
+                pool, aggregates, numpy.flatnonzero(viable), check_concurrency
+            )
+        try:
+            for rows in (
+                numpy.flatnonzero(viable), numpy.flatnonzero(~viable)
+            ):
+                if not len(rows):
+                    continue
+                hypervisor = self._select_hypervisor(
+                    aggregates, rows, pool, check_concurrency, warm_ups
+                )
+                if hypervisor:
+                    return hypervisor
+        finally:
+            # No more tasks are submitted, but the ones already running
+            # must finish before we return, because they are using
+            # the shared connections and hypervisors.  Their results are
+            # ignored.
+            if pool:
+                pool.close()
+                pool.join()
+
+        raise VMError('Cannot find a hypervisor')
+
+    def _warm_up_hypervisors(self, pool, aggregates, rows, count):
+        """Start connecting to the likely best hypervisors in the pool
+
+        The hypervisors in the given rows of the aggregates are ranked only
+        by the preferences until the over-allocation, so the connections
+        to the best ones are established and their facts are gathered
+        while the ranking by all preferences is running.  We return
+        the results of the tasks by the hostnames of the hypervisors.
+        """
+        ranking = HypervisorRanking(
+            self,
+            None,
+            aggregates,
+            get_required_preferences(HYPERVISOR_PREFERENCES),
+            rows=rows,
+        )
+        # The last key is the primary one for lexsort().
+        order = numpy.lexsort(ranking.get_columns()[::-1])[:count]
+
+        warm_ups = {}
+        for row in rows[order]:
+            hypervisor_obj = aggregates.hypervisor_objs[row]
+            warm_ups[hypervisor_obj['hostname']] = pool.apply_async(
+                _warm_up_hypervisor, (hypervisor_obj, )
+            )
+        return warm_ups
+
+    def _select_hypervisor(self, aggregates, rows, pool, check_concurrency,
+                           warm_ups):
+        """Select the best ranked hypervisor passing the checks
+
+        The hypervisors in the given rows of the aggregates are ranked as
+        lightweight candidates.  Only the ones reaching the checks are
+        constructed.  We return None, if none of them passes the checks.
+        """
         log.debug('Evaluating hypervisors...')
 
         selected_hypervisor = None
         index = len(HYPERVISOR_PREFERENCES)
         hypervisor_count = 0
 
-        # We use decorate-sort-undecorate pattern to get preferred hypervisors.
-        for ranking in sorted(HypervisorRanking(self, h) for h in hypervisors):
+        # All preferences are evaluated once for all of the hypervisors
+        # and sorted in a single pass.
+        ranking = list(HypervisorRanking(self, None, aggregates, rows=rows))
+
+        # The validation of the next hypervisors starts together with the
+        # best ranked one, so their connections are already established
+        # by the time we need them.
+        checks = self._check_hypervisors(
+            (h for h, i in ranking), pool, check_concurrency, warm_ups
+        )
+        for hypervisor, new_index in ranking:
 
             # We care to keep track of the preference indexes only to provide
             # good logging.
-            new_index = ranking.get_last_preference_index()
             if new_index < index:
                 if hypervisor_count:
                     log.warning(
@@ -585,16 +713,17 @@ class VM(Host):
             # The actual resources are not checked during hypervisor ranking
             # for performance.  We need to validate the hypervisor using
             # the actual values before the final decision.
-            try:
-                ranking.hypervisor.check_vm(self)
-            except HypervisorError as error:
+            checked_hypervisor, error = next(checks)
+            assert checked_hypervisor.fqdn == hypervisor.fqdn
+            hypervisor = checked_hypervisor
+            if error:
                 log.warning(
                     'Preferred hypervisor "{}" is skipped:  {}'
-                    .format(ranking.hypervisor, error)
+                    .format(hypervisor, error)
                 )
                 continue
 
-            selected_hypervisor = ranking.hypervisor
+            selected_hypervisor = hypervisor
             log.info(
                 'Hypervisor "{}" selected with decisive preference {!r} '
                 'after checking {} preferences.'
@@ -613,17 +742,116 @@ class VM(Host):
                 ))
             )
 
-        if not selected_hypervisor:
-            raise VMError('Cannot find a hypervisor')
+        checks.close()
 
         return selected_hypervisor
 
-    def set_best_hypervisor(self, hv_states=['online']):
+    def _check_hypervisors(self, candidates, pool, concurrency, warm_ups):
+        """Validate the hypervisors for the VM in the given order
+
+        The candidates are constructed as hypervisors right before their
+        validation.  The next hypervisors are validated in the thread pool
+        up to the given concurrency, while the caller is considering
+        the current one.  This generator yields the hypervisors with
+        the HypervisorError raised by the validation or None.
+        """
+        hypervisors = (
+            Hypervisor.get_shared(c.dataset_obj) for c in candidates
+        )
+        if pool is None:
+            for hypervisor in hypervisors:
+                try:
+                    hypervisor.check_vm(self)
+                except HypervisorError as error:
+                    yield hypervisor, error
+                else:
+                    yield hypervisor, None
+            return
+
+        def submit(hypervisor):
+            return hypervisor, pool.apply_async(self._check_hypervisor, (
+                hypervisor, warm_ups.get(hypervisor.dataset_obj['hostname'])
+            ))
+
+        hypervisors = iter(hypervisors)
+        pending = deque(submit(h) for h in islice(hypervisors, concurrency))
+        while pending:
+            hypervisor, result = pending.popleft()
+            for next_hypervisor in islice(hypervisors, 1):
+                pending.append(submit(next_hypervisor))
+            try:
+                result.get()
+            except HypervisorError as error:
+                yield hypervisor, error
+            else:
+                yield hypervisor, None
+
+    def _check_hypervisor(self, hypervisor, warm_up=None):
+        # The warm-ups are submitted to the pool before the checks, so
+        # they are already running by the time we wait for them.
+        if warm_up:
+            warm_up.wait()
+        hypervisor.check_vm(self)
+
+    def set_best_hypervisor(self, hv_states=['online'], tx=None):
         """Set best hypervisor
 
         Find the best or another hypervisor for the given virtual machine.
         """
-        self.hypervisor = self.get_best_hypervisor(hv_states)
+        self.set_hypervisor(self.get_best_hypervisor(hv_states), tx)
+
+    def set_hypervisor(self, hypervisor, tx=None):
+        """Set the hypervisor of the VM on Serveradmin
+
+        The hypervisor is committed right away, so the other igvm processes
+        see its resources as taken.  It is reset, if the transaction is
+        rolled back.
+        """
+        previous_hypervisor = self.hypervisor
+        self.hypervisor = hypervisor
         logging.info('Setting hypervisor to {}'.format(self.hypervisor))
         self.dataset_obj['xen_host'] = self.hypervisor.dataset_obj['hostname']
-        self.dataset_obj.commit()
+        self.commit()
+        if tx:
+            tx.on_rollback(
+                'reset hypervisor', self.reset_hypervisor, previous_hypervisor
+            )
+
+    def reset_hypervisor(self, hypervisor=None):
+        """Set the hypervisor of the VM back or clear it on Serveradmin"""
+        self.hypervisor = hypervisor
+        self.dataset_obj['xen_host'] = (
+            hypervisor.dataset_obj['hostname'] if hypervisor else None
+        )
+        self.commit()
+
+
+def load_vms(vm_hostnames, ignore_reserved=False):
+    """Load multiple VMs with their hypervisors
+
+    The VMs and their hypervisors are loaded with a single Query each
+    instead of two per VM.  The VMs are returned in the given order.
+    """
+    vm_objs = get_servers(vm_hostnames, 'vm')
+    hypervisor_names = sorted(set(
+        o['xen_host'] for o in vm_objs if o['xen_host']
+    ))
+    hypervisors = {
+        o['hostname']: Hypervisor.get_shared(o, ignore_reserved=True)
+        for o in get_servers(hypervisor_names, 'hypervisor')
+    }
+
+    return [
+        VM(o, ignore_reserved, hypervisors.get(o['xen_host']))
+        for o in vm_objs
+    ]
+
+
+def _warm_up_hypervisor(hypervisor_obj):
+    """Connect to the hypervisor and gather its facts for the checks
+
+    The errors are ignored, as the checks will encounter them again.
+    """
+    hypervisor = Hypervisor.get_shared(hypervisor_obj)
+    hypervisor.conn()
+    hypervisor.facts
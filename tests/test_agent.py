@@ -0,0 +1,99 @@
+"""igvm - Agent Tests
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from threading import Thread
+
+from igvm import remote_agent
+from igvm.agent import Agent
+from igvm.exceptions import RemoteCommandError
+
+
+class AgentTest(unittest.TestCase):
+    """Test the agent running locally instead of on a hypervisor"""
+
+    def setUp(self):
+        self.process = subprocess.Popen(
+            [sys.executable, remote_agent.__file__],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.agent = Agent(
+            'localhost', self.process.stdout, self.process.stdin
+        )
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.agent.close()
+        self.process.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def test_run(self):
+        result = self.agent.run('echo out; echo err >&2', silent=True)
+        self.assertEqual(result, 'out')
+        self.assertEqual(result.stderr, 'err')
+        self.assertTrue(result.succeeded)
+
+        result = self.agent.run('exit 3', silent=True, warn_only=True)
+        self.assertEqual(result.return_code, 3)
+        self.assertTrue(result.failed)
+
+        with self.assertRaises(RemoteCommandError):
+            self.agent.run('false', silent=True)
+
+    def test_run_stdin(self):
+        self.assertEqual(
+            self.agent.run('cat', silent=True, stdin=b'data\n'), 'data'
+        )
+
+    def test_run_parallel(self):
+        results = []
+        threads = [
+            Thread(target=lambda i=i: results.append(
+                self.agent.run('sleep 0.2; echo {}'.format(i), silent=True)
+            ))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ['0', '1', '2', '3', '4'])
+
+    def test_stat(self):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'w') as fd:
+            fd.write('content')
+        os.chmod(path, 0o640)
+
+        result = self.agent.stat(path)
+        self.assertEqual(result['size'], 7)
+        self.assertEqual(result['mode'], 0o640)
+        self.assertTrue(result['is_file'])
+        self.assertTrue(self.agent.stat(self.tmpdir)['is_dir'])
+        self.assertIsNone(self.agent.stat(os.path.join(self.tmpdir, 'none')))
+
+    def test_read_files(self):
+        paths = [os.path.join(self.tmpdir, n) for n in ('a', 'b')]
+        for path in paths:
+            with open(path, 'w') as fd:
+                fd.write(path + '\n')
+
+        self.assertEqual(
+            self.agent.read_files(paths), {p: p + '\n' for p in paths}
+        )
+        with self.assertRaises(RemoteCommandError):
+            self.agent.read_files([os.path.join(self.tmpdir, 'none')])
+
+    def test_exit(self):
+        self.process.kill()
+        with self.assertRaises(RemoteCommandError):
+            self.agent.run('sleep 1', silent=True)
+        self.assertTrue(self.agent.closed)
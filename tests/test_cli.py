@@ -0,0 +1,23 @@
+"""igvm - Command Line Interface Tests
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import unittest
+
+from igvm.cli import parse_args
+from igvm.commands import rebalance
+
+
+class ParseArgsTest(unittest.TestCase):
+    def test_rebalance(self):
+        args = parse_args(['rebalance'])
+        self.assertEqual(args.pop('func'), rebalance)
+        self.assertEqual(args.pop('max_moves'), 10)
+        self.assertNotIn('plan', args)
+
+    def test_rebalance_plan(self):
+        args = parse_args(['rebalance', '--plan', '--max-moves', '3'])
+        self.assertEqual(args.pop('func'), rebalance)
+        self.assertEqual(args.pop('max_moves'), 3)
+        self.assertNotIn('plan', args)
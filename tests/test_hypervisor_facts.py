@@ -0,0 +1,49 @@
+"""igvm - Hypervisor Facts Tests
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import unittest
+
+from igvm.hypervisor_facts import HypervisorFacts, SEPARATOR
+
+LVM_OUTPUT = '\n'.join([
+    '  vm1 xen-data 10737418240',
+    '--- vgs ---',
+    '  xen-data 53687091200 7',
+])
+
+
+class HypervisorFactsTest(unittest.TestCase):
+    def test_parse(self):
+        facts = HypervisorFacts.parse('\n'.join([
+            'num_cpus 8',
+            'numa_cpulist 0-3',
+            'numa_cpulist 4-7',
+            'mem_total_kib 65536',
+            'boot_id abc',
+            'libvirt_version 1.2.9',
+            'qemu_version 2.1.2 (Debian 1:2.1+dfsg-12)',
+            SEPARATOR,
+            LVM_OUTPUT,
+        ]))
+        self.assertEqual(facts.num_cpus, 8)
+        self.assertEqual(facts.numa_cpulists, ['0-3', '4-7'])
+        self.assertEqual(facts.mem_total_kib, 65536)
+        self.assertEqual(facts.boot_id, 'abc')
+        self.assertEqual(facts.libvirt_version, (1, 2, 9))
+        self.assertEqual(facts.qemu_version, (2, 1, 2))
+
+    def test_parse_without_numa(self):
+        facts = HypervisorFacts.parse('\n'.join([
+            'num_cpus 8',
+            'mem_total_kib 65536',
+            'boot_id abc',
+            SEPARATOR,
+            LVM_OUTPUT,
+        ]))
+        self.assertEqual(facts.numa_cpulists, ['0-7'])
+
+    def test_cached_without_numa(self):
+        facts = HypervisorFacts(num_cpus=4, numa_cpulists=[])
+        self.assertEqual(facts.numa_cpulists, ['0-3'])
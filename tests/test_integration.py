@@ -20,10 +20,15 @@ from fabric.api import env
 from igvm.buildvm import buildvm
 from igvm.commands import (
     disk_set,
+    rebalance,
     host_info,
+    simulate_placement,
+    snapshot_export,
     mem_set,
     vcpu_set,
+    vm_build_many,
     vm_delete,
+    vm_place,
     vm_rebuild,
     vm_restart,
     vm_start,
@@ -34,18 +39,15 @@ from igvm.exceptions import (
     IGVMError,
     InvalidStateError,
     InconsistentAttributeError,
+    RemoteCommandError,
 )
 from igvm.hypervisor import Hypervisor
 from igvm.migratevm import migratevm
-from igvm.settings import (
-    COMMON_FABRIC_SETTINGS,
-    IMAGE_PATH,
-)
+from igvm.settings import IMAGE_PATH
 from igvm.utils.units import parse_size
 from igvm.vm import VM
 
 logging.basicConfig(level=logging.INFO)
-env.update(COMMON_FABRIC_SETTINGS)
 env['user'] = 'igtesting'  # Enforce user for integration testing process
 os.environ['IGVM_MODE'] = 'testing'
 
@@ -222,6 +224,43 @@ class BuildTest(IGVMTest):
         buildvm(self.vm_obj['hostname'])
         self.check_vm_present()
 
+    def test_place(self):
+        self.vm_obj['xen_host'] = None
+        self.vm_obj.commit()
+
+        # Doesn't change anything without commit
+        vm_place([self.vm_obj['hostname']])
+        self.assertEqual(self.get_vm_obj()['xen_host'], None)
+
+        vm_place([self.vm_obj['hostname']], commit=True)
+        self.assertIn(
+            self.get_vm_obj()['xen_host'],
+            [hv.dataset_obj['hostname'] for hv in HYPERVISORS],
+        )
+
+    def test_build_many(self):
+        self.vm_obj['xen_host'] = None
+        self.vm_obj.commit()
+        vm_build_many([self.vm_obj['hostname']])
+        self.check_vm_present()
+
+    def test_build_many_unexpected_error(self):
+        self.vm_obj['xen_host'] = None
+        self.vm_obj.commit()
+
+        def build(vm, **kwargs):
+            raise RuntimeError('Unexpected error')
+
+        original_build = VM.build
+        VM.build = build
+        try:
+            with self.assertRaises(RuntimeError):
+                vm_build_many([self.vm_obj['hostname']])
+        finally:
+            VM.build = original_build
+
+        self.assertEqual(self.get_vm_obj()['xen_host'], None)
+
     def test_build_stretch(self):
         self.vm_obj.update({
             'os': 'stretch',
@@ -543,6 +582,31 @@ class CommandTest(IGVMTest):
         self.vm.shutdown()
         host_info(self.vm_obj['hostname'])
 
+    def test_read_files(self):
+        paths = ['/etc/hostname', '/etc/hosts', '/proc/loadavg']
+        contents = self.vm.read_files(paths)
+        self.assertEqual(sorted(contents.keys()), sorted(paths))
+        self.assertEqual(
+            contents['/etc/hosts'], self.vm.read_file('/etc/hosts')
+        )
+
+        with self.assertRaises(RemoteCommandError):
+            self.vm.read_files(['/etc/hostname', '/nonexistent'])
+
+    def test_rebalance(self):
+        # Only prints the plan
+        rebalance()
+        self.check_vm_present()
+
+    def test_simulate_placement(self):
+        fd, path = tempfile.mkstemp(suffix='.json.gz')
+        os.close(fd)
+        try:
+            snapshot_export(path)
+            simulate_placement(path, count=10)
+        finally:
+            os.remove(path)
+
 
 class MigrationTest(IGVMTest):
     def setUp(self):
@@ -0,0 +1,214 @@
+"""igvm - Hypervisor Ranking Tests
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import random
+import unittest
+
+import numpy
+
+from igvm.hypervisor_aggregates import HypervisorAggregates
+from igvm.hypervisor_preferences import (
+    HashDifference,
+    HypervisorAttributeValue,
+    HypervisorAttributeValueLimit,
+    InsufficientResource,
+    OtherVMs,
+    OverAllocation,
+    get_anti_affinity_attributes,
+)
+from igvm.hypervisor_ranking import HypervisorRanking, get_viable_rows
+from igvm.settings import HYPERVISOR_PREFERENCES
+
+
+def old_insufficient_resource(preference, vm, hv):
+    total_size = hv.dataset_obj[preference.attribute]
+    vms_size = sum(v[preference.attribute] for v in hv.dataset_obj['vms'])
+    remaining_size = total_size - vms_size - preference.reserved
+    return remaining_size < vm.dataset_obj[preference.attribute]
+
+
+def old_other_vms(preference, vm, hv):
+    result = 0
+    for other_vm in hv.dataset_obj['vms']:
+        if other_vm['hostname'] == vm.dataset_obj['hostname']:
+            continue
+        if preference.values and not all(
+            vm.dataset_obj[a] == v
+            for a, v in zip(preference.attributes, preference.values)
+        ):
+            continue
+        if all(
+            other_vm[a] == vm.dataset_obj[a]
+            for a in preference.attributes
+        ):
+            result = 1
+    return result
+
+
+def old_hypervisor_attribute_value(preference, vm, hv):
+    # None used to be less than any number on Python 2.
+    value = hv.dataset_obj[preference.attribute]
+    return float('-inf') if value is None else value
+
+
+def old_hypervisor_attribute_value_limit(preference, vm, hv):
+    value = hv.dataset_obj[preference.attribute]
+    return value is not None and value > preference.limit
+
+
+def old_over_allocation(preference, vm, hv):
+    attribute = preference.attribute
+    cur_hv_cpus = sum(v[attribute] for v in vm.hypervisor.dataset_obj['vms'])
+    cur_hv_rl_cpus = vm.hypervisor.dataset_obj[attribute]
+    cur_ovr_allc = float(cur_hv_cpus) / float(cur_hv_rl_cpus)
+    tgt_hv_cpus = vm.dataset_obj[attribute] + sum(
+        v[attribute] for v in hv.dataset_obj['vms']
+    )
+    tgt_hv_rl_cpus = hv.dataset_obj[attribute]
+    tgt_ovr_allc = float(tgt_hv_cpus) / float(tgt_hv_rl_cpus)
+    return tgt_ovr_allc > cur_ovr_allc
+
+
+def old_hash_difference(preference, vm, hv):
+    return hash(hv.fqdn) - hash(vm.fqdn)
+
+
+OLD_RANKS = {
+    InsufficientResource: old_insufficient_resource,
+    OtherVMs: old_other_vms,
+    HypervisorAttributeValue: old_hypervisor_attribute_value,
+    HypervisorAttributeValueLimit: old_hypervisor_attribute_value_limit,
+    OverAllocation: old_over_allocation,
+    HashDifference: old_hash_difference,
+}
+
+
+def old_rank(preference, vm, hv):
+    """Evaluate the preference for a single hypervisor like before"""
+    if type(preference) not in OLD_RANKS:
+        raise NotImplementedError(repr(preference))
+    return OLD_RANKS[type(preference)](preference, vm, hv)
+
+
+class OldHypervisorRanking(object):
+    """The lazy pairwise comparison the columnar ranking replaced"""
+    def __init__(self, vm, hypervisor, preferences):
+        self.vm = vm
+        self.hypervisor = hypervisor
+        self.preferences = preferences
+        self.ranks = []
+
+    def __lt__(self, other):
+        rank_len = min(len(self.ranks), len(other.ranks))
+        ranks = self.ranks[:rank_len]
+        other_ranks = other.ranks[:rank_len]
+        if ranks < other_ranks:
+            return True
+        if ranks > other_ranks:
+            return False
+
+        for index in range(rank_len, len(self.preferences)):
+            rank = self.get_rank(index)
+            other_rank = other.get_rank(index)
+            if rank < other_rank:
+                return True
+            if rank > other_rank:
+                return False
+
+        raise Exception(
+            'Exact same preferences for hypervisor "{}" and "{}"'
+            .format(self.hypervisor, other.hypervisor)
+        )
+
+    def get_rank(self, index):
+        if len(self.ranks) == index:
+            self.ranks.append(
+                old_rank(self.preferences[index], self.vm, self.hypervisor)
+            )
+        return self.ranks[index]
+
+
+class FakeHost(object):
+    def __init__(self, dataset_obj):
+        self.dataset_obj = dataset_obj
+        self.fqdn = dataset_obj['hostname'] + '.ig.local'
+        self.hypervisor = None
+
+
+def get_vm_obj(hostname, rng):
+    return {
+        'hostname': hostname,
+        'disk_size_gib': rng.choice([10, 50, 100]),
+        'memory': rng.choice([1024, 4096, 8192]),
+        'num_cpu': rng.choice([1, 2, 4]),
+        'project': rng.choice(['ig', 'foe']),
+        'function': rng.choice(['web', 'db', 'master_db']),
+        'environment': 'production',
+        'game_market': rng.choice(['de', 'en']),
+        'game_world': rng.choice([0, 1]),
+        'game_type': None,
+        'xen_host': None,
+    }
+
+
+class HypervisorRankingTest(unittest.TestCase):
+    def test_all_preferences_compared(self):
+        # A new type of preference must be added to the comparison.
+        for preference in HYPERVISOR_PREFERENCES:
+            self.assertIn(type(preference), OLD_RANKS)
+
+    def test_same_order_as_pairwise_comparison(self):
+        rng = random.Random(42)
+        for attempt in range(20):
+            hypervisor_objs = []
+            for index in range(30):
+                hostname = 'hv{}'.format(index)
+                vm_objs = [
+                    get_vm_obj('vm{}-{}'.format(index, i), rng)
+                    for i in range(rng.randint(0, 6))
+                ]
+                for vm_obj in vm_objs:
+                    vm_obj['xen_host'] = hostname
+                hypervisor_objs.append({
+                    'hostname': hostname,
+                    # Few distinct values to have many ties, and small ones
+                    # to have non-viable hypervisors
+                    'disk_size_gib': rng.choice([100, 500, 1000]),
+                    'memory': rng.choice([8192, 32768, 65536]),
+                    'num_cpu': rng.choice([8, 16]),
+                    'cpu_util_vm_pct': rng.choice([None, 10, 50]),
+                    'cpu_util_pct': rng.choice([None, 10, 10, 20]),
+                    'vms': vm_objs,
+                })
+
+            source = FakeHost(hypervisor_objs[0])
+            vm = FakeHost(get_vm_obj('vm', rng))
+            vm.dataset_obj['xen_host'] = source.dataset_obj['hostname']
+            vm.hypervisor = source
+            source.dataset_obj['vms'].append(vm.dataset_obj)
+
+            old_order = [
+                r.hypervisor.dataset_obj['hostname'] for r in sorted(
+                    OldHypervisorRanking(
+                        vm, FakeHost(o), HYPERVISOR_PREFERENCES
+                    )
+                    for o in hypervisor_objs
+                )
+            ]
+
+            # The viable hypervisors are ranked before the others like
+            # VM.get_best_hypervisor() does.
+            aggregates = HypervisorAggregates(
+                hypervisor_objs,
+                get_anti_affinity_attributes(HYPERVISOR_PREFERENCES),
+            )
+            viable = get_viable_rows(vm, aggregates)
+            new_order = []
+            for rows in numpy.flatnonzero(viable), numpy.flatnonzero(~viable):
+                ranking = HypervisorRanking(vm, None, aggregates, rows=rows)
+                new_order.extend(h.dataset_obj['hostname'] for h, i in ranking)
+
+            self.assertTrue(viable.any() and not viable.all())
+            self.assertEqual(new_order, old_order)
@@ -0,0 +1,88 @@
+"""igvm - Route Network Index Tests
+
+Copyright (c) 2018, InnoGames GmbH
+"""
+
+import unittest
+
+from ipaddress import ip_address, ip_interface
+
+from igvm.exceptions import ConfigError
+from igvm.route_network_index import RouteNetworkIndex
+
+
+def get_route_network_obj(hostname, intern_ip, vlan_tag=None, state='online',
+                          primary_ip6=None):
+    return {
+        'hostname': hostname,
+        'intern_ip': ip_interface(intern_ip),
+        'default_gateway': None,
+        'internal_gateway': None,
+        'primary_ip6': primary_ip6 and ip_interface(primary_ip6),
+        'state': state,
+        'vlan_tag': vlan_tag,
+    }
+
+
+class FakeRouteNetworkIndex(RouteNetworkIndex):
+    """Index with other servers instead of querying Serveradmin"""
+    def __init__(self, route_network_objs, other_network_objs):
+        super(FakeRouteNetworkIndex, self).__init__(route_network_objs, [])
+        self.other_network_objs = other_network_objs
+        self.queried = []
+
+    def _query_other_networks(self, hostnames):
+        self.queried.append(hostnames)
+        return [
+            o for o in self.other_network_objs if o['hostname'] in hostnames
+        ]
+
+
+class RouteNetworkIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = FakeRouteNetworkIndex([
+            get_route_network_obj('net1', u'10.0.0.0/24', 1),
+            get_route_network_obj('net2', u'10.0.1.0/24', 2),
+            get_route_network_obj('net3', u'10.0.1.0/25'),
+            get_route_network_obj('net4', u'10.0.2.0/24', 4, 'retired'),
+            get_route_network_obj(
+                'net5', u'10.0.3.0/24', 5, primary_ip6=u'2001:db8::/64'
+            ),
+        ], [
+            {'hostname': 'other6', 'vlan_tag': 6},
+        ])
+
+    def test_lookup(self):
+        self.assertEqual(
+            self.index.lookup(ip_address(u'10.0.0.1'))['hostname'], 'net1'
+        )
+        self.assertEqual(
+            self.index.lookup(ip_address(u'10.0.1.200'))['hostname'], 'net2'
+        )
+
+    def test_lookup_overlapping(self):
+        # Getting the single route network containing the address from
+        # Serveradmin fails in this case, too.
+        with self.assertRaises(ConfigError):
+            self.index.lookup(ip_address(u'10.0.1.1'))
+
+    def test_lookup_missing(self):
+        # The networks are only found by their intern_ip like the Contains
+        # filter did.
+        for address in u'10.0.2.1', u'10.0.4.1', u'2001:db8::1':
+            with self.assertRaises(ConfigError):
+                self.index.lookup(ip_address(address))
+
+    def test_get_vlan_tags(self):
+        self.assertEqual(
+            self.index.get_vlan_tags(['net4', 'net2', 'net3', 'net2', 'none']),
+            [2, 4],
+        )
+
+    def test_get_vlan_tags_other_servers(self):
+        # The VLAN networks were not restricted to the route networks.
+        for attempt in range(2):
+            self.assertEqual(
+                self.index.get_vlan_tags(['other6', 'net1', 'none']), [1, 6]
+            )
+        self.assertEqual(self.index.queried, [['none', 'other6']])